@@ -3,8 +3,9 @@ import streamlit as st
 import time
 import base64
 import json
-import requests
+import asyncio
 import tempfile
+import contextlib
 import logging
 import traceback
 import io
@@ -17,6 +18,20 @@ from openai import OpenAI
 import uuid
 import streamlit.components.v1 as components
 import re
+import threading
+import hashlib
+from collections import OrderedDict, deque
+import random
+import statistics
+import keyword
+import ast
+import builtins
+import textwrap
+import math
+import heapq
+import bisect
+import zlib
+import httpx
 
 # =============================================
 # ANALYTICS INJECTION
@@ -312,69 +327,667 @@ def is_streamlit_cloud():
         return False
 
 
+# Configuración del pool de clientes OpenAI compartido por todo el proceso
+OPENAI_CLIENT_POOL_CONFIG = {
+    "max_clients": 32,  # Máximo de API keys con cliente activo (expulsión LRU)
+    "max_connections": 20,  # Conexiones HTTP simultáneas por cliente
+    "max_keepalive_connections": 10,  # Conexiones persistentes reutilizables
+    "keepalive_expiry": 30.0,  # Segundos antes de cerrar una conexión inactiva
+    "verification_ttl": 600,  # Vigencia (s) de la verificación de conectividad
+}
+
+
+class OpenAIClientPool:
+    """
+    Pool de clientes OpenAI seguro para hilos, indexado por API key.
+    Reutiliza las conexiones HTTP entre reruns y sesiones, expulsa los
+    clientes menos usados y cachea la verificación de conectividad con TTL.
+    """
+
+    def __init__(
+        self,
+        max_clients=32,
+        max_connections=20,
+        max_keepalive_connections=10,
+        keepalive_expiry=30.0,
+        verification_ttl=600,
+    ):
+        self.max_clients = max_clients
+        self.verification_ttl = verification_ttl
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._clients = OrderedDict()
+        self._verified_at = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key_for(api_key):
+        # Nunca se guarda la API key en claro como índice del pool
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+    def _build_client(self, api_key):
+        import openai
+
+        # DefaultHttpxClient conserva los timeouts por defecto del SDK (openai>=1.17)
+        http_client_class = getattr(openai, "DefaultHttpxClient", httpx.Client)
+        http_client = http_client_class(limits=self._limits)
+        return OpenAI(
+            api_key=api_key,
+            default_headers={"OpenAI-Beta": "assistants=v2"},
+            http_client=http_client,
+        )
+
+    def get(self, api_key):
+        """Devuelve el cliente asociado a la API key, creándolo si no existe"""
+        key = self._key_for(api_key)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                return client
+
+            client = self._build_client(api_key)
+            self._clients[key] = client
+
+            # Expulsar los clientes menos usados recientemente. No se cierran
+            # explícitamente porque otra sesión podría tener una petición en curso.
+            while len(self._clients) > self.max_clients:
+                evicted_key, _ = self._clients.popitem(last=False)
+                self._verified_at.pop(evicted_key, None)
+                logging.info("Cliente OpenAI expulsado del pool (LRU)")
+
+            return client
+
+    def is_verified(self, api_key):
+        """Indica si la conectividad de la API key se verificó dentro del TTL"""
+        with self._lock:
+            verified_at = self._verified_at.get(self._key_for(api_key))
+        return (
+            verified_at is not None
+            and time.time() - verified_at < self.verification_ttl
+        )
+
+    def mark_verified(self, api_key):
+        with self._lock:
+            key = self._key_for(api_key)
+            if key in self._clients:
+                self._verified_at[key] = time.time()
+
+    def invalidate(self, api_key):
+        """Olvida la verificación de la API key para forzar una nueva comprobación"""
+        with self._lock:
+            self._verified_at.pop(self._key_for(api_key), None)
+
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client_pool():
+    """Devuelve el pool de clientes OpenAI compartido entre reruns y sesiones"""
+    return OpenAIClientPool(**OPENAI_CLIENT_POOL_CONFIG)
+
+
 # Crear cliente OpenAI para Assistants
 @handle_error(max_retries=1)
 def create_openai_client(api_key):
     """
-    Crea un cliente OpenAI con encabezados compatibles con Assistants API v2
-    y verificación de conectividad
+    Obtiene del pool compartido un cliente OpenAI con encabezados compatibles
+    con Assistants API v2, verificando la conectividad una vez por API key
     """
+    pool = None
     try:
-        client = OpenAI(
-            api_key=api_key, default_headers={"OpenAI-Beta": "assistants=v2"}
-        )
+        pool = get_openai_client_pool()
+        client = pool.get(api_key)
 
-        # Verificar conectividad con una llamada simple
-        models = client.models.list()
-        if not models:
-            raise Exception("No se pudo obtener la lista de modelos")
+        # Verificar conectividad solo si no hay una verificación vigente
+        if not pool.is_verified(api_key):
+            models = client.models.list()
+            if not models:
+                raise Exception("No se pudo obtener la lista de modelos")
+            pool.mark_verified(api_key)
+            logging.info("Cliente OpenAI inicializado correctamente")
 
-        logging.info("Cliente OpenAI inicializado correctamente")
         return client
     except Exception as e:
+        if pool is not None:
+            pool.invalidate(api_key)
         logging.error(f"Error inicializando cliente OpenAI: {str(e)}")
         st.error(f"No se pudo conectar a OpenAI: {str(e)}")
         return None
 
 
+# ----- NORMALIZACIÓN DE TEXTO PARA EXPORTACIÓN -----
+
+# Expresiones de simplificación de Markdown, compiladas una sola vez
+_EXPORT_HEADING_PATTERN = re.compile(r"^#{1,6}\s+(.*?)$", re.MULTILINE)
+_EXPORT_IMAGE_PATTERN = re.compile(r"!\[.*?\]\(.*?\)")
+_EXPORT_LINK_PATTERN = re.compile(r"\[(.*?)\]\(.*?\)")
+_EXPORT_UNSAFE_CHARACTERS = re.compile(r"[^\w .,;:\-?!()]")
+
+# Signos tipográficos frecuentes fuera de Latin-1 y su equivalente más cercano
+_TYPOGRAPHIC_REPLACEMENTS = {
+    "•": "-", "◦": "-", "▪": "-", "–": "-", "—": "-", "‑": "-",
+    "‘": "'", "’": "'", "‚": ",", "“": '"', "”": '"', "„": '"',
+    "…": "...", "€": "EUR", "™": "(TM)", "→": "->", "←": "<-",
+    "⇒": "=>", "≤": "<=", "≥": ">=", "≠": "!=", "✓": "v", "✔": "v",
+    "✗": "x", "❌": "x", "✅": "v", " ": " ", "​": "", "﻿": "",
+}
+
+
+def _build_ascii_transliteration():
+    """Tabla que reduce los caracteres Latin-1 acentuados a su letra base"""
+    import unicodedata
+
+    table = {}
+    for code in range(0xC0, 0x100):
+        char = chr(code)
+        base = unicodedata.normalize("NFKD", char).encode("ascii", "ignore").decode()
+        if base:
+            table[code] = base
+    table.update({ord("ß"): "ss", ord("æ"): "ae", ord("Æ"): "AE", ord("ø"): "o",
+                  ord("Ø"): "O", ord("¿"): "?", ord("¡"): "!", ord("º"): "o",
+                  ord("ª"): "a", ord("«"): '"', ord("»"): '"', ord("·"): "-"})
+    return table
+
+
+# Tablas de transliteración (formato str.maketrans): Latin-1 conserva tildes
+# y eñes (fuentes estándar de PDF), ASCII las reduce a su letra base. Solo
+# se consultan para los caracteres que el destino no puede representar
+LATIN1_TRANSLATION = str.maketrans(_TYPOGRAPHIC_REPLACEMENTS)
+ASCII_TRANSLATION = str.maketrans(
+    {**_TYPOGRAPHIC_REPLACEMENTS, **{chr(k): v for k, v in _build_ascii_transliteration().items()}}
+)
+PDF_STRING_ESCAPE_TRANSLATION = str.maketrans({"\\": "\\\\", "(": "\\(", ")": "\\)"})
+_NON_LATIN1_CHARACTER = re.compile(r"[^\x00-\xff]")
+_NON_ASCII_CHARACTER = re.compile(r"[^\x00-\x7f]")
+# Caracteres que WinAnsi (cp1252) añade a Latin-1 (€, •, comillas tipográficas...)
+_CP1252_EXTRA_CHARACTERS = frozenset(bytes(range(0x80, 0xA0)).decode("cp1252", "ignore"))
+
+
+def to_latin1(text):
+    """Adapta un texto a Latin-1 conservando tildes; lo irrepresentable pasa a '?'"""
+    if text.isascii():
+        return text
+    return _NON_LATIN1_CHARACTER.sub(
+        lambda match: LATIN1_TRANSLATION.get(ord(match.group()), "?"), text
+    )
+
+
+def to_ascii(text):
+    """Translitera un texto a ASCII (á -> a, ñ -> n); lo irrepresentable pasa a '?'"""
+    if text.isascii():
+        return text
+    return _NON_ASCII_CHARACTER.sub(
+        lambda match: ASCII_TRANSLATION.get(ord(match.group()), "?"), text
+    )
+
+
+def escape_xml(text):
+    """Escapa &, < y > para los párrafos con marcado de ReportLab"""
+    # Tres reemplazos en C superan a str.translate con tabla de cadenas
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
+def strip_unsafe_characters(text):
+    """Deja solo letras, dígitos y puntuación básica (último recurso de exportación)"""
+    return _EXPORT_UNSAFE_CHARACTERS.sub("", text)
+
+
+# Bloques y fragmentos de código Markdown (también los aún sin cerrar durante el streaming)
+_MARKDOWN_CODE_SPANS = re.compile(r"(```.*?(?:```|\Z)|~~~.*?(?:~~~|\Z)|`[^`\n]*`)", re.DOTALL)
+
+
+def escape_markdown_dollars(text):
+    """
+    Escapa los signos $ fuera del código para st.markdown, que interpreta
+    $...$ como fórmulas LaTeX y deformaría expresiones Mako como ${ ... }.
+    Solo afecta a la presentación: el historial guarda el texto original
+    """
+    if "$" not in text:
+        return text
+    parts = _MARKDOWN_CODE_SPANS.split(text)
+    # Las posiciones impares son bloques o fragmentos de código
+    return "".join(
+        part if i % 2 else part.replace("\\$", "$").replace("$", "\\$")
+        for i, part in enumerate(parts)
+    )
+
+
+def simplify_markdown_for_export(text):
+    """Simplifica Markdown para formatos sin soporte de estilos (PDF)"""
+    # Simplificar encabezados
+    text = _EXPORT_HEADING_PATTERN.sub(r"\1", text)
+
+    # Eliminar elementos multimedia
+    text = _EXPORT_IMAGE_PATTERN.sub("[IMAGEN]", text)
+
+    # Simplificar enlaces
+    return _EXPORT_LINK_PATTERN.sub(r"\1", text)
+
+
+# Exportación incremental a PDF: disposición de página y uso de memoria
+PDF_EXPORT_CONFIG = {
+    "page_width": 595.28,  # A4 en puntos
+    "page_height": 841.89,
+    "margin": 50,
+    "body_top": 770,  # Debajo del encabezado de página
+    "font_size": 10,
+    "code_font_size": 9,
+    "role_font_size": 11,
+    "leading": 1.3,  # Interlineado relativo al tamaño de fuente
+    "spool_memory_bytes": 1024 * 1024,  # Páginas en memoria antes de pasar a disco
+    "write_chunk_size": 64 * 1024,
+}
+
+# Fuentes estándar de PDF (sin incrustar) usadas por el exportador incremental
+PDF_STANDARD_FONTS = {
+    "F1": "Helvetica",
+    "F2": "Helvetica-Bold",
+    "F3": "Helvetica-Oblique",
+    "F4": "Courier",
+}
+
+
+def _pdf_escape(text):
+    """Codifica texto como cadena literal de PDF en WinAnsi"""
+    if "\\" in text or "(" in text or ")" in text:
+        text = text.translate(PDF_STRING_ESCAPE_TRANSLATION)
+    if text.isascii():
+        return text
+    # WinAnsi (cp1252) incluye los signos tipográficos habituales; el resto se adapta
+    try:
+        return text.encode("cp1252").decode("latin-1")
+    except UnicodeEncodeError:
+        text = _NON_LATIN1_CHARACTER.sub(
+            lambda match: match.group()
+            if match.group() in _CP1252_EXTRA_CHARACTERS
+            else LATIN1_TRANSLATION.get(ord(match.group()), "?"),
+            text,
+        )
+        return text.encode("cp1252", "replace").decode("latin-1")
+
+
+class IncrementalPDFExporter:
+    """
+    Exportador de conversaciones a PDF que dispone cada mensaje una sola vez.
+    Como la conversación solo crece por el final, las páginas completas se
+    comprimen y se guardan en un archivo temporal; en cada exportación solo se
+    disponen los mensajes nuevos y el PDF se escribe por bloques a partir de
+    las páginas guardadas, con memoria acotada a la página en curso
+    """
+
+    def __init__(self, config=None):
+        self.config = dict(PDF_EXPORT_CONFIG, **(config or {}))
+        self.lock = threading.Lock()
+        self._width_cache = {}
+        try:
+            from reportlab.pdfbase.pdfmetrics import stringWidth
+
+            self._string_width = stringWidth
+        except ImportError:
+            self._string_width = None
+        self.reset()
+
+    def reset(self):
+        """Descarta todas las páginas dispuestas"""
+        self._store = tempfile.SpooledTemporaryFile(
+            max_size=self.config["spool_memory_bytes"]
+        )
+        self._pages = []  # (offset, longitud) del contenido comprimido en _store
+        self._ops = []  # Operaciones de la página en curso
+        self._y = self.config["body_top"]
+        self.message_keys = []
+
+    @staticmethod
+    def message_key(message):
+        """Identifica un mensaje por su ID o, si no tiene, por su contenido"""
+        if message.get("id"):
+            return message["id"]
+        return hashlib.sha256(
+            f"{message['role']}\0{message['content']}".encode("utf-8")
+        ).hexdigest()
+
+    @property
+    def page_count(self):
+        return len(self._pages) + 1
+
+    def _text_width(self, text, font, size):
+        key = (text, font)
+        width = self._width_cache.get(key)
+        if width is None:
+            if self._string_width is not None:
+                width = self._string_width(text, PDF_STANDARD_FONTS[font], 1000)
+            else:
+                # Aproximación sin métricas: Courier 600, proporcional ~520
+                width = len(text) * (600 if font == "F4" else 520)
+            if len(self._width_cache) < 50000:
+                self._width_cache[key] = width
+        return width * size / 1000
+
+    def _wrap(self, line, font, size, max_width):
+        """Divide una línea en renglones que caben en el ancho disponible"""
+        if self._text_width(line, font, size) <= max_width:
+            return [line]
+        space = self._text_width(" ", font, size)
+        rows, current, current_width = [], [], 0.0
+        for word in line.split(" "):
+            word_width = self._text_width(word, font, size)
+            # Palabras más anchas que la línea se cortan por caracteres
+            while word_width > max_width and len(word) > 1:
+                cut = max(1, int(len(word) * max_width / word_width))
+                if current:
+                    rows.append(" ".join(current))
+                    current, current_width = [], 0.0
+                rows.append(word[:cut])
+                word = word[cut:]
+                word_width = self._text_width(word, font, size)
+            extra = word_width + (space if current else 0)
+            if current and current_width + extra > max_width:
+                rows.append(" ".join(current))
+                current, current_width = [word], word_width
+            else:
+                current.append(word)
+                current_width += extra
+        if current:
+            rows.append(" ".join(current))
+        return rows
+
+    def _seal_page(self):
+        """Comprime la página en curso, la guarda y empieza una nueva"""
+        data = zlib.compress("\n".join(self._ops).encode("latin-1"))
+        self._store.seek(0, os.SEEK_END)
+        self._pages.append((self._store.tell(), len(data)))
+        self._store.write(data)
+        self._ops = []
+        self._y = self.config["body_top"]
+
+    def _add_row(self, text, font, size, indent=0):
+        leading = size * self.config["leading"]
+        if self._y - leading < self.config["margin"]:
+            self._seal_page()
+        self._y -= leading
+        if text:
+            self._ops.append(
+                f"BT /{font} {size} Tf {self.config['margin'] + indent:.2f} {self._y:.2f} Td ({_pdf_escape(text)}) Tj ET"
+            )
+
+    def _add_message(self, message):
+        config = self.config
+        body_width = config["page_width"] - 2 * config["margin"]
+        role = "Usuario" if message["role"] == "user" else APP_IDENTITY["name"]
+
+        self._add_row("", "F1", config["font_size"] / 2)
+        self._add_row(role, "F2", config["role_font_size"])
+
+        in_code = False
+        for line in simplify_markdown_for_export(message["content"]).split("\n"):
+            if line.lstrip().startswith(("```", "~~~")):
+                in_code = not in_code
+                continue
+            if in_code:
+                font, size, indent = "F4", config["code_font_size"], 10
+                line = line.expandtabs(4)
+            elif line.startswith(("- ", "* ")):
+                font, size, indent = "F1", config["font_size"], 10
+                line = "• " + line[2:]
+            else:
+                font, size, indent = "F1", config["font_size"], 0
+            for row in self._wrap(line.rstrip(), font, size, body_width - indent):
+                self._add_row(row, font, size, indent)
+
+    def update(self, messages, on_progress=None):
+        """
+        Dispone los mensajes que aún no están en el documento. Si la
+        conversación ya no empieza por los mensajes dispuestos (por ejemplo,
+        tras limpiar la sesión), el documento se reconstruye
+
+        Parámetros:
+            messages: Mensajes de la conversación
+            on_progress: Función opcional (hechos, total) llamada tras cada
+                mensaje; puede lanzar ExportCancelled para interrumpir
+
+        Retorno:
+            int: Número de mensajes dispuestos en esta llamada
+        """
+        keys = [self.message_key(message) for message in messages]
+        if keys[: len(self.message_keys)] != self.message_keys:
+            self.reset()
+        new_messages = messages[len(self.message_keys) :]
+        for message, key in zip(new_messages, keys[len(self.message_keys) :]):
+            self._add_message(message)
+            self.message_keys.append(key)
+            if on_progress is not None:
+                on_progress(len(self.message_keys), len(messages))
+        return len(new_messages)
+
+    def _overlay(self, page_number, export_date):
+        """Encabezado, pie y fecha de una página, generados en cada exportación"""
+        config = self.config
+        title = f"{APP_IDENTITY['name']} - Historial de Conversación"
+        title_x = (config["page_width"] - self._text_width(title, "F2", 12)) / 2
+        footer = f"Página {page_number}"
+        footer_x = (config["page_width"] - self._text_width(footer, "F3", 8)) / 2
+        ops = [
+            f"BT /F2 12 Tf {title_x:.2f} {config['page_height'] - 45:.2f} Td ({_pdf_escape(title)}) Tj ET",
+            f"BT /F3 8 Tf {footer_x:.2f} 25 Td ({_pdf_escape(footer)}) Tj ET",
+        ]
+        if page_number == 1:
+            ops.append(
+                f"BT /F3 9 Tf {config['margin']} {config['page_height'] - 62:.2f} Td ({_pdf_escape('Fecha: ' + export_date)}) Tj ET"
+            )
+        return "\n".join(ops).encode("latin-1")
+
+    def write_to(self, output, exported_at=None):
+        """
+        Escribe el documento completo en un archivo binario, copiando por
+        bloques el contenido de las páginas guardadas
+
+        Parámetros:
+            output: Archivo binario de destino
+            exported_at: Fecha de exportación del encabezado (por defecto, ahora)
+        """
+        config = self.config
+        export_date = (exported_at or datetime.now()).strftime("%Y-%m-%d %H:%M:%S")
+        pages = list(self._pages)
+        current_page = zlib.compress("\n".join(self._ops).encode("latin-1"))
+        page_count = len(pages) + 1
+        offsets = []
+        written = 0
+
+        def emit(data):
+            nonlocal written
+            output.write(data)
+            written += len(data)
+
+        def begin_object(number):
+            offsets.append(written)
+            emit(f"{number} 0 obj\n".encode("latin-1"))
+
+        font_count = len(PDF_STANDARD_FONTS)
+        first_page_object = 3 + font_count
+        emit(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+        begin_object(1)
+        emit(b"<< /Type /Catalog /Pages 2 0 R >>\nendobj\n")
+        kids = " ".join(
+            f"{first_page_object + 3 * i} 0 R" for i in range(page_count)
+        )
+        begin_object(2)
+        emit(f"<< /Type /Pages /Kids [{kids}] /Count {page_count} >>\nendobj\n".encode("latin-1"))
+        font_refs = []
+        for i, (name, base_font) in enumerate(PDF_STANDARD_FONTS.items()):
+            begin_object(3 + i)
+            emit(
+                f"<< /Type /Font /Subtype /Type1 /BaseFont /{base_font} /Encoding /WinAnsiEncoding >>\nendobj\n".encode("latin-1")
+            )
+            font_refs.append(f"/{name} {3 + i} 0 R")
+        resources = f"<< /Font << {' '.join(font_refs)} >> >>"
+
+        for index in range(page_count):
+            number = first_page_object + 3 * index
+            begin_object(number)
+            emit(
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {config['page_width']} {config['page_height']}] "
+                f"/Resources {resources} /Contents [{number + 1} 0 R {number + 2} 0 R] >>\nendobj\n".encode("latin-1")
+            )
+
+            begin_object(number + 1)
+            if index < len(pages):
+                offset, length = pages[index]
+                emit(f"<< /Length {length} /Filter /FlateDecode >>\nstream\n".encode("latin-1"))
+                self._store.seek(offset)
+                remaining = length
+                while remaining:
+                    chunk = self._store.read(min(remaining, config["write_chunk_size"]))
+                    if not chunk:
+                        raise IOError("Contenido de página incompleto en el almacén temporal")
+                    emit(chunk)
+                    remaining -= len(chunk)
+            else:
+                emit(f"<< /Length {len(current_page)} /Filter /FlateDecode >>\nstream\n".encode("latin-1"))
+                emit(current_page)
+            emit(b"\nendstream\nendobj\n")
+
+            overlay = self._overlay(index + 1, export_date)
+            begin_object(number + 2)
+            emit(f"<< /Length {len(overlay)} >>\nstream\n".encode("latin-1") + overlay + b"\nendstream\nendobj\n")
+
+        xref_offset = written
+        emit(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode("latin-1"))
+        for offset in offsets:
+            emit(f"{offset:010d} 00000 n \n".encode("latin-1"))
+        emit(
+            f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode("latin-1")
+        )
+        return written
+
+
+def get_session_pdf_exporter():
+    """Devuelve el exportador PDF incremental de la sesión actual"""
+    exporter = st.session_state.get("pdf_exporter")
+    if exporter is None:
+        exporter = IncrementalPDFExporter()
+        st.session_state.pdf_exporter = exporter
+    return exporter
+
+
+def export_chat_to_pdf_incremental(messages, exporter=None, on_progress=None, exported_at=None):
+    """
+    Exporta la conversación a PDF reutilizando los mensajes ya dispuestos
+    en exportaciones anteriores de la sesión
+
+    Parámetros:
+        messages: Mensajes de la conversación
+        exporter: Exportador a reutilizar (por defecto, el de la sesión)
+        on_progress: Función opcional (hechos, total) llamada por cada mensaje
+        exported_at: Fecha de exportación del encabezado (por defecto, ahora)
+
+    Retorno:
+        SpooledTemporaryFile: PDF generado, posicionado al inicio
+    """
+    if exporter is None:
+        exporter = get_session_pdf_exporter()
+
+    output = tempfile.SpooledTemporaryFile(
+        max_size=PDF_EXPORT_CONFIG["spool_memory_bytes"]
+    )
+    # El exportador puede compartirse con trabajos en segundo plano
+    with exporter.lock:
+        added = exporter.update(messages, on_progress=on_progress)
+        size = exporter.write_to(output, exported_at)
+        page_count = exporter.page_count
+    output.seek(0)
+    logging.info(
+        f"PDF exportado: {page_count} páginas, {size} bytes, {added} mensajes nuevos dispuestos"
+    )
+    return output
+
+
+# Motores de exportación a PDF: "auto" recorre todos en orden hasta que uno funciona
+PDF_EXPORT_ENGINES = ("auto", "incremental", "fpdf", "reportlab", "fallback")
+
+
 # Sistema multicapa para exportación de conversaciones
-def export_chat_to_pdf(messages):
+def export_chat_to_pdf(
+    messages, engine="auto", exporter=None, on_progress=None, exported_at=None
+):
     """
     Sistema multicapa para exportación de conversaciones a PDF.
     Implementa múltiples estrategias de generación con manejo de fallos.
+    No usa elementos de la interfaz, por lo que puede ejecutarse en segundo plano
+
+    Parámetros:
+        messages: Mensajes de la conversación
+        engine: Motor a usar (ver PDF_EXPORT_ENGINES); "auto" aplica todos en cascada
+        exporter: Exportador incremental a reutilizar (por defecto, el de la sesión)
+        on_progress: Función opcional (hechos, total) para informar del avance
+        exported_at: Fecha de exportación del encabezado (por defecto, ahora)
+
+    Retorno:
+        tuple: (archivo binario posicionado al inicio, formato) donde formato
+        es "pdf" o "markdown" si ningún método pudo generar el PDF
     """
+    if engine not in ("auto", "incremental"):
+        legacy_engines = {
+            "fpdf": _export_chat_to_pdf_primary,
+            "reportlab": _export_chat_to_pdf_secondary,
+            "fallback": _export_chat_to_pdf_fallback,
+        }
+        pdf_data, output_format = legacy_engines[engine](messages, exported_at)
+        return BytesIO(pdf_data), output_format
+
+    try:
+        # Método 1 (preferido): exportador incremental con memoria acotada
+        return (
+            export_chat_to_pdf_incremental(messages, exporter, on_progress, exported_at),
+            "pdf",
+        )
+    except ExportCancelled:
+        raise
+    except Exception as e:
+        if engine == "incremental":
+            raise
+        logging.warning(f"Exportación incremental a PDF falló: {str(e)}")
+        if exporter is not None:
+            exporter.reset()
     try:
-        # Método 1 (preferido): FPDF con manejo mejorado
-        return _export_chat_to_pdf_primary(messages)
+        # Método 2: FPDF con manejo mejorado
+        pdf_data, output_format = _export_chat_to_pdf_primary(messages, exported_at)
+        return BytesIO(pdf_data), output_format
     except Exception as e:
         logging.warning(f"Método primario de exportación a PDF falló: {str(e)}")
         try:
-            # Método 2: ReportLab como alternativa
-            return _export_chat_to_pdf_secondary(messages)
+            # Método 3: ReportLab como alternativa
+            pdf_data, output_format = _export_chat_to_pdf_secondary(messages, exported_at)
+            return BytesIO(pdf_data), output_format
         except Exception as e2:
             logging.warning(f"Método secundario de exportación a PDF falló: {str(e2)}")
             try:
-                # Método 3: Conversión simple como último recurso
-                return _export_chat_to_pdf_fallback(messages)
+                # Método 4: Conversión simple como último recurso
+                pdf_data, output_format = _export_chat_to_pdf_fallback(messages, exported_at)
+                return BytesIO(pdf_data), output_format
             except Exception as e3:
                 logging.error(
                     f"Todos los métodos de exportación a PDF fallaron: {str(e3)}"
                 )
-                # Último recurso: Devolver contenido en markdown codificado
-                md_content = export_chat_to_markdown(messages)
-                st.warning(
-                    "No fue posible generar un PDF. Se ha creado un archivo markdown en su lugar."
-                )
-                return base64.b64encode(md_content.encode()).decode(), "markdown"
+                # Último recurso: Devolver contenido en markdown
+                md_content = export_chat_to_markdown(messages, exported_at)
+                return BytesIO(md_content.encode("utf-8")), "markdown"
 
 
-def _export_chat_to_pdf_primary(messages):
+def _export_chat_to_pdf_primary(messages, exported_at=None):
     """
     Método primario: FPDF optimizado con manejo de errores mejorado
     y división inteligente de texto para evitar problemas de espacio
     """
     from fpdf import FPDF
-    import re
 
     class CustomPDF(FPDF):
         def header(self):
@@ -382,8 +995,9 @@ def _export_chat_to_pdf_primary(messages):
             self.cell(
                 0,
                 10,
-                f'{APP_IDENTITY["name"]} - Historial de Conversación',
+                to_latin1(f'{APP_IDENTITY["name"]} - Historial de Conversación'),
                 0,
+                new_x="LMARGIN",
                 new_y="NEXT",
                 align="C",
             )
@@ -392,12 +1006,12 @@ def _export_chat_to_pdf_primary(messages):
         def footer(self):
             self.set_y(-15)
             self.set_font("helvetica", "I", 8)
-            self.cell(0, 10, f"Página {self.page_no()}", 0, 0, "C")
+            self.cell(0, 10, to_latin1(f"Página {self.page_no()}"), 0, 0, "C")
 
         def add_message(self, role, content):
             # Añadir título del mensaje
             self.set_font("helvetica", "B", 11)
-            self.cell(0, 10, role, 0, new_y="NEXT", align="L")
+            self.cell(0, 10, to_latin1(role), 0, new_x="LMARGIN", new_y="NEXT", align="L")
             self.ln(2)
 
             # Añadir contenido con procesamiento seguro
@@ -427,7 +1041,7 @@ def _export_chat_to_pdf_primary(messages):
                     if line.startswith("- ") or line.startswith("* "):
                         # Elemento de lista
                         self.cell(5, 10, "", 0, 0)
-                        self.cell(5, 10, "•", 0, 0)
+                        self.cell(5, 10, "-", 0, 0)
                         self._safe_multi_cell(0, 10, line[2:])
                     else:
                         # Párrafo normal
@@ -437,16 +1051,7 @@ def _export_chat_to_pdf_primary(messages):
                 self.ln(2)
 
         def _process_markdown(self, text):
-            # Simplificar encabezados
-            text = re.sub(r"^#{1,6}\s+(.*?)$", r"\1", text, flags=re.MULTILINE)
-
-            # Eliminar elementos multimedia
-            text = re.sub(r"!\[.*?\]\(.*?\)", "[IMAGEN]", text)
-
-            # Simplificar enlaces
-            text = re.sub(r"\[(.*?)\]\(.*?\)", r"\1", text)
-
-            return text
+            return simplify_markdown_for_export(text)
 
         def _safe_wrap_text(self, text, max_width=180):
             """Divide texto en líneas seguras para renderizar"""
@@ -477,24 +1082,30 @@ def _export_chat_to_pdf_primary(messages):
         def _safe_multi_cell(self, w, h, txt, border=0, align="J", fill=False):
             """Versión segura de multi_cell con manejo de errores integrado"""
             try:
-                # Eliminar caracteres no ASCII si es necesario
-                if not all(ord(c) < 128 for c in txt):
-                    txt = "".join(c if ord(c) < 128 else "?" for c in txt)
+                # Las fuentes estándar solo admiten Latin-1 (se conservan las tildes)
+                txt = to_latin1(txt)
 
                 # Limitar longitud de línea si es necesario
                 if len(txt) > 200:
                     chunks = [txt[i : i + 200] for i in range(0, len(txt), 200)]
                     for chunk in chunks:
-                        self.multi_cell(w, h, chunk, border, align, fill)
+                        self.multi_cell(
+                            w, h, chunk, border, align, fill,
+                            new_x="LMARGIN", new_y="NEXT",
+                        )
                 else:
-                    self.multi_cell(w, h, txt, border, align, fill)
+                    self.multi_cell(
+                        w, h, txt, border, align, fill, new_x="LMARGIN", new_y="NEXT"
+                    )
             except Exception as e:
                 logging.warning(
                     f"Error en multi_cell: {str(e)}. Intentando versión simplificada."
                 )
                 # Versión de respaldo extremadamente simplificada
-                safe_txt = "".join(c for c in txt if c.isalnum() or c in " .,;:-?!()")
-                self.multi_cell(w, h, safe_txt[:100] + "...", border, align, fill)
+                self.multi_cell(
+                    w, h, strip_unsafe_characters(to_ascii(txt))[:100] + "...",
+                    border, align, fill, new_x="LMARGIN", new_y="NEXT",
+                )
 
     # Crear el PDF
     pdf = CustomPDF()
@@ -504,7 +1115,12 @@ def _export_chat_to_pdf_primary(messages):
     # Añadir fecha
     pdf.set_font("helvetica", "I", 10)
     pdf.cell(
-        0, 10, f"Fecha: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", 0, new_y="NEXT"
+        0,
+        10,
+        f"Fecha: {(exported_at or datetime.now()).strftime('%Y-%m-%d %H:%M:%S')}",
+        0,
+        new_x="LMARGIN",
+        new_y="NEXT",
     )
     pdf.ln(5)
 
@@ -519,7 +1135,7 @@ def _export_chat_to_pdf_primary(messages):
     return output.getvalue(), "pdf"
 
 
-def _export_chat_to_pdf_secondary(messages):
+def _export_chat_to_pdf_secondary(messages, exported_at=None):
     """
     Método secundario: ReportLab para generación alternativa de PDF
     con manejo mejorado de texto extenso
@@ -545,7 +1161,7 @@ def _export_chat_to_pdf_secondary(messages):
     styles = getSampleStyleSheet()
     styles.add(
         ParagraphStyle(
-            name="Title",
+            name="ChatTitle",
             fontName="Helvetica-Bold",
             fontSize=14,
             alignment=1,
@@ -577,13 +1193,14 @@ def _export_chat_to_pdf_secondary(messages):
     # Título y fecha
     elements.append(
         Paragraph(
-            f"{APP_IDENTITY['name']} - Historial de Conversación", styles["Title"]
+            f"{APP_IDENTITY['name']} - Historial de Conversación", styles["ChatTitle"]
         )
     )
     elements.append(Spacer(1, 0.25 * inch))
     elements.append(
         Paragraph(
-            f"Fecha: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", styles["Italic"]
+            f"Fecha: {(exported_at or datetime.now()).strftime('%Y-%m-%d %H:%M:%S')}",
+            styles["Italic"],
         )
     )
     elements.append(Spacer(1, 0.25 * inch))
@@ -591,7 +1208,7 @@ def _export_chat_to_pdf_secondary(messages):
     # Función de seguridad para procesar texto
     def safe_process_text(text, max_chunk=2000):
         # Escapar caracteres especiales HTML
-        text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        text = escape_xml(text)
 
         # Convertir newlines a <br/>
         text = text.replace("\n", "<br/>")
@@ -642,7 +1259,7 @@ def _export_chat_to_pdf_secondary(messages):
         raise e
 
 
-def _export_chat_to_pdf_fallback(messages):
+def _export_chat_to_pdf_fallback(messages, exported_at=None):
     """
     Método de último recurso: PDF simple sin formato avanzado
     diseñado para máxima compatibilidad y robustez
@@ -659,7 +1276,7 @@ def _export_chat_to_pdf_fallback(messages):
     pdf.cell(
         200,
         10,
-        f"{APP_IDENTITY['name']} - Historial de Conversación",
+        to_latin1(f"{APP_IDENTITY['name']} - Historial de Conversación"),
         ln=True,
         align="C",
     )
@@ -667,7 +1284,8 @@ def _export_chat_to_pdf_fallback(messages):
 
     # Fecha
     pdf.set_font("helvetica", style="I", size=10)
-    pdf.cell(200, 10, f"Fecha: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", ln=True)
+    export_date = (exported_at or datetime.now()).strftime("%Y-%m-%d %H:%M:%S")
+    pdf.cell(200, 10, f"Fecha: {export_date}", ln=True)
     pdf.ln(10)
 
     # Mensajes - formato mínimo con máxima seguridad
@@ -684,7 +1302,7 @@ def _export_chat_to_pdf_fallback(messages):
         pdf.set_font("helvetica", size=10)
 
         # Extraer texto plano con máxima seguridad
-        simple_text = "".join(c if ord(c) < 128 else "?" for c in msg["content"])
+        simple_text = to_latin1(msg["content"])
         simple_text = simple_text.replace("\n", " ").replace("\r", "")
 
         # Dividir texto en líneas muy cortas para evitar errores
@@ -695,7 +1313,7 @@ def _export_chat_to_pdf_fallback(messages):
                 pdf.cell(0, 10, chunk, ln=True)
             except:
                 # Si falla incluso con texto simplificado, usar solo alfanuméricos
-                ultra_safe = "".join(c for c in chunk if c.isalnum() or c == " ")
+                ultra_safe = strip_unsafe_characters(to_ascii(chunk))
                 try:
                     pdf.cell(0, 10, ultra_safe, ln=True)
                 except:
@@ -714,20 +1332,407 @@ def _export_chat_to_pdf_fallback(messages):
         raise e
 
 
-def export_chat_to_markdown(messages):
+def export_chat_to_markdown(messages, exported_at=None):
     """
     Exporta el historial de chat a formato markdown
     con mejoras de formato y legibilidad
     """
-    md_content = f"# {APP_IDENTITY['name']} - Historial de Conversación\n\n"
-    md_content += f"Fecha: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+    return "".join(iter_chat_markdown(messages, exported_at))
+
+
+def new_chat_message(role, content, **extra):
+    """Crea un mensaje del historial con identificador y marca de tiempo"""
+    message = {"role": role, "content": content}
+    message.update(extra)
+    if not message.get("id"):
+        message["id"] = f"local_{uuid.uuid4().hex}"
+    message.setdefault("timestamp", datetime.now().isoformat(timespec="seconds"))
+    return message
+
+
+def _export_message_record(position, message):
+    """Registro exportable de un mensaje (los mensajes antiguos pueden no tener ID)"""
+    return {
+        "id": message.get("id") or f"message_{position}",
+        "role": message["role"],
+        "timestamp": message.get("timestamp"),
+        "content": message["content"],
+        "cached": bool(message.get("cached", False)),
+    }
+
+
+def iter_chat_markdown(messages, exported_at=None):
+    """Genera la conversación en Markdown mensaje a mensaje"""
+    export_date = (exported_at or datetime.now()).strftime("%Y-%m-%d %H:%M:%S")
+    yield f"# {APP_IDENTITY['name']} - Historial de Conversación\n\n"
+    yield f"Fecha: {export_date}\n\n"
 
     for msg in messages:
         role = "Usuario" if msg["role"] == "user" else APP_IDENTITY["name"]
-        md_content += f"## {role}\n\n{msg['content']}\n\n"
-        md_content += "---\n\n"  # Separador para mejorar legibilidad
+        timestamp = f" ({msg['timestamp']})" if msg.get("timestamp") else ""
+        yield f"## {role}{timestamp}\n\n{msg['content']}\n\n"
+        yield "---\n\n"  # Separador para mejorar legibilidad
+
+
+def iter_chat_json(messages, exported_at=None):
+    """Genera la conversación como un único documento JSON, mensaje a mensaje"""
+    header = {
+        "application": APP_IDENTITY["name"],
+        "exported_at": (exported_at or datetime.now()).isoformat(timespec="seconds"),
+        "message_count": len(messages),
+    }
+    # Abrir el objeto de cabecera para añadir la lista de mensajes al final
+    yield json.dumps(header, ensure_ascii=False)[:-1] + ', "messages": ['
+    for position, message in enumerate(messages):
+        prefix = ",\n" if position else "\n"
+        yield prefix + json.dumps(_export_message_record(position, message), ensure_ascii=False)
+    yield "\n]}\n"
+
+
+def iter_chat_jsonl(messages, exported_at=None):
+    """Genera la conversación en JSON Lines: un mensaje por línea (sin cabecera ni fecha)"""
+    for position, message in enumerate(messages):
+        yield json.dumps(_export_message_record(position, message), ensure_ascii=False) + "\n"
+
+
+# Formatos de exportación de texto: generador, extensión y tipo MIME
+CHAT_EXPORT_FORMATS = {
+    "Markdown": {"generator": iter_chat_markdown, "extension": "md", "mime": "text/markdown"},
+    "JSON": {"generator": iter_chat_json, "extension": "json", "mime": "application/json"},
+    "JSONL": {"generator": iter_chat_jsonl, "extension": "jsonl", "mime": "application/x-ndjson"},
+}
+
+# Memoria máxima de una exportación antes de pasar a disco
+CHAT_EXPORT_SPOOL_BYTES = 1024 * 1024
+
+
+def write_chat_export(messages, export_format, output, on_progress=None, exported_at=None):
+    """
+    Escribe la conversación en el formato indicado en un archivo binario,
+    consumiendo el generador del formato por partes para que la memoria
+    no dependa de la longitud del historial
+
+    Parámetros:
+        messages: Mensajes de la conversación
+        export_format: Clave de CHAT_EXPORT_FORMATS
+        output: Archivo binario de destino
+        on_progress: Función opcional (hechos, total), estimada por tamaño del contenido
+        exported_at: Fecha de exportación de la cabecera (por defecto, ahora)
+    """
+    generator = CHAT_EXPORT_FORMATS[export_format]["generator"]
+    expected = sum(len(message["content"]) + 200 for message in messages) or 1
+    written = 0
+    for part in generator(messages, exported_at):
+        output.write(part.encode("utf-8"))
+        if on_progress is not None:
+            written += len(part)
+            on_progress(min(written, expected), expected)
+
+
+def export_chat_stream(messages, export_format):
+    """
+    Exporta la conversación en el formato indicado a un archivo temporal
+
+    Retorno:
+        SpooledTemporaryFile: Archivo exportado, posicionado al inicio
+    """
+    output = tempfile.SpooledTemporaryFile(max_size=CHAT_EXPORT_SPOOL_BYTES)
+    write_chat_export(messages, export_format, output)
+    output.seek(0)
+    return output
+
+
+# Trabajos de exportación en segundo plano y caché de resultados
+EXPORT_JOBS_CONFIG = {
+    "max_workers": 2,  # Exportaciones simultáneas en el proceso
+    "max_artifacts": 32,  # Resultados conservados (expulsión LRU)
+    "max_jobs": 64,  # Trabajos terminados conservados para consulta
+    "directory": os.path.join(
+        tempfile.gettempdir(), f"{APP_IDENTITY['document_prefix']}_exports"
+    ),
+    "refresh_interval": 1.0,  # Segundos entre actualizaciones del progreso
+    "copy_chunk_size": 64 * 1024,
+    # Resolución de la fecha del encabezado: una reexportación dentro del
+    # mismo minuto reutiliza el archivo; pasado ese plazo se genera de nuevo
+    "date_resolution_seconds": 60,
+}
+
+
+class ExportCancelled(Exception):
+    """Se lanza desde el avance de una exportación cuando el usuario la cancela"""
+
+
+class ExportJob:
+    """Estado de una exportación: progreso, resultado y solicitud de cancelación"""
+
+    def __init__(self, job_id, digest, export_format, engine, exported_at=None):
+        self.id = job_id
+        self.digest = digest
+        self.export_format = export_format
+        self.engine = engine
+        self.exported_at = exported_at
+        self.status = "queued"  # queued, running, done, failed, cancelled
+        self.progress = 0.0
+        self.path = None
+        self.output_format = None
+        self.error = None
+        self.from_cache = False
+        self.created_at = time.time()
+        self.finished_at = None
+        self.future = None
+        self._cancel_event = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    def report(self, done, total):
+        """Actualiza el progreso; interrumpe la exportación si se canceló"""
+        if self._cancel_event.is_set():
+            raise ExportCancelled()
+        self.progress = min(1.0, done / total) if total else 1.0
+
+    def cancel(self):
+        """Solicita la cancelación; si aún no empezó, no llega a ejecutarse"""
+        self._cancel_event.set()
+        if self.future is not None and self.future.cancel():
+            self.status = "cancelled"
+            self.finished_at = time.time()
+
+
+class ExportJobManager:
+    """
+    Ejecuta exportaciones en un pool de hilos fuera del script de Streamlit
+    y conserva los archivos generados indexados por el digest de
+    (mensajes, formato, motor, fecha de exportación), de modo que volver a
+    exportar una conversación sin cambios es inmediato sin servir un
+    encabezado con una fecha antigua
+    """
+
+    def __init__(self, config):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.config = config
+        self._executor = ThreadPoolExecutor(
+            max_workers=config["max_workers"], thread_name_prefix="export"
+        )
+        self._jobs = OrderedDict()
+        self._artifacts = OrderedDict()  # digest -> (ruta, formato_resultado)
+        self._lock = threading.Lock()
+        os.makedirs(config["directory"], exist_ok=True)
+
+    def export_date(self, now=None):
+        """
+        Fecha de exportación redondeada a la resolución configurada: es la que
+        se imprime en el encabezado y forma parte del digest del archivo
+        """
+        resolution = self.config["date_resolution_seconds"]
+        timestamp = (now or datetime.now()).timestamp()
+        return datetime.fromtimestamp(timestamp - timestamp % resolution)
+
+    @staticmethod
+    def make_digest(messages, export_format, engine, exported_at=None):
+        """Digest del contenido exportable de la conversación, las opciones y la fecha"""
+        stamp = exported_at.isoformat(timespec="seconds") if exported_at else ""
+        digest = hashlib.sha256(f"{export_format}\0{engine}\0{stamp}\0".encode("utf-8"))
+        for message in messages:
+            digest.update(
+                f"{message.get('id')}\0{message['role']}\0{message['content']}\0".encode("utf-8")
+            )
+        return digest.hexdigest()
+
+    def submit(self, messages, export_format, engine="auto", pdf_exporter=None):
+        """
+        Encola una exportación, o la resuelve al instante si el resultado ya
+        está en caché para la misma fecha de exportación
+
+        Parámetros:
+            messages: Mensajes de la conversación (se copia la lista)
+            export_format: Clave de CHAT_EXPORT_FORMATS o "PDF"
+            engine: Motor PDF (ver PDF_EXPORT_ENGINES); se ignora en otros formatos
+            pdf_exporter: Exportador incremental de la sesión a reutilizar
+
+        Retorno:
+            ExportJob: Trabajo creado
+        """
+        if export_format in CHAT_EXPORT_FORMATS:
+            engine = "stream"
+        exported_at = self.export_date()
+        digest = self.make_digest(messages, export_format, engine, exported_at)
+        job = ExportJob(uuid.uuid4().hex, digest, export_format, engine, exported_at)
+
+        with self._lock:
+            artifact = self._artifacts.get(digest)
+            if artifact is not None and os.path.exists(artifact[0]):
+                self._artifacts.move_to_end(digest)
+                job.path, job.output_format = artifact
+                job.status, job.progress, job.from_cache = "done", 1.0, True
+                job.finished_at = time.time()
+            self._jobs[job.id] = job
+            self._prune_jobs()
+
+        if not job.finished:
+            job.future = self._executor.submit(
+                self._run, job, list(messages), pdf_exporter
+            )
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, messages, pdf_exporter):
+        if job._cancel_event.is_set():
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            return
+
+        job.status = "running"
+        path = os.path.join(self.config["directory"], f"{job.digest}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(path, "wb") as output:
+                if job.export_format in CHAT_EXPORT_FORMATS:
+                    output_format = job.export_format
+                    write_chat_export(
+                        messages, job.export_format, output, job.report, job.exported_at
+                    )
+                else:
+                    result, output_format = export_chat_to_pdf(
+                        messages,
+                        engine=job.engine,
+                        exporter=pdf_exporter or IncrementalPDFExporter(),
+                        on_progress=job.report,
+                        exported_at=job.exported_at,
+                    )
+                    with result:
+                        while True:
+                            chunk = result.read(self.config["copy_chunk_size"])
+                            if not chunk:
+                                break
+                            output.write(chunk)
+            job.report(1, 1)
+        except ExportCancelled:
+            job.status = "cancelled"
+            self._remove_file(path)
+            return
+        except Exception as e:
+            logging.error(f"Error en la exportación en segundo plano: {str(e)}")
+            job.status, job.error = "failed", str(e)
+            self._remove_file(path)
+            return
+        finally:
+            job.finished_at = time.time()
+
+        final_path = os.path.join(self.config["directory"], f"{job.digest}.export")
+        os.replace(path, final_path)
+        job.path, job.output_format = final_path, output_format
+        job.status = "done"
+        self._store_artifact(job.digest, final_path, output_format)
+        logging.info(
+            f"Exportación {job.export_format} ({job.engine}) completada en {job.finished_at - job.created_at:.2f}s"
+        )
+
+    def _store_artifact(self, digest, path, output_format):
+        with self._lock:
+            self._artifacts[digest] = (path, output_format)
+            self._artifacts.move_to_end(digest)
+            while len(self._artifacts) > self.config["max_artifacts"]:
+                _, (old_path, _) = self._artifacts.popitem(last=False)
+                self._remove_file(old_path)
+
+    def _prune_jobs(self):
+        """Descarta los trabajos terminados más antiguos por encima del límite"""
+        excess = len(self._jobs) - self.config["max_jobs"]
+        for job_id in [jid for jid, job in self._jobs.items() if job.finished][: max(0, excess)]:
+            del self._jobs[job_id]
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
-    return md_content
+
+@st.cache_resource(show_spinner=False)
+def get_export_job_manager():
+    """Devuelve el gestor de exportaciones compartido por todas las sesiones"""
+    return ExportJobManager(EXPORT_JOBS_CONFIG)
+
+
+def _current_export_job():
+    """Devuelve el trabajo de exportación de la sesión actual, si existe"""
+    job_id = st.session_state.get("export_job_id")
+    return get_export_job_manager().get(job_id) if job_id else None
+
+
+def render_export_job_status():
+    """Muestra el progreso o el resultado del trabajo de exportación de la sesión"""
+    job = _current_export_job()
+    if job is None:
+        return
+
+    if not job.finished:
+        st.progress(job.progress, text=f"Generando {job.export_format}... {job.progress:.0%}")
+        col_cancel, col_refresh = st.columns(2)
+        if col_cancel.button("Cancelar", key="cancel_export_job"):
+            job.cancel()
+        col_refresh.button("🔄 Actualizar", key="refresh_export_job")
+        return
+
+    if job.status == "done":
+        if job.export_format == "PDF" and job.output_format == "markdown":
+            st.warning(
+                "No fue posible generar un PDF. Se ha creado un archivo markdown en su lugar."
+            )
+        if job.output_format in CHAT_EXPORT_FORMATS:
+            format_info = CHAT_EXPORT_FORMATS[job.output_format]
+        elif job.output_format == "markdown":
+            format_info = CHAT_EXPORT_FORMATS["Markdown"]
+        else:
+            format_info = {"extension": "pdf", "mime": "application/pdf"}
+        if job.from_cache:
+            st.caption("⚡ Conversación sin cambios: exportación reutilizada")
+        try:
+            with open(job.path, "rb") as export_file:
+                downloaded = st.download_button(
+                    f"Descargar archivo {format_info['extension'].upper()}",
+                    data=export_file,
+                    file_name=f"{APP_IDENTITY['conversation_export_name']}.{format_info['extension']}",
+                    mime=format_info["mime"],
+                    key=f"download_export_{job.id}",
+                )
+        except OSError:
+            st.warning("El archivo exportado ya no está disponible. Genérelo de nuevo.")
+            downloaded = True
+        # El archivo deja de enviarse al navegador una vez descargado
+        if downloaded:
+            del st.session_state["export_job_id"]
+    elif job.status == "failed":
+        st.error(f"La exportación falló: {job.error}")
+    elif job.status == "cancelled":
+        st.info("Exportación cancelada.")
+
+
+def _poll_export_job():
+    # Al terminar, un rerun completo deja de refrescar y muestra el resultado
+    job = _current_export_job()
+    if job is None or job.finished:
+        rerun_app()
+        return
+    render_export_job_status()
+
+
+# Refresco periódico del progreso limitado a su fragmento (sin soporte de
+# fragmentos se actualiza con el botón "Actualizar")
+_fragment_decorator = getattr(st, "fragment", None) or getattr(
+    st, "experimental_fragment", None
+)
+poll_export_job = (
+    _fragment_decorator(run_every=EXPORT_JOBS_CONFIG["refresh_interval"])(_poll_export_job)
+    if _fragment_decorator is not None
+    else _poll_export_job
+)
 
 
 # Definición de formatos permitidos y sus extensiones
@@ -742,6 +1747,186 @@ ALLOWED_FILE_FORMATS = {
 ALLOWED_EXTENSIONS = [ext for exts in ALLOWED_FILE_FORMATS.values() for ext in exts]
 
 
+# Firmas (magic numbers) reconocidas al inicio del contenido
+FILE_SIGNATURES = [
+    (b"%PDF", "PDF"),
+    (b"\x89PNG\r\n\x1a\n", "Imagen"),
+    (b"\xff\xd8\xff", "Imagen"),
+    (b"GIF87a", "Imagen"),
+    (b"GIF89a", "Imagen"),
+    (b"II*\x00", "Imagen"),
+    (b"MM\x00*", "Imagen"),
+]
+
+
+def sniff_file_type(header):
+    """
+    Identifica el tipo de documento a partir de los primeros bytes
+
+    Parámetros:
+        header: Primeros bytes del archivo (al menos 12)
+
+    Retorno:
+        string: "PDF" o "Imagen", o None si la firma no es reconocida
+    """
+    for signature, doc_type in FILE_SIGNATURES:
+        if header.startswith(signature):
+            return doc_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "Imagen"
+    return None
+
+
+class FileProbe:
+    """
+    Lectura única de un archivo cargado: copia el contenido a un archivo
+    temporal (ver spool_upload) calculando al mismo tiempo su SHA-256 y su
+    cabecera, y conserva los resultados del análisis (cabecera de la imagen,
+    validación YAML, lector PDF y su capa de texto, texto) para que la validación, la detección
+    de tipo y el OCR no vuelvan a leer ni decodificar el archivo.
+    Expone name, type y size como el archivo cargado por Streamlit
+    """
+
+    HEADER_BYTES = 16
+
+    def __init__(self, source, name=None, mime_type=None, max_bytes=None):
+        self.name = name or getattr(source, "name", None) or ""
+        self.type = mime_type or getattr(source, "type", None) or ""
+        self._digest = hashlib.sha256()
+        self.spool = spool_upload(source, max_bytes, digest=self._digest)
+        self.size = _source_size(self.spool)
+        self.header = self.spool.read(self.HEADER_BYTES)
+        self.spool.seek(0)
+        self._artifacts = {}
+
+    @classmethod
+    @contextlib.contextmanager
+    def scope(cls, source, **kwargs):
+        """
+        Contexto que entrega un FileProbe para source: el mismo objeto si ya
+        lo es, o uno temporal que se cierra al salir, restaurando la posición
+        del archivo original
+        """
+        if isinstance(source, cls):
+            yield source
+            return
+        position = source.tell() if hasattr(source, "tell") else None
+        try:
+            with cls(source, **kwargs) as probe:
+                yield probe
+        finally:
+            if position is not None:
+                source.seek(position)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        self.spool.close()
+
+    @property
+    def extension(self):
+        return os.path.splitext(self.name.lower())[1]
+
+    @property
+    def sniffed_type(self):
+        """Tipo de documento según la firma del contenido, o None"""
+        return sniff_file_type(self.header)
+
+    def content_digest(self):
+        """Copia del SHA-256 del contenido, para extenderla con otros datos"""
+        return self._digest.copy()
+
+    def _artifact(self, key, build):
+        """
+        Calcula una sola vez un resultado del análisis; si falla, el error
+        también se conserva y se vuelve a lanzar en cada consulta
+        """
+        if key not in self._artifacts:
+            try:
+                self._artifacts[key] = (build(), None)
+            except Exception as e:
+                self._artifacts[key] = (None, e)
+        value, error = self._artifacts[key]
+        if error is not None:
+            raise error
+        return value
+
+    def image_info(self):
+        """Formato, tamaño y modo de la imagen, verificada una sola vez"""
+
+        def build():
+            self.spool.seek(0)
+            with Image.open(self.spool) as img:
+                info = {"format": img.format, "size": img.size, "mode": img.mode}
+                img.verify()
+            self.spool.seek(0)
+            return info
+
+        return self._artifact("image", build)
+
+    def text(self):
+        """Contenido decodificado probando varias codificaciones habituales"""
+
+        def build():
+            self.spool.seek(0)
+            raw_text = self.spool.read()
+            self.spool.seek(0)
+            for encoding in ["utf-8", "latin-1", "cp1252", "iso-8859-1"]:
+                try:
+                    return raw_text.decode(encoding)
+                except UnicodeDecodeError:
+                    continue
+            raise UnicodeDecodeError("utf-8", raw_text, 0, 1, "codificación desconocida")
+
+        return self._artifact("text", build)
+
+    def yaml_validation(self):
+        """Resultado de validate_yaml_content para el contenido en UTF-8"""
+
+        def build():
+            self.spool.seek(0)
+            content = self.spool.read().decode("utf-8")
+            self.spool.seek(0)
+            return validate_yaml_content(content)
+
+        return self._artifact("yaml", build)
+
+    def pdf_reader(self):
+        """Lector PyPDF2 del documento, creado una sola vez"""
+
+        def build():
+            import PyPDF2
+
+            self.spool.seek(0)
+            return PyPDF2.PdfReader(self.spool)
+
+        return self._artifact("pdf", build)
+
+    def pdf_page_count(self):
+        return len(self.pdf_reader().pages)
+
+    def pdf_text_layer(self):
+        """Texto nativo (capa de texto) de cada página del PDF, extraído una sola vez"""
+
+        def build():
+            texts = []
+            for page_number, page in enumerate(self.pdf_reader().pages, start=1):
+                try:
+                    texts.append(page.extract_text() or "")
+                except Exception as e:
+                    logging.warning(
+                        f"No se pudo extraer el texto de la página {page_number}: {str(e)}"
+                    )
+                    texts.append("")
+            return texts
+
+        return self._artifact("pdf_text", build)
+
+
 # Funciones de OCR con Mistral
 @handle_error(max_retries=1)
 def validate_file_format(file):
@@ -750,7 +1935,8 @@ def validate_file_format(file):
     sea consistente con la extensión declarada.
 
     Parámetros:
-        file: Objeto de archivo cargado por el usuario mediante Streamlit
+        file: Objeto de archivo cargado por el usuario mediante Streamlit o
+            FileProbe (la imagen o el YAML analizados quedan guardados en él)
 
     Retorno:
         tuple: (es_válido, tipo_documento, mensaje_error)
@@ -775,47 +1961,36 @@ def validate_file_format(file):
             file_type = doc_type
             break
 
-    # Verificar contenido según el tipo de archivo
+    # Verificar contenido según el tipo de archivo; con un FileProbe el
+    # análisis queda guardado para la detección de tipo y el OCR
     try:
-        # Guardar posición del cursor
-        position = file.tell()
-
-        # Verificar contenido según tipo
-        if file_type == "PDF":
-            # Verificar firma de PDF
-            header = file.read(8)
-            file.seek(position)  # Restaurar posición
-
-            if not header.startswith(b"%PDF"):
-                return False, None, "El archivo no es un PDF válido"
+        with FileProbe.scope(file) as probe:
+            if file_type == "PDF":
+                # Verificar firma de PDF
+                if not probe.header.startswith(b"%PDF"):
+                    return False, None, "El archivo no es un PDF válido"
 
-        elif file_type == "Imagen":
-            # Intentar abrir como imagen
-            try:
-                img = Image.open(file)
-                img.verify()  # Verificar que la imagen sea válida
-                file.seek(position)  # Restaurar posición
-            except Exception as e:
-                file.seek(position)  # Restaurar posición
-                return False, None, f"El archivo no es una imagen válida: {str(e)}"
+            elif file_type == "Imagen":
+                # Intentar abrir y verificar la imagen
+                try:
+                    probe.image_info()
+                except Exception as e:
+                    return False, None, f"El archivo no es una imagen válida: {str(e)}"
 
-        elif file_type == "YAML":
-            # Verificar que sea YAML válido
-            try:
-                import yaml
-                content = file.read()
-                yaml.safe_load(content)
-                file.seek(position)  # Restaurar posición
-            except Exception as e:
-                file.seek(position)  # Restaurar posición
-                return False, None, f"El archivo no es YAML válido: {str(e)}"
+            elif file_type == "YAML":
+                # Verificar que sea YAML válido (todos sus bloques ---)
+                try:
+                    validation = probe.yaml_validation()
+                except Exception as e:
+                    return False, None, f"El archivo no es YAML válido: {str(e)}"
+                if not validation["valid"]:
+                    return (
+                        False,
+                        None,
+                        f"El archivo no es YAML válido: {format_yaml_errors(validation)}",
+                    )
 
     except Exception as e:
-        # Restaurar posición en caso de error
-        try:
-            file.seek(position)
-        except:
-            pass
         return False, None, f"Error validando el archivo: {str(e)}"
 
     # Si llegamos aquí, el archivo es válido
@@ -829,7 +2004,8 @@ def detect_document_type(file):
     con múltiples verificaciones para mayor precisión
 
     Parámetros:
-        file: Objeto de archivo cargado por el usuario mediante Streamlit
+        file: Objeto de archivo cargado por el usuario mediante Streamlit o
+            FileProbe (reutiliza su cabecera y su análisis de imagen)
 
     Retorno:
         string: Tipo de documento detectado ("PDF", "Imagen", "YAML", "Texto")
@@ -856,86 +2032,130 @@ def detect_document_type(file):
         elif name.endswith(".txt"):
             return "Texto"
 
-    # 3. Verificar contenido con análisis de bytes
-    try:
-        # Guardar posición del cursor
-        position = file.tell()
-        # Leer los primeros bytes
-        header = file.read(8)
-        file.seek(position)  # Restaurar posición
-
-        # Verificar firmas de archivo comunes
-        if header.startswith(b"%PDF"):
-            return "PDF"
-        elif header.startswith(b"\x89PNG") or header.startswith(b"\xff\xd8"):
-            return "Imagen"
-    except:
-        pass
+    # 3. Verificar contenido por su firma (magic number)
+    if isinstance(file, FileProbe):
+        header = file.header
+    else:
+        try:
+            position = file.tell()
+            header = file.read(FileProbe.HEADER_BYTES)
+            file.seek(position)  # Restaurar posición
+        except:
+            header = b""
+    sniffed_type = sniff_file_type(header)
+    if sniffed_type:
+        return sniffed_type
 
     # 4. Intentar abrir como imagen (último recurso)
     try:
-        Image.open(file)
-        file.seek(0)  # Restaurar el puntero
+        if isinstance(file, FileProbe):
+            file.image_info()
+        else:
+            Image.open(file)
+            file.seek(0)  # Restaurar el puntero
         return "Imagen"
     except:
-        file.seek(0)  # Restaurar el puntero
+        if not isinstance(file, FileProbe):
+            file.seek(0)  # Restaurar el puntero
 
     # Asumir Texto por defecto
     return "Texto"
 
 
-@handle_error(max_retries=1)
+# Preprocesamiento de imágenes para OCR
+IMAGE_PREPROCESSING_CONFIG = {
+    "max_dimension": 4000,  # Lado máximo enviado al OCR
+    "reducing_gap": 3.0,  # Reducción entera previa al remuestreo final (Pillow)
+    "document_ratio": 0.8,  # Fracción mínima de píxeles exactamente blancos (255) o negros (0)
+    "jpeg_quality": 95,
+    "png_compress_level": 6,
+}
+
+
+def _looks_like_document(img):
+    """
+    Clasifica una imagen en escala de grises como documento (predominio de
+    píxeles exactamente blancos o negros) o fotografía. El histograma de
+    Pillow se calcula en C sobre la imagen completa
+    """
+    histogram = img.histogram()
+    total = sum(histogram)
+    return total > 0 and histogram[0] + histogram[-1] > (
+        total * IMAGE_PREPROCESSING_CONFIG["document_ratio"]
+    )
+
+
+@handle_error(max_retries=1)
 def prepare_image_for_ocr(file_data):
     """
     Prepara una imagen para ser procesada con OCR,
-    optimizando formato y calidad para mejorar resultados
+    optimizando formato y calidad para mejorar resultados.
+    Los JPEG se decodifican directamente a escala reducida y en grises
+    (modo draft) cuando superan el tamaño máximo
 
     Parámetros:
-        file_data: Datos binarios de la imagen
+        file_data: Datos binarios de la imagen o archivo (file-like) que la contiene
 
     Retorno:
         tuple: (datos_optimizados, mime_type)
     """
+    config = IMAGE_PREPROCESSING_CONFIG
     try:
-        # Abrir la imagen con PIL
-        img = Image.open(BytesIO(file_data))
+        # Abrir la imagen con PIL (solo lee la cabecera)
+        img = Image.open(
+            file_data if hasattr(file_data, "read") else BytesIO(file_data)
+        )
+
+        # 1. Decodificar ya reducida: el decodificador JPEG escala 1/2, 1/4 o 1/8
+        # sin superar el tamaño pedido y entrega directamente la luminancia.
+        # Solo si hay que reducir, para que las imágenes pequeñas se conviertan
+        # igual que antes
+        max_dimension = config["max_dimension"]
+        ratio = min(1.0, max_dimension / img.width, max_dimension / img.height)
+        if img.format == "JPEG" and ratio < 1.0:
+            img.draft(
+                "L", (max(1, int(img.width * ratio)), max(1, int(img.height * ratio)))
+            )
 
-        # Optimizaciones avanzadas para OCR
-        # 1. Convertir a escala de grises si tiene más de un canal
+        # 2. Convertir a escala de grises si tiene más de un canal
         if img.mode != "L" and img.mode != "1":
             img = img.convert("L")
 
-        # 2. Ajustar tamaño si es muy grande (límite 4000px)
-        max_dimension = 4000
+        # 3. Ajustar tamaño si es muy grande: reducción entera rápida seguida
+        # de remuestreo LANCZOS sobre la imagen ya pequeña
         if img.width > max_dimension or img.height > max_dimension:
-            ratio = min(max_dimension / img.width, max_dimension / img.height)
-            new_width = int(img.width * ratio)
-            new_height = int(img.height * ratio)
-            img = img.resize((new_width, new_height), Image.LANCZOS)
+            img.thumbnail(
+                (max_dimension, max_dimension),
+                Image.LANCZOS,
+                reducing_gap=config["reducing_gap"],
+            )
 
-        # 3. Evaluar y determinar mejor formato
-        # JPEG para imágenes fotográficas, PNG para documentos/texto
+        # 4. JPEG para imágenes fotográficas, PNG para documentos/texto
         save_format = "JPEG"
-        save_quality = 95
-
-        # Detectar si es más probable que sea un documento (blanco/negro predominante)
-        histogram = img.histogram()
-        if img.mode == "L" and (histogram[0] + histogram[-1]) > sum(histogram) * 0.8:
+        if img.mode == "L" and _looks_like_document(img):
             save_format = "PNG"
 
-        # 4. Guardar con parámetros optimizados
+        # 5. Guardar con parámetros optimizados
         buffer = BytesIO()
         if save_format == "JPEG":
-            img.save(buffer, format=save_format, quality=save_quality, optimize=True)
+            img.save(
+                buffer, format=save_format, quality=config["jpeg_quality"], optimize=True
+            )
         else:
-            img.save(buffer, format=save_format, optimize=True)
+            img.save(
+                buffer, format=save_format, compress_level=config["png_compress_level"]
+            )
 
         buffer.seek(0)
         return buffer.read(), f"image/{save_format.lower()}"
 
     except Exception as e:
         logging.warning(f"Optimización de imagen fallida: {str(e)}")
-        return file_data, "image/jpeg"  # Formato por defecto
+        # Formato por defecto, devolviendo siempre bytes aunque se recibiera un archivo
+        if hasattr(file_data, "read"):
+            file_data.seek(0)
+            file_data = file_data.read()
+        return file_data, "image/jpeg"
 
 
 @handle_error(max_retries=1)
@@ -1057,522 +2277,3270 @@ def extract_all_text_fields(data, prefix="", max_depth=5, current_depth=0):
     return "\n".join(result)
 
 
-@handle_error(max_retries=1)
-def process_document_with_mistral_ocr(api_key, file_bytes, file_type, file_name):
-    """
-    Procesa un documento con OCR de Mistral
-    con sistema de recuperación ante fallos
+# Configuración del motor OCR de Mistral
+MISTRAL_OCR_URL = "https://api.mistral.ai/v1/ocr"
+MISTRAL_OCR_MODEL = "mistral-ocr-latest"
+OCR_CONFIG = {
+    "max_concurrency": 4,  # Documentos enviados simultáneamente a la API
+    "timeout": 90,  # Timeout (s) ampliado para documentos grandes
+    "max_retries": 2,  # Reintentos ante límite de tasa, timeouts o errores de red
+    "retry_delay": 2,  # Espera base (s) entre reintentos
+    "pdf_shard_pages": 10,  # Páginas por fragmento al dividir PDFs grandes
+    "shard_retry_rounds": 1,  # Rondas adicionales solo para fragmentos fallidos
+    "max_upload_bytes": 50 * 1024 * 1024,  # Tamaño máximo de archivo aceptado
+    "spool_memory_bytes": 1024 * 1024,  # Por encima de este tamaño se usa disco
+}
 
-    Parámetros:
-        api_key: API key de Mistral
-        file_bytes: Bytes del archivo
-        file_type: Tipo de archivo ("PDF", "Imagen", "Texto", "YAML")
-        file_name: Nombre del archivo
+# Tamaño de bloque (múltiplo de 3) para leer y codificar en base64 por partes
+OCR_STREAM_CHUNK_SIZE = 3 * 64 * 1024
 
-    Retorno:
-        dict: Texto extraído del documento
+# Capa de texto nativa de los PDF: las páginas con texto suficiente y legible
+# se extraen localmente y solo el resto se envía al OCR
+PDF_TEXT_LAYER_CONFIG = {
+    "enabled": True,
+    "min_chars": 200,  # Caracteres mínimos en páginas que contienen imágenes
+    "min_quality": 0.5,  # Fracción mínima de caracteres legibles (ver score_pdf_text_quality)
+    "max_image_depth": 3,  # Niveles de XObject de formulario revisados en busca de imágenes
+}
+
+
+# Caché persistente de resultados OCR compartida por todas las sesiones
+OCR_CACHE_CONFIG = {
+    "enabled": True,
+    "directory": os.path.join(
+        tempfile.gettempdir(), f"{APP_IDENTITY['document_prefix']}_ocr_cache"
+    ),
+    "max_bytes": 200 * 1024 * 1024,  # Tamaño máximo del directorio de caché
+    "ttl": 7 * 24 * 3600,  # Vigencia (s) de cada resultado
+}
+
+# Versión del pipeline OCR: incrementarla invalida los resultados cacheados
+OCR_PIPELINE_VERSION = 5
+
+
+class OCRResultCache:
+    """
+    Caché en disco de resultados OCR direccionada por contenido (SHA-256
+    de los bytes del archivo más modelo y opciones), con expiración por TTL,
+    expulsión LRU por tamaño total y contadores de aciertos y fallos
     """
-    job_id = str(uuid.uuid4())
-    logging.info(f"Procesando documento {file_name} con Mistral OCR (ID: {job_id})")
 
-    # Mostrar estado
-    with st.status(f"Procesando documento {file_name}...", expanded=True) as status:
+    def __init__(self, directory, max_bytes, ttl):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(source, model, options=None):
+        """
+        Calcula la clave de caché de un archivo (bytes o file-like) para un
+        modelo y opciones dados, leyéndolo por bloques; con un FileProbe se
+        reutiliza el SHA-256 calculado al copiarlo
+        """
+        if isinstance(source, FileProbe):
+            digest = source.content_digest()
+        else:
+            digest = hashlib.sha256()
+            for chunk in _iter_source_chunks(source):
+                digest.update(chunk)
+        digest.update(
+            json.dumps(
+                {
+                    "model": model,
+                    "options": options or {},
+                    "version": OCR_PIPELINE_VERSION,
+                },
+                sort_keys=True,
+            ).encode("utf-8")
+        )
+        return digest.hexdigest()
+
+    def _path_for(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _count(self, counter, amount=1):
+        with self._lock:
+            self.counters[counter] += amount
+
+    def get(self, key):
+        """Devuelve el resultado cacheado o None si no existe o expiró"""
+        path = self._path_for(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self._count("misses")
+            return None
+
+        if time.time() - entry.get("created_at", 0) > self.ttl:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._count("misses")
+            return None
+
+        # Actualizar la fecha de acceso usada por la expulsión LRU
         try:
-            status.update(label="Preparando documento para OCR...", state="running")
+            os.utime(path)
+        except OSError:
+            pass
+        self._count("hits")
+        return entry.get("result")
 
-            # Para archivos YAML, extraer contenido directamente
-            if file_type == "YAML":
+    def put(self, key, result):
+        """Guarda un resultado de forma atómica y aplica el límite de tamaño"""
+        path = self._path_for(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created_at": time.time(), "result": result}, f)
+            os.replace(tmp_path, path)
+            self._count("stores")
+        except OSError as e:
+            logging.warning(f"No se pudo guardar el resultado OCR en caché: {str(e)}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._evict()
+
+    def _evict(self):
+        """Elimina entradas expiradas y, si se excede el tamaño, las menos usadas"""
+        now = time.time()
+        entries = []
+        total_size = 0
+        with self._lock:
+            try:
+                with os.scandir(self.directory) as it:
+                    for entry in it:
+                        if not entry.name.endswith(".json"):
+                            continue
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                        total_size += stat.st_size
+            except OSError as e:
+                logging.warning(f"No se pudo revisar la caché OCR: {str(e)}")
+                return
+
+            entries.sort()
+            evicted = 0
+            for mtime, size, path in entries:
+                # Las fechas de acceso más antiguas que el TTL implican expiración
+                if total_size <= self.max_bytes and now - mtime <= self.ttl:
+                    break
                 try:
-                    import yaml
-                    yaml_content = file_bytes.decode("utf-8")
-                    # Validar que sea YAML válido
-                    yaml.safe_load(yaml_content)
-                    return {"text": yaml_content, "format": "yaml"}
-                except Exception as e:
-                    # Si falla la validación YAML, intentar como texto
-                    logging.warning(f"Error procesando YAML, tratando como texto: {str(e)}")
-                    file_type = "Texto"
+                    os.remove(path)
+                    total_size -= size
+                    evicted += 1
+                except OSError:
+                    pass
+            self.counters["evictions"] += evicted
 
-            # Guardar una copia del archivo para depuración
-            debug_dir = os.path.join(
-                tempfile.gettempdir(), f"{APP_IDENTITY['document_prefix']}_debug"
-            )
-            os.makedirs(debug_dir, exist_ok=True)
-            debug_file_path = os.path.join(debug_dir, f"debug_{job_id}_{file_name}")
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
 
-            with open(debug_file_path, "wb") as f:
-                f.write(file_bytes)
 
-            logging.info(f"Archivo de depuración guardado en: {debug_file_path}")
+@st.cache_resource(show_spinner=False)
+def get_ocr_result_cache():
+    """Devuelve la caché OCR compartida o None si está deshabilitada"""
+    if not OCR_CACHE_CONFIG["enabled"]:
+        return None
+    try:
+        return OCRResultCache(
+            OCR_CACHE_CONFIG["directory"],
+            OCR_CACHE_CONFIG["max_bytes"],
+            OCR_CACHE_CONFIG["ttl"],
+        )
+    except OSError as e:
+        logging.warning(f"Caché OCR no disponible: {str(e)}")
+        return None
 
-            # Sistema de procesamiento con verificación según tipo
-            if file_type == "PDF":
-                # Verificar que el PDF sea válido
-                try:
-                    import PyPDF2
-
-                    reader = PyPDF2.PdfReader(io.BytesIO(file_bytes))
-                    page_count = len(reader.pages)
-                    sample_text = ""
-                    if page_count > 0:
-                        sample_text = reader.pages[0].extract_text()[:100]
-                    logging.info(
-                        f"PDF válido con {page_count} páginas. Muestra: {sample_text}"
-                    )
 
-                    # Codificar PDF en base64
-                    encoded_file = base64.b64encode(file_bytes).decode("utf-8")
-                    document = {
-                        "type": "document_url",
-                        "document_url": f"data:application/pdf;base64,{encoded_file}",
-                    }
-                except Exception as e:
-                    logging.error(f"Error al validar PDF: {str(e)}")
-                    status.update(
-                        label=f"Error al validar PDF: {str(e)}", state="error"
-                    )
-                    return {"error": f"El archivo no es un PDF válido: {str(e)}"}
-            elif file_type == "Imagen":
-                # Optimizar imagen para mejores resultados
-                try:
-                    optimized_bytes, mime_type = prepare_image_for_ocr(file_bytes)
+# Artefactos de depuración OCR (opcional): se activa con la variable de entorno
+# o el secret OCR_DEBUG y nunca bloquea el procesamiento de documentos
+OCR_DEBUG_CONFIG = {
+    "directory": os.path.join(
+        tempfile.gettempdir(), f"{APP_IDENTITY['document_prefix']}_debug"
+    ),
+    "sample_rate": 0.1,  # Fracción de trabajos OCR cuyos artefactos se guardan
+    "max_file_bytes": 5 * 1024 * 1024,  # Tamaño máximo de cada artefacto
+    "max_total_bytes": 100 * 1024 * 1024,  # Tamaño máximo del directorio
+    "max_age": 24 * 3600,  # Antigüedad (s) a partir de la cual se eliminan
+    "queue_size": 32,  # Artefactos pendientes antes de descartar nuevos
+}
 
-                    # Codificar en base64
-                    encoded_file = base64.b64encode(optimized_bytes).decode("utf-8")
-                    document = {
-                        "type": "image_url",
-                        "image_url": f"data:{mime_type};base64,{encoded_file}",
-                    }
-                except Exception as e:
-                    logging.error(f"Error al procesar imagen: {str(e)}")
-                    status.update(
-                        label=f"Error al procesar imagen: {str(e)}", state="error"
-                    )
-                    return {"error": f"El archivo no es una imagen válida: {str(e)}"}
-            elif file_type == "Texto":
-                # Para archivos de texto, extraer contenido directamente
-                try:
-                    # Intentar leer con diferentes codificaciones
-                    try:
-                        text_content = file_bytes.decode("utf-8")
-                        return {"text": text_content, "format": "text"}
-                    except UnicodeDecodeError:
-                        # Intentar con otras codificaciones comunes
-                        for encoding in ["latin-1", "cp1252", "iso-8859-1"]:
-                            try:
-                                text_content = file_bytes.decode(encoding)
-                                return {"text": text_content, "format": "text"}
-                            except UnicodeDecodeError:
-                                continue
-
-                    # Si llegamos aquí, no pudimos decodificar el texto
-                    # Intentar enviar como documento plano
-                    status.update(
-                        label=f"Convirtiendo documento de texto {file_name} para OCR...",
-                        state="running",
-                    )
 
-                    # Codificar en base64 y enviar como documento
-                    encoded_file = base64.b64encode(file_bytes).decode("utf-8")
-                    document = {
-                        "type": "document_url",
-                        "document_url": f"data:text/plain;base64,{encoded_file}",
-                    }
-                except Exception as e:
-                    logging.error(f"Error al procesar documento de texto: {str(e)}")
-                    status.update(
-                        label=f"Error al procesar documento: {str(e)}", state="error"
-                    )
-                    return {"error": f"Error al procesar documento de texto: {str(e)}"}
-            else:
-                # Tipo de documento no soportado
-                error_msg = f"Tipo de documento no soportado: {file_type}"
-                logging.error(error_msg)
-                status.update(label=error_msg, state="error")
-                return {"error": error_msg}
+class DebugArtifactSink:
+    """
+    Escritor en segundo plano de artefactos de depuración OCR. Muestrea
+    trabajos, limita el tamaño de cada archivo y del directorio, elimina
+    artefactos antiguos y descarta (sin esperar) si la cola está llena
+    """
 
-            status.update(
-                label="Enviando documento a la API de Mistral...", state="running"
-            )
+    def __init__(
+        self,
+        directory,
+        sample_rate=0.1,
+        max_file_bytes=5 * 1024 * 1024,
+        max_total_bytes=100 * 1024 * 1024,
+        max_age=24 * 3600,
+        queue_size=32,
+    ):
+        import queue
+
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self.max_age = max_age
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        os.makedirs(directory, exist_ok=True)
+        self._worker = threading.Thread(
+            target=self._run, name="ocr-debug-sink", daemon=True
+        )
+        self._worker.start()
 
-            # Configurar los headers
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}",
-            }
+    def should_sample(self, job_id):
+        """Decide de forma determinista si se guardan los artefactos de un trabajo"""
+        bucket = int(hashlib.sha256(job_id.encode("utf-8")).hexdigest()[:8], 16)
+        return bucket / 0xFFFFFFFF < self.sample_rate
 
-            # Preparar payload
-            payload = {"model": "mistral-ocr-latest", "document": document}
+    def submit(self, name, data):
+        """
+        Encola un artefacto (bytes, str o estructura JSON) sin bloquear.
+        Los bytes y textos deben venir ya recortados por el llamador si son grandes
+        """
+        import queue
 
-            # Guardar payload para depuración (excluyendo contenido base64 por tamaño)
-            debug_payload = {
-                "model": payload["model"],
-                "document": {
-                    "type": payload["document"]["type"],
-                    "content_size": len(encoded_file),
-                    "content_format": "base64",
-                },
-            }
-            logging.info(f"Payload para OCR: {json.dumps(debug_payload)}")
+        try:
+            self._queue.put_nowait((os.path.basename(name), data))
+        except queue.Full:
+            self.dropped += 1
 
-            # Sistema de retry interno para la API de Mistral
-            max_retries = 2
-            retry_delay = 2
-            last_error = None
+    def _run(self):
+        while True:
+            name, data = self._queue.get()
+            try:
+                self._write(name, data)
+                self._rotate()
+            except Exception as e:
+                logging.warning(f"No se pudo guardar el artefacto de depuración {name}: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, name, data):
+        if isinstance(data, (dict, list)):
+            data = json.dumps(data, indent=2)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with open(os.path.join(self.directory, name), "wb") as f:
+            f.write(data[: self.max_file_bytes])
+
+    def _rotate(self):
+        """Elimina artefactos expirados y, si se excede el tamaño, los más antiguos"""
+        now = time.time()
+        entries = []
+        total_size = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_size += stat.st_size
+
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_total_bytes and now - mtime <= self.max_age:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError:
+                pass
 
-            for retry in range(max_retries + 1):
-                try:
-                    # Hacer la solicitud a Mistral OCR API
-                    response = requests.post(
-                        "https://api.mistral.ai/v1/ocr",
-                        json=payload,
-                        headers=headers,
-                        timeout=90,  # Timeout ampliado para documentos grandes
-                    )
 
-                    logging.info(
-                        f"Respuesta de OCR API - Estado: {response.status_code}"
-                    )
+@st.cache_resource(show_spinner=False)
+def get_debug_artifact_sink():
+    """Devuelve el escritor de artefactos de depuración o None si está desactivado"""
+    enabled = os.environ.get("OCR_DEBUG")
+    if enabled is None and hasattr(st, "secrets"):
+        try:
+            enabled = st.secrets.get("OCR_DEBUG")
+        except Exception:
+            enabled = None
+    if str(enabled).lower() not in ("1", "true", "yes"):
+        return None
+    try:
+        return DebugArtifactSink(**OCR_DEBUG_CONFIG)
+    except OSError as e:
+        logging.warning(f"Depuración OCR no disponible: {str(e)}")
+        return None
 
-                    if response.status_code == 200:
-                        try:
-                            result = response.json()
-                            # Guardar respuesta para depuración
-                            with open(
-                                os.path.join(
-                                    debug_dir, f"response_{job_id}_{file_name}.json"
-                                ),
-                                "w",
-                            ) as f:
-                                json.dump(result, f, indent=2)
-
-                            status.update(
-                                label=f"Documento {file_name} procesado exitosamente",
-                                state="complete",
-                            )
 
-                            # Verificar existencia de contenido
-                            if not result or (isinstance(result, dict) and not result):
-                                return {
-                                    "error": "La API no devolvió contenido",
-                                    "raw_response": str(result),
-                                }
+def spool_upload(source, max_bytes=None, digest=None):
+    """
+    Copia un archivo cargado (o bytes) a un archivo temporal que pasa a disco
+    al superar cierto tamaño, verificando el límite de bytes antes de leerlo
 
-                            # Extraer texto de la respuesta
-                            extracted_content = extract_text_from_ocr_response(result)
-
-                            if "error" in extracted_content:
-                                status.update(
-                                    label=f"Error al extraer texto: {extracted_content['error']}",
-                                    state="error",
-                                )
-                                return {
-                                    "error": extracted_content["error"],
-                                    "raw_response": result,
-                                }
+    Parámetros:
+        source: Bytes o archivo cargado por el usuario (file-like)
+        max_bytes: Tamaño máximo permitido (por defecto OCR_CONFIG["max_upload_bytes"])
+        digest: Objeto hashlib opcional que se actualiza con cada bloque copiado
 
-                            return extracted_content
-                        except Exception as e:
-                            error_message = (
-                                f"Error al procesar respuesta JSON: {str(e)}"
-                            )
-                            logging.error(error_message)
-                            # Guardar respuesta cruda para depuración
-                            with open(
-                                os.path.join(
-                                    debug_dir, f"raw_response_{job_id}_{file_name}.txt"
-                                ),
-                                "w",
-                            ) as f:
-                                f.write(response.text[:10000])  # Limitar tamaño
-                            status.update(label=error_message, state="error")
-                            last_error = e
-                    elif response.status_code == 429:  # Rate limit
-                        if retry < max_retries:
-                            wait_time = retry_delay * (retry + 1)
-                            logging.warning(
-                                f"Rate limit alcanzado. Esperando {wait_time}s antes de reintentar..."
-                            )
-                            status.update(
-                                label=f"Límite de tasa alcanzado. Reintentando en {wait_time}s...",
-                                state="running",
-                            )
-                            time.sleep(wait_time)
-                            continue
-                        else:
-                            error_message = "Límite de tasa alcanzado. No se pudo procesar después de reintentos."
-                            logging.error(error_message)
-                            status.update(label=error_message, state="error")
-                            return {
-                                "error": error_message,
-                                "raw_response": response.text,
-                            }
-                    else:
-                        error_message = f"Error en API OCR ({response.status_code}): {response.text[:500]}"
-                        logging.error(error_message)
-                        status.update(label=f"Error: {error_message}", state="error")
-                        last_error = Exception(error_message)
-                        break
-                except requests.exceptions.Timeout:
-                    if retry < max_retries:
-                        wait_time = retry_delay * (retry + 1)
-                        logging.warning(
-                            f"Timeout al contactar API. Esperando {wait_time}s antes de reintentar..."
-                        )
-                        status.update(
-                            label=f"Timeout. Reintentando en {wait_time}s...",
-                            state="running",
-                        )
-                        time.sleep(wait_time)
-                    else:
-                        error_message = (
-                            "Timeout al contactar API después de múltiples intentos."
-                        )
-                        logging.error(error_message)
-                        status.update(label=error_message, state="error")
-                        return {"error": error_message}
-                except Exception as e:
-                    if retry < max_retries:
-                        wait_time = retry_delay * (retry + 1)
-                        logging.warning(
-                            f"Error: {str(e)}. Esperando {wait_time}s antes de reintentar..."
-                        )
-                        status.update(
-                            label=f"Error. Reintentando en {wait_time}s...",
-                            state="running",
-                        )
-                        time.sleep(wait_time)
-                    else:
-                        error_message = f"Error al procesar documento: {str(e)}"
-                        logging.error(error_message)
-                        status.update(label=f"Error: {error_message}", state="error")
-                        last_error = e
-                        break
+    Retorno:
+        SpooledTemporaryFile: Copia del archivo posicionada al inicio
 
-            # Si llegamos aquí después de reintentos, devolver último error
-            return {
-                "error": f"Error después de reintentos: {str(last_error)}",
-                "details": traceback.format_exc(),
-            }
+    Excepciones:
+        ValueError: Si el archivo supera el tamaño máximo permitido
+    """
+    max_bytes = max_bytes or OCR_CONFIG["max_upload_bytes"]
+    too_large = f"El archivo supera el tamaño máximo permitido de {max_bytes // (1024 * 1024)} MB"
 
-        except Exception as e:
-            error_message = f"Error general al procesar documento: {str(e)}"
-            logging.error(error_message)
-            logging.error(traceback.format_exc())
-            status.update(label=f"Error: {error_message}", state="error")
-            return {"error": error_message}
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        declared_size = len(source)
+    else:
+        declared_size = getattr(source, "size", None)
+    if declared_size is not None and declared_size > max_bytes:
+        raise ValueError(too_large)
+
+    spool = tempfile.SpooledTemporaryFile(max_size=OCR_CONFIG["spool_memory_bytes"])
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        spool.write(source)
+        if digest is not None:
+            digest.update(source)
+    else:
+        if hasattr(source, "seek"):
+            source.seek(0)
+        copied = 0
+        while True:
+            chunk = source.read(OCR_STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            copied += len(chunk)
+            if copied > max_bytes:
+                spool.close()
+                raise ValueError(too_large)
+            spool.write(chunk)
+            if digest is not None:
+                digest.update(chunk)
+
+    spool.seek(0)
+    return spool
+
+
+def _source_size(source):
+    """Tamaño en bytes de un origen de datos (bytes o archivo con seek)"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return len(source)
+    source.seek(0, os.SEEK_END)
+    size = source.tell()
+    source.seek(0)
+    return size
+
+
+def _iter_source_chunks(source, chunk_size=None):
+    """Recorre un origen de datos (bytes o archivo con seek) en bloques"""
+    chunk_size = chunk_size or OCR_STREAM_CHUNK_SIZE
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for start in range(0, len(view), chunk_size):
+            yield view[start : start + chunk_size]
+        return
+
+    source.seek(0)
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
 
 
-# Función segura para gestionar el contexto de documentos
-@handle_error(max_retries=0)
-def manage_document_context():
+def _ocr_request_body_parts(document, model=None):
     """
-    Permite al usuario gestionar qué documentos mantener en el contexto actual
-    con manejo seguro de actualización de estado
+    Devuelve el prefijo, el sufijo y el tamaño total del cuerpo JSON de la
+    petición OCR, cuyo centro es el contenido del documento en base64
     """
-    if "document_contents" in st.session_state and st.session_state.document_contents:
-        st.write("Documentos en contexto actual:")
+    model = model or MISTRAL_OCR_MODEL
+    url_field = "image_url" if document["type"] == "image_url" else "document_url"
+    prefix = (
+        f'{{"model": {json.dumps(model)}, "document": {{"type": {json.dumps(document["type"])}, '
+        f'"{url_field}": "data:{document["mime_type"]};base64,'
+    ).encode("utf-8")
+    suffix = b'"}}'
+    encoded_size = 4 * ((_source_size(document["source"]) + 2) // 3)
+    return prefix, suffix, len(prefix) + encoded_size + len(suffix)
+
+
+def _iter_ocr_request_body(document, model=None):
+    """
+    Genera el cuerpo JSON de la petición OCR por partes, codificando el
+    contenido en base64 bloque a bloque sin materializar la data URL completa
+    """
+    prefix, suffix, _ = _ocr_request_body_parts(document, model)
+    yield prefix
+    # Los bloques son múltiplos de 3 bytes, por lo que su base64 concatenado es válido
+    for chunk in _iter_source_chunks(document["source"]):
+        yield base64.b64encode(chunk)
+    yield suffix
 
-        # Crear checkboxes para cada documento
-        docs_to_keep = {}
-        for doc_name in st.session_state.document_contents:
-            docs_to_keep[doc_name] = st.checkbox(
-                f"{doc_name}", value=True, key=f"keep_{doc_name}"
-            )
 
-        # Botón para aplicar cambios
-        if st.button("Actualizar contexto", key="update_context"):
-            # Eliminar documentos no seleccionados
-            docs_to_remove = [doc for doc, keep in docs_to_keep.items() if not keep]
-            if docs_to_remove:
-                for doc in docs_to_remove:
-                    if doc in st.session_state.document_contents:
-                        del st.session_state.document_contents[doc]
-                    if doc in st.session_state.uploaded_files:
-                        st.session_state.uploaded_files.remove(doc)
+async def _aiter_ocr_request_body(document, model=None):
+    """Versión asíncrona de _iter_ocr_request_body para httpx.AsyncClient"""
+    for part in _iter_ocr_request_body(document, model):
+        yield part
 
-                st.success(
-                    f"Se eliminaron {len(docs_to_remove)} documentos del contexto."
-                )
-                # Usar sistema seguro de reinicio
-                rerun_app()
-            else:
-                st.info("No se seleccionaron documentos para eliminar.")
-    else:
-        st.info("No hay documentos cargados en el contexto actual.")
 
+def _split_pdf_into_shards(reader, shard_pages, page_indices=None):
+    """
+    Divide un PDF en fragmentos de páginas consecutivas, cada uno
+    serializado como un PDF independiente en un archivo temporal
 
-# Función para inicializar un thread con OpenAI Assistants
-@handle_error(max_retries=1)
-def initialize_thread(client):
+    Parámetros:
+        reader: PyPDF2.PdfReader del documento completo
+        shard_pages: Número máximo de páginas por fragmento
+        page_indices: Índices (base 0, ordenados) de las páginas a incluir;
+            por defecto todas. Un hueco entre índices inicia otro fragmento
+
+    Retorno:
+        generator: Tuplas (índice_primera_página, índice_tras_la_última, archivo_del_fragmento)
     """
-    Inicializa un nuevo thread de conversación
-    con verificación de éxito
+    import PyPDF2
+
+    if page_indices is None:
+        page_indices = range(len(reader.pages))
+    runs = []
+    for page_index in page_indices:
+        if runs and page_index == runs[-1][-1] + 1 and len(runs[-1]) < shard_pages:
+            runs[-1].append(page_index)
+        else:
+            runs.append([page_index])
+
+    for run in runs:
+        writer = PyPDF2.PdfWriter()
+        for page_index in run:
+            writer.add_page(reader.pages[page_index])
+        shard = tempfile.SpooledTemporaryFile(
+            max_size=OCR_CONFIG["spool_memory_bytes"]
+        )
+        writer.write(shard)
+        shard.seek(0)
+        yield run[0], run[-1] + 1, shard
+
+
+_PDF_UNREADABLE_TEXT = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\ufffd\ue000-\uf8ff]|\(cid:\d+\)")
+_PDF_ALPHANUMERIC = re.compile(r"[^\W_]")
+_PDF_WHITESPACE = re.compile(r"\s")
+
+
+def score_pdf_text_quality(text):
+    """
+    Puntúa de 0 a 1 la legibilidad de la capa de texto de una página: la
+    fracción de caracteres visibles que son letras o dígitos, descontando
+    los de reemplazo, de uso privado o de control que dejan las fuentes sin
+    tabla ToUnicode
+    """
+    visible = len(text) - len(_PDF_WHITESPACE.findall(text))
+    if visible == 0:
+        return 0.0
+    alphanumeric = len(_PDF_ALPHANUMERIC.findall(text))
+    unreadable = len(_PDF_UNREADABLE_TEXT.findall(text))
+    return max(0.0, (alphanumeric - unreadable) / visible)
+
+
+def _pdf_resources_have_images(resources, depth):
+    """Indica si unos recursos PDF contienen imágenes (también dentro de formularios)"""
+    if resources is None or depth > PDF_TEXT_LAYER_CONFIG["max_image_depth"]:
+        return False
+    xobjects = resources.get_object().get("/XObject")
+    if xobjects is None:
+        return False
+    for xobject in xobjects.get_object().values():
+        xobject = xobject.get_object()
+        subtype = xobject.get("/Subtype")
+        if subtype == "/Image":
+            return True
+        if subtype == "/Form" and _pdf_resources_have_images(
+            xobject.get("/Resources"), depth + 1
+        ):
+            return True
+    return False
+
+
+def pdf_page_needs_ocr(page, text):
+    """
+    Decide si una página de PDF debe enviarse al OCR a partir de su capa
+    de texto nativa
+
+    Parámetros:
+        page: Página de PyPDF2
+        text: Texto extraído de la página
+
+    Retorno:
+        bool: True si la capa de texto falta, es ilegible o es escasa en una
+        página con imágenes (escaneos); False si basta con el texto nativo
     """
+    config = PDF_TEXT_LAYER_CONFIG
+    stripped = text.strip()
+    if stripped and score_pdf_text_quality(stripped) < config["min_quality"]:
+        return True
+    if len(stripped) >= config["min_chars"]:
+        return False
     try:
-        thread = client.beta.threads.create()
-        thread_id = thread.id
-        logging.info(f"Thread creado: {thread_id}")
+        if _pdf_resources_have_images(page.get("/Resources"), 0):
+            return True
+    except Exception as e:
+        logging.warning(f"No se pudieron revisar las imágenes de la página: {str(e)}")
+        return True
+    # Sin imágenes: una página sin texto pero con contenido es texto vectorizado
+    return not stripped and page.get("/Contents") is not None
 
-        # Verificar que el thread se creó correctamente
-        test_thread = client.beta.threads.retrieve(thread_id=thread_id)
-        if not test_thread or not hasattr(test_thread, "id"):
-            raise Exception("El thread se creó pero no se puede recuperar")
 
-        return thread_id
-    except Exception as e:
-        logging.error(f"Error creando thread: {str(e)}")
-        st.error("No se pudo inicializar la conversación con el asistente")
-        return None
+def _stitch_ocr_shards(shard_results):
+    """
+    Une en orden de página los resultados OCR de los fragmentos de un PDF
+    (y las páginas extraídas de su capa de texto), insertando marcadores de
+    página y señalando las páginas sin resultado
+
+    Parámetros:
+        shard_results: Lista de resultados por fragmento, en cualquier orden
+
+    Retorno:
+        dict: Texto combinado del documento
+    """
+    failed = [result for result in shard_results if "error" in result]
+    if len(failed) == len(shard_results):
+        return {
+            "error": f"Ningún fragmento del PDF pudo procesarse: {failed[0]['error']}"
+        }
+
+    parts = []  # (número_de_página, texto)
+    for result in shard_results:
+        if "error" in result:
+            first, last = result["page_range"]
+            parts.append(
+                (first, f"<!-- Páginas {first}-{last}: error de OCR ({result['error']}) -->")
+            )
+            continue
+        for page in result["pages"]:
+            parts.append(
+                (page["number"], f"<!-- Página {page['number']} -->\n\n{page['markdown']}")
+            )
+    parts.sort(key=lambda part: part[0])
+
+    stitched = {"text": "\n\n".join(text for _, text in parts), "format": "markdown"}
+    if failed:
+        stitched["partial_errors"] = [result["error"] for result in failed]
+    return stitched
+
+
+def _prepare_ocr_document(probe, file_type, file_name, job_id):
+    """
+    Prepara un documento para OCR según su tipo. Los archivos YAML y de texto
+    legibles se resuelven localmente sin llamar a la API y los PDF grandes
+    se dividen en fragmentos de páginas que se procesan en paralelo.
+    El contenido nunca se codifica completo en memoria: cada documento
+    referencia su origen y el cuerpo de la petición se genera por partes
+
+    Parámetros:
+        probe: FileProbe con el contenido y su análisis ya realizado
+        file_type: Tipo de archivo ("PDF", "Imagen", "Texto", "YAML")
+        file_name: Nombre del archivo
+        job_id: Identificador del trabajo OCR
+
+    Retorno:
+        tuple: (resultado_directo, fragmentos) donde solo uno de los dos es distinto
+        de None; cada fragmento es un dict con "document" (tipo, mime_type y origen
+        de los datos) y "first_page" (índice de la primera página en PDFs
+        fragmentados, None en los demás casos). En PDFs con capa de texto, un
+        fragmento puede traer ya su "result" con las páginas extraídas localmente
+    """
+    # Para archivos YAML, extraer contenido directamente
+    if file_type == "YAML":
+        try:
+            # Validar que sea YAML válido (reutiliza el análisis de la validación)
+            validation = probe.yaml_validation()
+            if not validation["valid"]:
+                raise ValueError(format_yaml_errors(validation))
+            return {"text": probe.text(), "format": "yaml"}, None
+        except Exception as e:
+            # Si falla la validación YAML, intentar como texto
+            logging.warning(f"Error procesando YAML, tratando como texto: {str(e)}")
+            file_type = "Texto"
+
+    # Guardar una copia (recortada) del archivo si el trabajo está muestreado
+    debug_sink = get_debug_artifact_sink()
+    if debug_sink is not None and debug_sink.should_sample(job_id):
+        probe.spool.seek(0)
+        debug_sink.submit(
+            f"debug_{job_id}_{file_name}", probe.spool.read(debug_sink.max_file_bytes)
+        )
+
+    # Sistema de procesamiento con verificación según tipo
+    if file_type == "PDF":
+        # Verificar que el PDF sea válido
+        try:
+            reader = probe.pdf_reader()
+            page_count = probe.pdf_page_count()
+
+            # Las páginas con capa de texto utilizable no necesitan OCR
+            ocr_pages = list(range(page_count))
+            local_pages = []
+            if PDF_TEXT_LAYER_CONFIG["enabled"]:
+                ocr_pages = []
+                for page_index, text in enumerate(probe.pdf_text_layer()):
+                    if pdf_page_needs_ocr(reader.pages[page_index], text):
+                        ocr_pages.append(page_index)
+                    else:
+                        local_pages.append(
+                            {"number": page_index + 1, "markdown": text.strip()}
+                        )
+            logging.info(
+                f"PDF válido con {page_count} páginas, {len(local_pages)} resueltas con su capa de texto"
+            )
+            local_shard = {
+                "result": {"pages": local_pages, "format": "markdown"},
+                "first_page": local_pages[0]["number"] - 1 if local_pages else None,
+            }
+            if page_count > 0 and not ocr_pages:
+                return _stitch_ocr_shards([local_shard["result"]]), None
+
+            shard_pages = OCR_CONFIG["pdf_shard_pages"]
+            if local_pages or page_count > shard_pages:
+                # Fragmentar para que un timeout solo afecte a unas pocas páginas
+                # y enviar únicamente las páginas que requieren OCR
+                shards = [
+                    {
+                        "document": {
+                            "type": "document_url",
+                            "mime_type": "application/pdf",
+                            "source": shard_file,
+                        },
+                        "first_page": first_page,
+                        "last_page": last_page,
+                    }
+                    for first_page, last_page, shard_file in _split_pdf_into_shards(
+                        reader, shard_pages, ocr_pages
+                    )
+                ]
+                logging.info(f"PDF {file_name}: {len(shards)} fragmentos enviados a OCR")
+                if local_pages:
+                    shards.append(local_shard)
+                return None, shards
+
+            return None, [
+                {
+                    "document": {
+                        "type": "document_url",
+                        "mime_type": "application/pdf",
+                        "source": probe.spool,
+                    },
+                    "first_page": None,
+                }
+            ]
+        except Exception as e:
+            logging.error(f"Error al validar PDF: {str(e)}")
+            return {"error": f"El archivo no es un PDF válido: {str(e)}"}, None
+    elif file_type == "Imagen":
+        # Optimizar imagen para mejores resultados
+        try:
+            probe.spool.seek(0)
+            optimized_data, mime_type = prepare_image_for_ocr(probe.spool)
+            return None, [
+                {
+                    "document": {
+                        "type": "image_url",
+                        "mime_type": mime_type,
+                        "source": optimized_data,
+                    },
+                    "first_page": None,
+                }
+            ]
+        except Exception as e:
+            logging.error(f"Error al procesar imagen: {str(e)}")
+            return {"error": f"El archivo no es una imagen válida: {str(e)}"}, None
+    elif file_type == "Texto":
+        # Para archivos de texto, extraer contenido directamente
+        try:
+            # Intentar leer con diferentes codificaciones
+            try:
+                return {"text": probe.text(), "format": "text"}, None
+            except UnicodeDecodeError:
+                pass
+
+            # Si llegamos aquí, no pudimos decodificar el texto
+            # Enviar como documento plano
+            return None, [
+                {
+                    "document": {
+                        "type": "document_url",
+                        "mime_type": "text/plain",
+                        "source": probe.spool,
+                    },
+                    "first_page": None,
+                }
+            ]
+        except Exception as e:
+            logging.error(f"Error al procesar documento de texto: {str(e)}")
+            return {"error": f"Error al procesar documento de texto: {str(e)}"}, None
+
+    # Tipo de documento no soportado
+    error_msg = f"Tipo de documento no soportado: {file_type}"
+    logging.error(error_msg)
+    return {"error": error_msg}, None
+
+
+async def _request_mistral_ocr_async(
+    http_client, api_key, document, file_name, job_id, report, first_page=None
+):
+    """
+    Envía un documento preparado a la API OCR de Mistral con reintentos
+    ante límite de tasa, timeouts y errores transitorios
+
+    Parámetros:
+        http_client: Cliente httpx.AsyncClient compartido por el lote
+        api_key: API key de Mistral
+        document: Documento preparado por _prepare_ocr_document
+        file_name: Nombre del archivo
+        job_id: Identificador del trabajo OCR
+        report: Función report(mensaje) para informar el progreso del archivo
+        first_page: Índice de la primera página si el documento es un fragmento de PDF
+
+    Retorno:
+        dict: Texto extraído del documento (o sus páginas numeradas si es un
+        fragmento) o descripción del error
+    """
+    # El cuerpo se genera por partes: declarar su tamaño evita la codificación chunked
+    _, _, body_size = _ocr_request_body_parts(document)
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+        "Content-Length": str(body_size),
+    }
+
+    # Registrar payload para depuración (excluyendo contenido base64 por tamaño)
+    debug_payload = {
+        "model": MISTRAL_OCR_MODEL,
+        "document": {
+            "type": document["type"],
+            "content_size": body_size,
+            "content_format": "base64",
+        },
+    }
+    logging.info(f"Payload para OCR: {json.dumps(debug_payload)}")
+
+    debug_sink = get_debug_artifact_sink()
+    if debug_sink is not None and not debug_sink.should_sample(job_id):
+        debug_sink = None
+    debug_name = f"{job_id}_{file_name}"
+    if first_page is not None:
+        debug_name = f"{job_id}_p{first_page + 1}_{file_name}"
+
+    max_retries = OCR_CONFIG["max_retries"]
+    retry_delay = OCR_CONFIG["retry_delay"]
+    last_error = None
+
+    for retry in range(max_retries + 1):
+        try:
+            report("Enviando documento a la API de Mistral...")
+            response = await http_client.post(
+                MISTRAL_OCR_URL,
+                content=_aiter_ocr_request_body(document),
+                headers=headers,
+            )
+
+            logging.info(
+                f"Respuesta de OCR API para {file_name} - Estado: {response.status_code}"
+            )
+
+            if response.status_code == 200:
+                try:
+                    result = response.json()
+                    # Guardar respuesta para depuración (en segundo plano)
+                    if debug_sink is not None:
+                        debug_sink.submit(f"response_{debug_name}.json", result)
+
+                    # Verificar existencia de contenido
+                    if not result:
+                        return {
+                            "error": "La API no devolvió contenido",
+                            "raw_response": str(result),
+                        }
+
+                    # Los fragmentos conservan sus páginas para unirlas en orden
+                    if first_page is not None and isinstance(result.get("pages"), list):
+                        return {
+                            "pages": [
+                                {
+                                    "number": first_page + page.get("index", i) + 1,
+                                    "markdown": page.get("markdown", ""),
+                                }
+                                for i, page in enumerate(result["pages"])
+                            ],
+                            "format": "markdown",
+                        }
+
+                    # Extraer texto de la respuesta
+                    extracted_content = extract_text_from_ocr_response(result)
+
+                    if "error" in extracted_content:
+                        return {
+                            "error": extracted_content["error"],
+                            "raw_response": result,
+                        }
+
+                    return extracted_content
+                except Exception as e:
+                    error_message = f"Error al procesar respuesta JSON: {str(e)}"
+                    logging.error(error_message)
+                    # Guardar respuesta cruda para depuración (en segundo plano)
+                    if debug_sink is not None:
+                        debug_sink.submit(
+                            f"raw_response_{debug_name}.txt", response.text[:10000]
+                        )
+                    report(error_message)
+                    last_error = e
+            elif response.status_code == 429:  # Rate limit
+                if retry < max_retries:
+                    wait_time = retry_delay * (retry + 1)
+                    logging.warning(
+                        f"Rate limit alcanzado. Esperando {wait_time}s antes de reintentar..."
+                    )
+                    report(f"Límite de tasa alcanzado. Reintentando en {wait_time}s...")
+                    await asyncio.sleep(wait_time)
+                    continue
+                else:
+                    error_message = "Límite de tasa alcanzado. No se pudo procesar después de reintentos."
+                    logging.error(error_message)
+                    return {"error": error_message, "raw_response": response.text}
+            else:
+                error_message = f"Error en API OCR ({response.status_code}): {response.text[:500]}"
+                logging.error(error_message)
+                last_error = Exception(error_message)
+                break
+        except httpx.TimeoutException:
+            if retry < max_retries:
+                wait_time = retry_delay * (retry + 1)
+                logging.warning(
+                    f"Timeout al contactar API. Esperando {wait_time}s antes de reintentar..."
+                )
+                report(f"Timeout. Reintentando en {wait_time}s...")
+                await asyncio.sleep(wait_time)
+            else:
+                error_message = "Timeout al contactar API después de múltiples intentos."
+                logging.error(error_message)
+                return {"error": error_message}
+        except Exception as e:
+            if retry < max_retries:
+                wait_time = retry_delay * (retry + 1)
+                logging.warning(
+                    f"Error: {str(e)}. Esperando {wait_time}s antes de reintentar..."
+                )
+                report(f"Error. Reintentando en {wait_time}s...")
+                await asyncio.sleep(wait_time)
+            else:
+                error_message = f"Error al procesar documento: {str(e)}"
+                logging.error(error_message)
+                last_error = e
+                break
+
+    # Si llegamos aquí después de reintentos, devolver último error
+    return {
+        "error": f"Error después de reintentos: {str(last_error)}",
+        "details": traceback.format_exc(),
+    }
+
+
+async def _process_ocr_jobs_async(api_key, jobs, max_concurrency, on_progress):
+    """
+    Ejecuta concurrentemente los trabajos OCR de un lote, limitando
+    el número de peticiones simultáneas con un semáforo
+
+    Parámetros:
+        api_key: API key de Mistral
+        jobs: Lista de trabajos (dict con index, document, file_name, job_id y first_page)
+        max_concurrency: Máximo de peticiones simultáneas
+        on_progress: Función on_progress(trabajo, estado, mensaje)
+
+    Retorno:
+        list: Resultados en el mismo orden que jobs
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async with httpx.AsyncClient(
+        timeout=httpx.Timeout(OCR_CONFIG["timeout"]),
+        limits=httpx.Limits(max_connections=max_concurrency),
+    ) as http_client:
+
+        async def run_job(job):
+            def report(message):
+                on_progress(job, "running", message)
+
+            try:
+                async with semaphore:
+                    result = await _request_mistral_ocr_async(
+                        http_client,
+                        api_key,
+                        job["document"],
+                        job["file_name"],
+                        job["job_id"],
+                        report,
+                        first_page=job["first_page"],
+                    )
+            except Exception as e:
+                logging.error(
+                    f"Error general al procesar {job['file_name']}: {str(e)}"
+                )
+                result = {"error": f"Error general al procesar documento: {str(e)}"}
+
+            if "error" in result:
+                on_progress(job, "error", result["error"])
+            else:
+                on_progress(job, "complete", "procesado exitosamente")
+            return result
+
+        return await asyncio.gather(*(run_job(job) for job in jobs))
+
+
+@handle_error(max_retries=0)
+def process_documents_with_mistral_ocr(api_key, files, max_concurrency=None):
+    """
+    Procesa un lote de documentos con OCR de Mistral de forma concurrente,
+    mostrando el progreso de cada archivo en un panel de estado
+
+    Parámetros:
+        api_key: API key de Mistral
+        files: Lista de tuplas (archivo, file_type, file_name), donde archivo son
+            bytes, un archivo cargado (file-like) que se copia a disco por bloques
+            o un FileProbe ya analizado (p. ej. por validate_file_format)
+        max_concurrency: Máximo de peticiones simultáneas a la API, contando
+            cada fragmento de PDF como una petición (por defecto, el de OCR_CONFIG)
+
+    Retorno:
+        list: Resultados (dict) en el mismo orden de carga de los archivos
+    """
+    max_concurrency = max_concurrency or OCR_CONFIG["max_concurrency"]
+    results = [None] * len(files)
+    icons = {"running": "⏳", "complete": "✅", "error": "❌"}
+
+    with st.status(
+        f"Procesando {len(files)} documento(s)...", expanded=True
+    ) as status, contextlib.ExitStack() as open_files:
+        lines = [status.empty() for _ in files]
+        jobs = []
+        shard_totals = {}
+        sharded_files = set()
+        cache = get_ocr_result_cache()
+        cache_keys = {}
+        local_results = {}  # índice -> páginas extraídas de la capa de texto
+
+        status.update(label="Preparando documentos para OCR...", state="running")
+        for index, (file_source, file_type, file_name) in enumerate(files):
+            # Copiar a un archivo temporal respetando el límite de tamaño
+            # (salvo que ya sea un FileProbe, cuyo cierre corresponde al llamador)
+            try:
+                probe = open_files.enter_context(FileProbe.scope(file_source))
+            except ValueError as e:
+                results[index] = {"error": str(e)}
+                lines[index].markdown(f"❌ **{file_name}**: {str(e)}")
+                continue
+
+            # Un acierto en caché evita codificación, depuración y llamada a la API
+            if cache is not None and file_type in ("PDF", "Imagen"):
+                cache_keys[index] = OCRResultCache.make_key(
+                    probe, MISTRAL_OCR_MODEL, {"file_type": file_type}
+                )
+                cached_result = cache.get(cache_keys[index])
+                if cached_result is not None:
+                    logging.info(f"Resultado OCR de {file_name} recuperado de caché")
+                    results[index] = cached_result
+                    lines[index].markdown(f"✅ **{file_name}**: recuperado de caché")
+                    continue
+
+            job_id = str(uuid.uuid4())
+            logging.info(
+                f"Procesando documento {file_name} con Mistral OCR (ID: {job_id})"
+            )
+            lines[index].markdown(f"⏳ **{file_name}**: preparando documento...")
+
+            try:
+                direct_result, shards = _prepare_ocr_document(
+                    probe, file_type, file_name, job_id
+                )
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                direct_result = {"error": f"Error general al procesar documento: {str(e)}"}
+                shards = None
+
+            if direct_result is not None:
+                results[index] = direct_result
+                state = "error" if "error" in direct_result else "complete"
+                message = direct_result.get("error", "procesado localmente")
+                lines[index].markdown(f"{icons[state]} **{file_name}**: {message}")
+                if index in cache_keys and state == "complete":
+                    cache.put(cache_keys[index], direct_result)
+                continue
+
+            if shards[0]["first_page"] is not None:
+                sharded_files.add(index)
+            for shard in shards:
+                if "result" in shard:
+                    local_results.setdefault(index, []).append(shard["result"])
+                    continue
+                source = shard["document"]["source"]
+                if hasattr(source, "close") and source is not probe.spool:
+                    open_files.enter_context(source)
+                jobs.append(
+                    dict(shard, index=index, file_name=file_name, job_id=job_id)
+                )
+            shard_totals[index] = len(shards) - len(local_results.get(index, []))
+
+        if jobs:
+            shards_done = {index: 0 for index in shard_totals}
+            files_done = [len(files) - len(shard_totals)]
+
+            def on_progress(job, state, message):
+                index = job["index"]
+                total = shard_totals[index]
+                if state != "running":
+                    shards_done[index] += 1
+                    if shards_done[index] == total:
+                        files_done[0] += 1
+                        status.update(
+                            label=f"Procesando documentos con OCR ({files_done[0]}/{len(files)})...",
+                            state="running",
+                        )
+                if index in sharded_files:
+                    # El estado final se muestra al unir los fragmentos; los
+                    # reintentos pueden superar el total de fragmentos
+                    done = min(shards_done[index], total)
+                    message = f"{done}/{total} fragmentos procesados - {message}"
+                    state = "running"
+                lines[index].markdown(f"{icons[state]} **{files[index][2]}**: {message}")
+
+            status.update(
+                label=f"Enviando {len(shard_totals)} documento(s) a la API de Mistral...",
+                state="running",
+            )
+            job_results = asyncio.run(
+                _process_ocr_jobs_async(api_key, jobs, max_concurrency, on_progress)
+            )
+
+            # Reintentar únicamente los fragmentos de PDF que fallaron
+            for _ in range(OCR_CONFIG["shard_retry_rounds"]):
+                failed_positions = [
+                    position
+                    for position, (job, result) in enumerate(zip(jobs, job_results))
+                    if job["first_page"] is not None and "error" in result
+                ]
+                if not failed_positions:
+                    break
+                logging.warning(
+                    f"Reintentando {len(failed_positions)} fragmentos de PDF fallidos"
+                )
+                retry_results = asyncio.run(
+                    _process_ocr_jobs_async(
+                        api_key,
+                        [jobs[position] for position in failed_positions],
+                        max_concurrency,
+                        on_progress,
+                    )
+                )
+                for position, result in zip(failed_positions, retry_results):
+                    job_results[position] = result
+
+            # Agrupar resultados por archivo manteniendo el orden de páginas
+            file_shards = {
+                index: list(local_results.get(index, [])) for index in shard_totals
+            }
+            for job, result in zip(jobs, job_results):
+                if job["first_page"] is not None:
+                    result = dict(
+                        result, page_range=(job["first_page"] + 1, job["last_page"])
+                    )
+                file_shards[job["index"]].append(result)
+
+            for index, shard_results in file_shards.items():
+                if index not in sharded_files:
+                    result = shard_results[0]
+                else:
+                    result = _stitch_ocr_shards(shard_results)
+                    state = "error" if "error" in result else "complete"
+                    message = result.get("error", "procesado exitosamente")
+                    lines[index].markdown(
+                        f"{icons[state]} **{files[index][2]}**: {message}"
+                    )
+                results[index] = result
+                if index in cache_keys and "error" not in result:
+                    cache.put(cache_keys[index], result)
+
+        if cache is not None and cache_keys:
+            logging.info(f"Estadísticas de caché OCR: {cache.stats()}")
+
+        failed = sum(1 for result in results if "error" in result)
+        if failed:
+            status.update(
+                label=f"{len(files) - failed}/{len(files)} documento(s) procesados, {failed} con errores",
+                state="error",
+            )
+        else:
+            status.update(
+                label=f"{len(files)} documento(s) procesados exitosamente",
+                state="complete",
+            )
+
+    return results
+
+
+@handle_error(max_retries=1)
+def process_document_with_mistral_ocr(api_key, file_bytes, file_type, file_name):
+    """
+    Procesa un documento con OCR de Mistral
+    con sistema de recuperación ante fallos
+
+    Parámetros:
+        api_key: API key de Mistral
+        file_bytes: Bytes del archivo, archivo cargado (file-like) o FileProbe
+        file_type: Tipo de archivo ("PDF", "Imagen", "Texto", "YAML")
+        file_name: Nombre del archivo
+
+    Retorno:
+        dict: Texto extraído del documento
+    """
+    # Un único archivo, pero sus fragmentos de PDF se envían en paralelo
+    # con el límite general de OCR_CONFIG["max_concurrency"]
+    results = process_documents_with_mistral_ocr(
+        api_key, [(file_bytes, file_type, file_name)]
+    )
+    if not results:
+        return {"error": f"Error general al procesar documento {file_name}"}
+    return results[0]
+
+
+# Función segura para gestionar el contexto de documentos
+@handle_error(max_retries=0)
+def manage_document_context():
+    """
+    Permite al usuario gestionar qué documentos mantener en el contexto actual
+    con manejo seguro de actualización de estado
+    """
+    if "document_contents" in st.session_state and st.session_state.document_contents:
+        st.write("Documentos en contexto actual:")
+
+        # Crear checkboxes para cada documento
+        docs_to_keep = {}
+        for doc_name in st.session_state.document_contents:
+            docs_to_keep[doc_name] = st.checkbox(
+                f"{doc_name}", value=True, key=f"keep_{doc_name}"
+            )
+
+        # Botón para aplicar cambios
+        if st.button("Actualizar contexto", key="update_context"):
+            # Eliminar documentos no seleccionados
+            docs_to_remove = [doc for doc, keep in docs_to_keep.items() if not keep]
+            if docs_to_remove:
+                for doc in docs_to_remove:
+                    forget_document_content(doc)
+                    if doc in st.session_state.uploaded_files:
+                        st.session_state.uploaded_files.remove(doc)
+
+                st.success(
+                    f"Se eliminaron {len(docs_to_remove)} documentos del contexto."
+                )
+                # Usar sistema seguro de reinicio
+                rerun_app()
+            else:
+                st.info("No se seleccionaron documentos para eliminar.")
+    else:
+        st.info("No hay documentos cargados en el contexto actual.")
+
+
+# Configuración de la recuperación de fragmentos relevantes de documentos
+DOCUMENT_RETRIEVAL_CONFIG = {
+    "chunk_chars": 1200,  # Tamaño objetivo de cada fragmento indexado
+    "top_k": 6,  # Fragmentos relevantes recuperados por consulta
+    "max_context_chars": 6000,  # Presupuesto de caracteres de contexto por mensaje
+    "yaml_max_blocks": 8,  # Bloques de entrevista enviados por variables mencionadas
+    "bm25_k1": 1.5,
+    "bm25_b": 0.75,
+}
+
+# Tokenización: palabras normalizadas sin tildes y sin palabras vacías frecuentes
+_TOKEN_PATTERN = re.compile(r"[^\W_]+", re.UNICODE)
+_ACCENT_TABLE = str.maketrans("áéíóúüàèìòùâêîôûñç", "aeiouuaeiouaeiounc")
+_STOPWORDS = frozenset(
+    """
+    a al algo como con de del el ella en es esta este esto la las lo los me mi
+    no o para pero por que se si sin su sus te tu un una uno y ya
+    an and are as at be by for from in is it of on or that the this to with
+    """.split()
+)
+
+
+def tokenize_for_search(text):
+    """Divide un texto en términos normalizados para el índice de búsqueda"""
+    return [
+        token
+        for token in _TOKEN_PATTERN.findall(text.lower().translate(_ACCENT_TABLE))
+        if len(token) > 1 and token not in _STOPWORDS
+    ]
+
+
+def chunk_document_text(text, chunk_chars=None):
+    """
+    Divide el texto de un documento en fragmentos de tamaño similar,
+    respetando los límites de párrafo siempre que sea posible
+
+    Retorno:
+        list: Fragmentos de texto en orden
+    """
+    chunk_chars = chunk_chars or DOCUMENT_RETRIEVAL_CONFIG["chunk_chars"]
+    chunks = []
+    current = []
+    current_size = 0
+
+    for paragraph in text.split("\n\n"):
+        if not paragraph.strip():
+            continue
+        # Párrafos más largos que un fragmento se cortan a tamaño fijo
+        pieces = [
+            paragraph[i : i + chunk_chars]
+            for i in range(0, len(paragraph), chunk_chars)
+        ]
+        for piece in pieces:
+            if current and current_size + len(piece) > chunk_chars:
+                chunks.append("\n\n".join(current))
+                current, current_size = [], 0
+            current.append(piece)
+            current_size += len(piece) + 2
+
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+class BM25Index:
+    """
+    Índice invertido BM25 en memoria sobre fragmentos de documentos,
+    con altas y bajas incrementales por documento
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # término -> {id_fragmento: frecuencia}
+        self.chunks = {}  # id_fragmento -> datos del fragmento
+        self.doc_chunks = {}  # nombre_documento -> [id_fragmento]
+        self.total_length = 0
+
+    def add_document(self, doc_name, chunks, key="", labels=None):
+        """
+        Indexa los fragmentos de un documento, reemplazando su versión previa.
+        Las etiquetas opcionales describen cada fragmento al presentarlo
+
+        Retorno:
+            list: Identificadores de los fragmentos indexados, en orden
+        """
+        self.remove_document(doc_name)
+        chunk_ids = []
+        for position, text in enumerate(chunks):
+            chunk_id = f"{doc_name}#{key}#{position}"
+            terms = tokenize_for_search(text)
+            frequencies = {}
+            for term in terms:
+                frequencies[term] = frequencies.get(term, 0) + 1
+            for term, frequency in frequencies.items():
+                self.postings.setdefault(term, {})[chunk_id] = frequency
+
+            self.chunks[chunk_id] = {
+                "doc_name": doc_name,
+                "position": position,
+                "count": len(chunks),
+                "text": text,
+                "label": labels[position] if labels else None,
+                "length": len(terms),
+                "terms": tuple(frequencies),
+            }
+            self.total_length += len(terms)
+            chunk_ids.append(chunk_id)
+
+        self.doc_chunks[doc_name] = chunk_ids
+        return chunk_ids
+
+    def remove_document(self, doc_name):
+        """Elimina del índice todos los fragmentos de un documento"""
+        for chunk_id in self.doc_chunks.pop(doc_name, []):
+            chunk = self.chunks.pop(chunk_id)
+            self.total_length -= chunk["length"]
+            for term in chunk["terms"]:
+                postings = self.postings.get(term)
+                if postings is not None:
+                    postings.pop(chunk_id, None)
+                    if not postings:
+                        del self.postings[term]
+
+    def search(self, query, top_k=5, exclude=()):
+        """
+        Devuelve los fragmentos más relevantes para la consulta
+
+        Parámetros:
+            query: Texto de la consulta
+            top_k: Número máximo de resultados
+            exclude: Identificadores de fragmentos a omitir
+
+        Retorno:
+            list: Tuplas (id_fragmento, puntuación) ordenadas por relevancia
+        """
+        chunk_count = len(self.chunks)
+        if not chunk_count:
+            return []
+
+        avg_length = self.total_length / chunk_count or 1.0
+        k1, b = self.k1, self.b
+        scores = {}
+        for term in set(tokenize_for_search(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (chunk_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, frequency in postings.items():
+                norm = k1 * (1 - b + b * self.chunks[chunk_id]["length"] / avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * frequency * (
+                    k1 + 1
+                ) / (frequency + norm)
+
+        candidates = (
+            (chunk_id, score) for chunk_id, score in scores.items() if chunk_id not in exclude
+        )
+        return heapq.nlargest(top_k, candidates, key=lambda item: item[1])
+
+
+def get_document_index():
+    """Devuelve el índice de búsqueda de documentos de la sesión actual"""
+    if "document_index" not in st.session_state:
+        st.session_state.document_index = BM25Index(
+            k1=DOCUMENT_RETRIEVAL_CONFIG["bm25_k1"],
+            b=DOCUMENT_RETRIEVAL_CONFIG["bm25_b"],
+        )
+    return st.session_state.document_index
+
+
+# Tipos de bloque de docassemble según la clave que los identifica, en orden de prioridad
+DOCASSEMBLE_BLOCK_KEYS = [
+    ("mandatory", ("mandatory",)),
+    ("question", ("question",)),
+    ("code", ("code",)),
+    ("objects", ("objects",)),
+    ("attachment", ("attachment", "attachments")),
+    ("metadata", ("metadata",)),
+    ("include", ("include",)),
+    ("features", ("features",)),
+    ("modules", ("modules", "imports")),
+    ("template", ("template",)),
+    ("table", ("table",)),
+]
+
+# Claves de un bloque cuyos valores son expresiones o código Python
+_DOCASSEMBLE_EXPRESSION_KEYS = frozenset(
+    ["code", "show if", "hide if", "js show if", "js hide if", "enable if",
+     "disable if", "validation code", "if", "need", "depends on", "reconsider"]
+)
+
+# Separador de documentos: admite comentarios o etiquetas tras "---" ("--- # sección")
+_YAML_SEPARATOR = re.compile(r"^---(?:\s|$)", re.MULTILINE)
+_VARIABLE_PATTERN = re.compile(
+    r"(?<![\w.'\"])([A-Za-z_]\w*(?:\[[^\]\n]{1,40}\])*(?:\.[A-Za-z_]\w*(?:\[[^\]\n]{1,40}\])*)*)"
+)
+_MAKO_EXPRESSION = re.compile(r"\$\{\s*(.+?)\s*\}")
+_MAKO_CONTROL_LINE = re.compile(r"^\s*%\s*(?:if|elif|for|while)\b(.*)$", re.MULTILINE)
+_PYTHON_KEYWORDS = frozenset(
+    keyword.kwlist
+    + ["True", "False", "None", "str", "int", "len", "float", "list", "dict", "set",
+       "range", "any", "all", "sum", "min", "max", "format_date", "today", "word",
+       "url_of", "user_info", "space_to_underscore", "currency", "defined",
+       "showifdef", "nice_number", "noun_plural", "comma_and_list", "force_ask",
+       "value", "action_button_html", "i", "j", "k", "x", "y"]
+)
+
+
+def _normalize_variable(name):
+    """Reemplaza los índices de una variable por [i] para agrupar sus usos"""
+    return re.sub(r"\[[^\]]*\]", "[i]", name)
+
+
+def _expression_variables(expression):
+    """
+    Devuelve las variables candidatas referenciadas en una expresión corta
+    (plantillas Mako, consultas); el código de los bloques se analiza con
+    _code_variables
+    """
+    variables = set()
+    for match in _VARIABLE_PATTERN.finditer(expression):
+        name = _normalize_variable(match.group(1))
+        root = name.split(".", 1)[0].split("[", 1)[0]
+        if root in _PYTHON_KEYWORDS:
+            continue
+        # Descartar llamadas a métodos al final (cliente.name.full() -> cliente.name)
+        end = match.end()
+        if end < len(expression) and expression[end] == "(" and "." in name:
+            name = name.rsplit(".", 1)[0]
+        elif end < len(expression) and expression[end] == "(":
+            continue
+        variables.add(name)
+    return variables
+
+
+class _CodeVariableVisitor(ast.NodeVisitor):
+    """
+    Recorre el árbol sintáctico de un bloque de código y separa las variables
+    de la entrevista que define y usa de los nombres locales del propio código
+    (bucles, comprensiones, except/with ... as, argumentos, imports y funciones)
+    """
+
+    def __init__(self):
+        self.defines = set()
+        self.uses = set()
+        self.local_names = set()
+        self._function_depth = 0
+
+    @staticmethod
+    def _reference(node):
+        """
+        Devuelve el nombre de una referencia (cliente.name.first,
+        personas[i].name) y los nodos de sus índices, o None si no parte
+        de un nombre
+        """
+        parts, indexes = [], []
+        while True:
+            if isinstance(node, ast.Attribute):
+                parts.append("." + node.attr)
+                node = node.value
+            elif isinstance(node, ast.Subscript):
+                parts.append("[i]")
+                indexes.append(node.slice)
+                node = node.value
+            elif isinstance(node, ast.Name):
+                parts.append(node.id)
+                return "".join(reversed(parts)), indexes
+            else:
+                return None, [node] + indexes
+
+    def _use(self, node):
+        name, others = self._reference(node)
+        if name is not None:
+            self.uses.add(name)
+        for other in others:
+            self.visit(other)
+
+    def _bind_local(self, target):
+        """Anota como locales los nombres de un destino (for, with, except, ...)"""
+        for node in ast.walk(target):
+            if isinstance(node, ast.Name):
+                self.local_names.add(node.id)
+
+    def _bind(self, target):
+        """Anota el destino de una asignación como variable definida o local"""
+        if isinstance(target, (ast.Tuple, ast.List)):
+            for element in target.elts:
+                self._bind(element)
+            return
+        if isinstance(target, ast.Starred):
+            self._bind(target.value)
+            return
+        name, others = self._reference(target)
+        if name is not None:
+            if self._function_depth:
+                self.local_names.add(name.split(".", 1)[0].split("[", 1)[0])
+            else:
+                self.defines.add(name)
+        for other in others:
+            self.visit(other)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.uses.add(node.id)
+
+    def visit_Attribute(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self._use(node)
+        else:
+            self._bind(node)
+
+    visit_Subscript = visit_Attribute
+
+    def visit_Call(self, node):
+        # Una llamada a método usa el objeto (cliente.name.full() -> cliente.name);
+        # las llamadas a funciones no son variables de la entrevista
+        if isinstance(node.func, ast.Attribute):
+            self._use(node.func.value)
+        elif not isinstance(node.func, ast.Name):
+            self.visit(node.func)
+        for argument in node.args:
+            self.visit(argument)
+        for keyword_argument in node.keywords:
+            self.visit(keyword_argument.value)
+
+    def visit_Assign(self, node):
+        self.visit(node.value)
+        for target in node.targets:
+            self._bind(target)
+
+    def visit_AugAssign(self, node):
+        self.visit(node.value)
+        self._bind(node.target)
+
+    def visit_AnnAssign(self, node):
+        if node.value is not None:
+            self.visit(node.value)
+            self._bind(node.target)
+
+    def visit_NamedExpr(self, node):
+        self.visit(node.value)
+        self._bind(node.target)
+
+    def visit_For(self, node):
+        self._bind_local(node.target)
+        self.visit(node.iter)
+        for statement in node.body + node.orelse:
+            self.visit(statement)
+
+    visit_AsyncFor = visit_For
+
+    def visit_comprehension(self, node):
+        self._bind_local(node.target)
+        self.visit(node.iter)
+        for condition in node.ifs:
+            self.visit(condition)
+
+    def visit_withitem(self, node):
+        self.visit(node.context_expr)
+        if node.optional_vars is not None:
+            self._bind_local(node.optional_vars)
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self.local_names.add(node.name)
+        self.generic_visit(node)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.local_names.add(alias.asname or alias.name.split(".", 1)[0])
+
+    visit_ImportFrom = visit_Import
+
+    def visit_arguments(self, node):
+        for argument in node.posonlyargs + node.args + node.kwonlyargs:
+            self.local_names.add(argument.arg)
+        for argument in (node.vararg, node.kwarg):
+            if argument is not None:
+                self.local_names.add(argument.arg)
+        for default in node.defaults + [d for d in node.kw_defaults if d is not None]:
+            self.visit(default)
+
+    def visit_FunctionDef(self, node):
+        self.local_names.add(node.name)
+        for decorator in node.decorator_list:
+            self.visit(decorator)
+        self.visit(node.args)
+        self._function_depth += 1
+        for statement in node.body:
+            self.visit(statement)
+        self._function_depth -= 1
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        self.visit(node.args)
+        self._function_depth += 1
+        self.visit(node.body)
+        self._function_depth -= 1
+
+    def visit_ClassDef(self, node):
+        self.local_names.add(node.name)
+        self._function_depth += 1
+        self.generic_visit(node)
+        self._function_depth -= 1
+
+
+_BUILTIN_NAMES = frozenset(dir(builtins))
+
+
+def _code_variables(code):
+    """
+    Analiza código Python de un bloque (code, validation code, show if, ...)
+    con ast, de modo que comentarios, cadenas, argumentos con nombre y
+    nombres locales no se confunden con variables de la entrevista
+
+    Parámetros:
+        code: Código o expresión Python
+
+    Retorno:
+        tuple | None: (definidas, usadas, locales) normalizadas, o None si
+        el código no compila
+    """
+    try:
+        tree = ast.parse(textwrap.dedent(code))
+    except (SyntaxError, ValueError):
+        return None
+    visitor = _CodeVariableVisitor()
+    visitor.visit(tree)
+
+    ignored = visitor.local_names | _BUILTIN_NAMES | _PYTHON_KEYWORDS
+    uses = set()
+    for name in visitor.uses:
+        if name.split(".", 1)[0].split("[", 1)[0] not in ignored:
+            uses.add(_normalize_variable(name))
+    defines = {_normalize_variable(name) for name in visitor.defines}
+    return defines, uses, visitor.local_names
+
+
+def _text_variables(text):
+    """Devuelve las variables usadas en las plantillas Mako de un texto"""
+    variables = set()
+    for match in _MAKO_EXPRESSION.finditer(text):
+        variables |= _expression_variables(match.group(1))
+    for match in _MAKO_CONTROL_LINE.finditer(text):
+        variables |= _expression_variables(match.group(1))
+    return variables
+
+
+# Opciones de un campo que no son la etiqueta del campo
+DOCASSEMBLE_FIELD_OPTIONS = frozenset(
+    ["datatype", "input type", "required", "default", "choices", "code", "hint",
+     "help", "show if", "hide if", "js show if", "js hide if", "label", "field",
+     "min", "max", "minlength", "maxlength", "note", "html", "validate",
+     "exclude", "none of the above", "shuffle", "address autocomplete",
+     "disable others", "uncheck others", "under text", "step", "scale",
+     "accept", "rows", "maximage", "object labeler", "help generator",
+     "image upload", "css class", "enable if", "disable if"]
+)
+
+
+def _field_variable(field):
+    """Devuelve la variable que define una entrada de la lista fields, si la hay"""
+    if not isinstance(field, dict):
+        return None
+    if isinstance(field.get("field"), str):
+        return field["field"]
+    # Forma abreviada: "Etiqueta": variable
+    for key, value in field.items():
+        if isinstance(value, str) and key not in DOCASSEMBLE_FIELD_OPTIONS:
+            return value
+    return None
+
+
+def _collect_block_variables(data, defines, uses):
+    """Recorre un bloque analizado y anota las variables que define y usa"""
+    for key, value in data.items():
+        if key == "fields" and isinstance(value, list):
+            for field in value:
+                name = _field_variable(field)
+                if name:
+                    defines.add(_normalize_variable(name))
+                if isinstance(field, dict):
+                    _collect_block_variables(field, set(), uses)
+        elif key in ("field", "sets", "event") and isinstance(value, str):
+            defines.add(_normalize_variable(value))
+        elif key == "sets" and isinstance(value, list):
+            defines.update(_normalize_variable(v) for v in value if isinstance(v, str))
+        elif key == "objects" and isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    for name, class_name in item.items():
+                        defines.add(_normalize_variable(str(name)))
+                        if isinstance(class_name, str):
+                            uses |= _text_variables(class_name)
+        elif key in _DOCASSEMBLE_EXPRESSION_KEYS and isinstance(value, str):
+            # Código Python: se analiza con ast; si no compila se omite
+            variables = _code_variables(value)
+            if variables is not None:
+                if key == "code":
+                    defines |= variables[0]
+                uses |= variables[1]
+        elif isinstance(value, str):
+            uses |= _text_variables(value)
+        elif isinstance(value, dict):
+            _collect_block_variables(value, defines, uses)
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    _collect_block_variables(item, defines, uses)
+                elif isinstance(item, str):
+                    uses |= _text_variables(item)
+
+
+def _docassemble_flag_enabled(value):
+    """
+    Indica si un modificador como mandatory o initial puede activarse: solo
+    False (o la expresión "False") lo desactiva; una expresión Python se
+    evalúa al ejecutar la entrevista y puede ser verdadera
+    """
+    if isinstance(value, str):
+        return value.strip() != "False"
+    return value is not False and value is not None
+
+
+def classify_docassemble_block(data):
+    """Devuelve el tipo de un bloque de docassemble a partir de sus claves"""
+    if not isinstance(data, dict):
+        return "other"
+    for block_type, keys in DOCASSEMBLE_BLOCK_KEYS:
+        if any(key in data for key in keys):
+            if block_type == "mandatory" and not _docassemble_flag_enabled(
+                data.get("mandatory")
+            ):
+                continue
+            return block_type
+    return "other"
+
+
+def is_docassemble_entry_point(data):
+    """
+    Indica si un bloque hace avanzar la entrevista por sí solo: un bloque
+    mandatory (True o una expresión) o un bloque initial
+    """
+    if not isinstance(data, dict):
+        return False
+    return any(
+        key in data and _docassemble_flag_enabled(data[key])
+        for key in ("mandatory", "initial")
+    )
+
+
+# Motor de validación de YAML (entrevistas con varios documentos ---)
+YAML_VALIDATION_CONFIG = {
+    "max_bytes": 10 * 1024 * 1024,  # Tamaño máximo del archivo
+    "max_documents": 5000,  # Bloques (documentos) por archivo
+    "max_depth": 64,  # Anidamiento máximo de listas y diccionarios
+    "max_nodes": 1000000,  # Nodos por bloque, contando los alias ya expandidos
+    "cache_entries": 16,  # Resultados guardados por hash del contenido
+}
+
+
+def _yaml_limited_loader(max_depth, max_nodes):
+    """
+    Construye un cargador YAML seguro que limita el anidamiento y el número
+    de nodos de cada documento (los alias cuentan con su tamaño expandido,
+    lo que detiene ataques del tipo "billion laughs"). Usa el analizador en C
+    de libyaml si está disponible; la composición se hace en Python porque
+    la versión en C es recursiva y un anidamiento extremo agota la pila
+    """
+    import yaml
+    from yaml.composer import Composer, ComposerError
+    from yaml.constructor import SafeConstructor
+    from yaml.events import AliasEvent
+    from yaml.resolver import Resolver
+
+    if getattr(yaml, "__with_libyaml__", False):
+        from yaml.cyaml import CParser
+
+        class ParserBase(Composer, SafeConstructor, Resolver, CParser):
+            def __init__(self, stream):
+                CParser.__init__(self, stream)
+                Composer.__init__(self)
+                SafeConstructor.__init__(self)
+                Resolver.__init__(self)
+
+    else:
+        ParserBase = yaml.SafeLoader
+
+    class LimitedLoader(ParserBase):
+        def __init__(self, stream):
+            super().__init__(stream)
+            self._depth = 0
+            self._nodes = 0
+            self._anchor_nodes = {}
+
+        def _count_nodes(self, amount, event):
+            self._nodes += amount
+            if self._nodes > max_nodes:
+                raise ComposerError(
+                    None, None, f"el bloque supera {max_nodes} nodos", event.start_mark
+                )
+
+        def compose_document(self):
+            self._depth = 0
+            self._nodes = 0
+            self._anchor_nodes = {}
+            return super().compose_document()
+
+        def compose_node(self, parent, index):
+            event = self.peek_event()
+            if self.check_event(AliasEvent):
+                self._count_nodes(self._anchor_nodes.get(event.anchor, 1), event)
+                return super().compose_node(parent, index)
+
+            if self._depth >= max_depth:
+                raise ComposerError(
+                    None, None, f"anidamiento superior a {max_depth} niveles", event.start_mark
+                )
+            start = self._nodes
+            self._count_nodes(1, event)
+            self._depth += 1
+            node = super().compose_node(parent, index)
+            self._depth -= 1
+            if event.anchor is not None:
+                self._anchor_nodes[event.anchor] = self._nodes - start
+            return node
+
+    LimitedLoader.engine = "libyaml" if ParserBase is not yaml.SafeLoader else "python"
+    return LimitedLoader
+
+
+class YamlValidationCache:
+    """
+    Caché en memoria de resultados de validate_yaml_content por hash del
+    contenido, compartida entre sesiones, con expulsión LRU por entradas
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.counters = {"hits": 0, "misses": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return result
+
+    def put(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries))
+
+
+@st.cache_resource(show_spinner=False)
+def get_yaml_validation_cache():
+    """Devuelve la caché de validaciones YAML compartida"""
+    return YamlValidationCache(YAML_VALIDATION_CONFIG["cache_entries"])
+
+
+def validate_yaml_content(yaml_content):
+    """
+    Valida un archivo YAML de varios documentos (separados por ---) en un
+    único recorrido; si hay errores, lo analiza bloque a bloque para informar
+    la línea de cada uno sin que un bloque inválido impida procesar el resto.
+    Aplica límites de tamaño, número de bloques, anidamiento y nodos, y guarda
+    el resultado por hash del contenido para que cada archivo se analice una
+    sola vez
+
+    Parámetros:
+        yaml_content: Texto del archivo YAML
+
+    Retorno:
+        dict: "valid", "blocks" (cada uno con "text", "line" de inicio (base 1),
+        "first_line" con contenido, "data" y "error"), "errors" ({"line",
+        "message"}), "engine" y "elapsed_ms". El resultado es compartido y
+        no debe modificarse
+    """
+    config = YAML_VALIDATION_CONFIG
+    encoded = yaml_content.encode("utf-8")
+    cache = get_yaml_validation_cache()
+    key = hashlib.sha256(encoded).hexdigest()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    start = time.perf_counter()
+    loader_class = _yaml_limited_loader(config["max_depth"], config["max_nodes"])
+    result = {"valid": True, "blocks": [], "errors": [], "engine": loader_class.engine}
+    if len(encoded) > config["max_bytes"]:
+        result["errors"].append(
+            {
+                "line": 1,
+                "message": f"el archivo supera {config['max_bytes'] // (1024 * 1024)} MB",
+            }
+        )
+
+    pending = []  # (texto, primera_línea)
+    if not result["errors"]:
+        current, current_line = [], 1
+        for number, text_line in enumerate(yaml_content.splitlines(), start=1):
+            if _YAML_SEPARATOR.match(text_line):
+                pending.append(("\n".join(current), current_line))
+                # El resto de la línea (una etiqueta o un valor) abre el bloque
+                # siguiente; un comentario no aporta contenido
+                rest = text_line[3:].strip()
+                if rest and not rest.startswith("#"):
+                    current, current_line = [rest], number
+                else:
+                    current, current_line = [], number + 1
+            else:
+                current.append(text_line)
+        pending.append(("\n".join(current), current_line))
+
+    segments = []  # (texto, primera_línea) de los bloques con contenido
+    for text, block_line in pending:
+        if all(not l.strip() or l.lstrip().startswith("#") for l in text.splitlines()):
+            continue
+        if len(segments) >= config["max_documents"]:
+            result["errors"].append(
+                {
+                    "line": block_line,
+                    "message": f"el archivo supera {config['max_documents']} bloques",
+                }
+            )
+            break
+        segments.append((text, block_line))
+
+    for text, block_line in segments:
+        result["blocks"].append(
+            {
+                "text": text.strip("\n"),
+                "line": block_line,
+                "first_line": block_line + len(text) - len(text.lstrip("\n")),
+                "data": None,
+                "error": None,
+            }
+        )
+
+    if result["blocks"] and not result["errors"]:
+        # Camino rápido: todo el archivo en un único flujo; cada documento se
+        # asigna a su bloque por la línea en que empieza
+        starts = [block["line"] for block in result["blocks"]]
+        assigned = set()
+        loader = loader_class(yaml_content)
+        try:
+            while loader.check_node():
+                node = loader.get_node()
+                position = bisect.bisect_right(starts, node.start_mark.line + 1) - 1
+                data = loader.construct_document(node)
+                if position < 0 or (data is None and node.tag.endswith(":null")):
+                    continue  # Documento vacío (solo comentarios)
+                if position in assigned:
+                    raise ValueError("varios documentos en un mismo bloque")
+                assigned.add(position)
+                result["blocks"][position]["data"] = data
+            fast_path = len(assigned) == len(result["blocks"])
+        except Exception:
+            fast_path = False
+        finally:
+            loader.dispose()
+
+        if not fast_path:
+            # Con errores se analiza bloque a bloque para localizarlos todos
+            for block, (text, block_line) in zip(result["blocks"], segments):
+                loader = loader_class(text)
+                try:
+                    block["data"] = loader.get_single_data()
+                    block["error"] = None
+                except Exception as e:
+                    mark = getattr(e, "problem_mark", None)
+                    block["data"] = None
+                    block["error"] = {
+                        "message": str(getattr(e, "problem", None) or e),
+                        "line": block_line + mark.line
+                        if mark is not None
+                        else block["first_line"],
+                    }
+                    result["errors"].append(block["error"])
+                finally:
+                    loader.dispose()
+
+    result["valid"] = not result["errors"]
+    result["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    cache.put(key, result)
+    return result
+
+
+def format_yaml_errors(validation, limit=3):
+    """Resume los errores de validate_yaml_content en una línea de texto"""
+    errors = validation["errors"]
+    summary = "; ".join(
+        f"línea {error['line']}: {error['message']}" for error in errors[:limit]
+    )
+    if len(errors) > limit:
+        summary += f" (y {len(errors) - limit} errores más)"
+    return summary
+
+
+def split_docassemble_blocks(yaml_content):
+    """
+    Divide un archivo de entrevista de docassemble en sus bloques YAML
+    (separados por ---) y analiza cada uno por separado, de modo que un
+    bloque con errores no impide procesar el resto. El análisis sintáctico
+    lo hace validate_yaml_content (compartido con la validación de carga)
+
+    Parámetros:
+        yaml_content: Texto del archivo YAML
+
+    Retorno:
+        list: Bloques con "text", "line" (primera línea, base 1), "type",
+        "id", "data", "error", "defines" y "uses"
+    """
+    blocks = []
+    for parsed in validate_yaml_content(yaml_content)["blocks"]:
+        block = {
+            "text": parsed["text"],
+            "line": parsed["first_line"],
+            "type": "other",
+            "id": None,
+            "data": parsed["data"],
+            "error": parsed["error"],
+            "defines": set(),
+            "uses": set(),
+        }
+        if block["error"] is None:
+            data = block["data"]
+            block["type"] = classify_docassemble_block(data)
+            if isinstance(data, dict):
+                if isinstance(data.get("id"), str):
+                    block["id"] = data["id"]
+                _collect_block_variables(data, block["defines"], block["uses"])
+                block["uses"] -= block["defines"]
+        blocks.append(block)
+
+    return blocks
+
+
+def variable_prefixes(name):
+    """Devuelve una variable y sus prefijos (cliente.name.first -> cliente.name, cliente)"""
+    parts = name.split(".")
+    prefixes = [".".join(parts[:i]) for i in range(len(parts), 0, -1)]
+    if "[" in parts[0]:
+        prefixes.append(parts[0].split("[", 1)[0])
+    return prefixes
+
+
+class YamlVariableIndex:
+    """
+    Índice de variables de entrevistas de docassemble: relaciona cada
+    variable con los bloques (fragmentos indexados) que la definen o usan
+    """
+
+    def __init__(self):
+        self.defined_in = {}  # variable -> {id_fragmento}
+        self.used_in = {}  # variable -> {id_fragmento}
+        self.doc_variables = {}  # nombre_documento -> [(variable, id_fragmento, define)]
+
+    def add_document(self, doc_name, blocks, chunk_ids):
+        """Indexa las variables de los bloques de un documento"""
+        self.remove_document(doc_name)
+        entries = []
+        for block, chunk_id in zip(blocks, chunk_ids):
+            for name in block["defines"]:
+                self.defined_in.setdefault(name, set()).add(chunk_id)
+                entries.append((name, chunk_id, True))
+            for name in block["uses"]:
+                self.used_in.setdefault(name, set()).add(chunk_id)
+                entries.append((name, chunk_id, False))
+        self.doc_variables[doc_name] = entries
+
+    def remove_document(self, doc_name):
+        """Elimina del índice las variables de un documento"""
+        for name, chunk_id, defines in self.doc_variables.pop(doc_name, []):
+            table = self.defined_in if defines else self.used_in
+            chunk_ids = table.get(name)
+            if chunk_ids is not None:
+                chunk_ids.discard(chunk_id)
+                if not chunk_ids:
+                    del table[name]
+
+    def lookup(self, text):
+        """
+        Busca en un texto las referencias a variables conocidas y devuelve
+        los bloques relacionados: primero los que las definen (incluidos los que definen
+        el objeto padre) y después los que las usan
+
+        Retorno:
+            tuple: (variables_encontradas, ids_fragmentos_en_orden_de_prioridad)
+        """
+        # Solo referencias reales: nombres con atributos o índices
+        # (cliente.name.first, hijos[0]) o nombres que un bloque define;
+        # así las palabras comunes de la consulta no coinciden con usos
+        found = []
+        for candidate in _expression_variables(text):
+            name = _normalize_variable(candidate)
+            if name in self.defined_in or (
+                ("." in name or "[" in name) and name in self.used_in
+            ):
+                found.append(name)
+
+        defining, using = [], []
+        for name in sorted(found):
+            for prefix in variable_prefixes(name):
+                defining.extend(sorted(self.defined_in.get(prefix, ())))
+            using.extend(sorted(self.used_in.get(name, ())))
+
+        ordered = list(dict.fromkeys(defining + using))
+        return sorted(found), ordered
+
+
+def get_yaml_variable_index():
+    """Devuelve el índice de variables de entrevistas de la sesión actual"""
+    if "yaml_variable_index" not in st.session_state:
+        st.session_state.yaml_variable_index = YamlVariableIndex()
+    return st.session_state.yaml_variable_index
+
+
+# Variables especiales de docassemble que nunca se definen en la entrevista
+DOCASSEMBLE_SPECIAL_VARIABLES = frozenset(
+    ["user_info", "url_args", "role", "role_needed", "role_event", "speak_text",
+     "track_location", "multi_user", "allow_cron", "menu_items", "user_dict",
+     "session_local", "device_local", "user_local", "nav", "action", "x", "i",
+     "j", "k", "l", "m", "n", "row_item", "row_index", "caller", "interview_url",
+     "incoming_email", "loop", "DAObject", "Individual", "Person", "DAList",
+     "DADict", "DASet", "DAFile", "DAFileList", "Address", "Thing", "Value",
+     "PeriodicValue", "Organization", "IndividualName", "DAEmpty", "DATemplate"]
+)
+
+# Preguntas sobre la estructura de las entrevistas (reciben siempre los hallazgos del análisis)
+_STRUCTURAL_QUESTION_PATTERN = re.compile(
+    r"\b(ids?\s+duplicad|duplicate(d)?\s+ids?|variables?\s+(no\s+definidas|indefinidas|sin\s+definir)"
+    r"|undefined\s+variables|errore?s?\s+de\s+(indentaci[oó]n|sintaxis)|indentation\s+errors?"
+    r"|dependencias?\s+circular|circular\s+dependenc|bloques?\s+mandatory|mandatory\s+blocks?"
+    r"|(analiza|revisa|valida)r?\s+(la\s+estructura|el\s+(yaml|archivo)|la\s+entrevista)"
+    r"|lint)",
+    re.IGNORECASE,
+)
+_MAKO_LOOP_PATTERN = re.compile(r"^\s*%\s*for\s+([\w\s,()]+?)\s+in\b", re.MULTILINE)
+
+
+def _block_local_names(text):
+    """
+    Devuelve las variables de los bucles Mako (% for ... in) de un bloque; los
+    nombres locales del código ya los descarta _code_variables
+    """
+    names = set()
+    for match in _MAKO_LOOP_PATTERN.finditer(text):
+        names.update(re.findall(r"\w+", match.group(1)))
+    return names
+
+
+def _find_code_cycles(edges):
+    """
+    Busca ciclos en un grafo dirigido mediante el algoritmo de Tarjan
+
+    Retorno:
+        list: Componentes fuertemente conexas con más de un nodo
+    """
+    index_of, low, stack, on_stack, cycles = {}, {}, [], set(), []
+    counter = [0]
+
+    def visit(node):
+        index_of[node] = low[node] = counter[0]
+        counter[0] += 1
+        stack.append(node)
+        on_stack.add(node)
+        for target in edges.get(node, ()):
+            if target not in index_of:
+                visit(target)
+                low[node] = min(low[node], low[target])
+            elif target in on_stack:
+                low[node] = min(low[node], index_of[target])
+        if low[node] == index_of[node]:
+            component = []
+            while True:
+                member = stack.pop()
+                on_stack.discard(member)
+                component.append(member)
+                if member == node:
+                    break
+            if len(component) > 1:
+                cycles.append(sorted(component))
+
+    for node in edges:
+        if node not in index_of:
+            visit(node)
+    return cycles
+
+
+def analyze_docassemble_interview(documents):
+    """
+    Análisis estático local de los archivos de entrevista cargados: detecta
+    variables usadas que ninguna entrevista define, ids duplicados, ausencia
+    de bloques mandatory o initial, dependencias circulares entre bloques code y
+    errores de indentación o sintaxis, con su número de línea
+
+    Parámetros:
+        documents: Lista de tuplas (nombre_documento, bloques) según
+            split_docassemble_blocks
+
+    Retorno:
+        dict: "findings" (lista de hallazgos con "kind", "severity", "doc",
+        "line" y "message") y "elapsed_ms"
+    """
+    start = time.perf_counter()
+    findings = []
+    defined = set()
+    ids = {}
+    has_entry_point = False
+    has_questions = False
+    has_includes = False
+
+    for doc_name, blocks in documents:
+        for block in blocks:
+            if block["error"] is not None:
+                findings.append(
+                    {
+                        "kind": "syntax",
+                        "severity": "error",
+                        "doc": doc_name,
+                        "line": block["error"]["line"],
+                        "message": f"Error de sintaxis o indentación YAML: {block['error']['message']}",
+                    }
+                )
+            for offset, text_line in enumerate(block["text"].splitlines()):
+                if text_line[: len(text_line) - len(text_line.lstrip())].count("\t"):
+                    findings.append(
+                        {
+                            "kind": "indentation",
+                            "severity": "error",
+                            "doc": doc_name,
+                            "line": block["line"] + offset,
+                            "message": "Indentación con tabuladores (YAML solo admite espacios)",
+                        }
+                    )
+            if block["id"] is not None:
+                ids.setdefault(block["id"], []).append((doc_name, block["line"]))
+            has_entry_point = has_entry_point or is_docassemble_entry_point(block["data"])
+            has_questions = has_questions or block["type"] == "question"
+            has_includes = has_includes or block["type"] == "include"
+            for name in block["defines"]:
+                defined.update(variable_prefixes(name))
+
+    for block_id, locations in ids.items():
+        if len(locations) > 1:
+            places = ", ".join(f"{doc} línea {line}" for doc, line in locations)
+            findings.append(
+                {
+                    "kind": "duplicate_id",
+                    "severity": "error",
+                    "doc": locations[1][0],
+                    "line": locations[1][1],
+                    "message": f"id duplicado '{block_id}' ({places})",
+                }
+            )
+
+    if has_questions and not has_entry_point:
+        findings.append(
+            {
+                "kind": "missing_mandatory",
+                "severity": "warning",
+                "doc": documents[0][0] if documents else None,
+                "line": None,
+                "message": "Ninguna entrevista tiene un bloque mandatory ni initial, por lo que no hay un punto de inicio definido",
+            }
+        )
+
+    # Variables usadas que ningún bloque (ni su objeto padre) define
+    undefined = {}
+    for doc_name, blocks in documents:
+        for block in blocks:
+            local_names = None
+            for name in block["uses"]:
+                prefixes = variable_prefixes(name)
+                root = prefixes[-1]
+                if root in DOCASSEMBLE_SPECIAL_VARIABLES or any(
+                    prefix in defined for prefix in prefixes
+                ):
+                    continue
+                if local_names is None:
+                    local_names = _block_local_names(block["text"])
+                if root in local_names:
+                    continue
+                undefined.setdefault(name, (doc_name, block["line"]))
+    for name, (doc_name, line) in sorted(undefined.items()):
+        findings.append(
+            {
+                "kind": "undefined_variable",
+                "severity": "warning" if has_includes else "error",
+                "doc": doc_name,
+                "line": line,
+                "message": f"La variable '{name}' se usa pero ningún bloque la define"
+                + (" (puede estar en un archivo incluido no cargado)" if has_includes else ""),
+            }
+        )
+
+    # Dependencias circulares entre bloques code
+    code_blocks = {}
+    defined_by_code = {}
+    for doc_name, blocks in documents:
+        for block in blocks:
+            if block["type"] in ("code", "mandatory") and isinstance(block["data"], dict) and "code" in block["data"]:
+                key = (doc_name, block["line"])
+                code_blocks[key] = block
+                for name in block["defines"]:
+                    defined_by_code.setdefault(name, set()).add(key)
+    edges = {}
+    for key, block in code_blocks.items():
+        targets = set()
+        for name in block["uses"]:
+            for prefix in variable_prefixes(name):
+                targets |= defined_by_code.get(prefix, set())
+        targets.discard(key)
+        edges[key] = targets
+    for cycle in _find_code_cycles(edges):
+        places = " -> ".join(f"{doc} línea {line}" for doc, line in cycle)
+        findings.append(
+            {
+                "kind": "circular_dependency",
+                "severity": "error",
+                "doc": cycle[0][0],
+                "line": cycle[0][1],
+                "message": f"Dependencia circular entre bloques code: {places}",
+            }
+        )
+
+    return {
+        "findings": findings,
+        "elapsed_ms": (time.perf_counter() - start) * 1000,
+    }
+
+
+def format_analysis_findings(analysis):
+    """Presenta los hallazgos del análisis estático como lista Markdown"""
+    if not analysis["findings"]:
+        return "No se encontraron problemas estructurales en los archivos YAML cargados."
+    severity_labels = {"error": "Error", "warning": "Aviso"}
+    lines = []
+    for finding in sorted(
+        analysis["findings"],
+        key=lambda f: (f["severity"] != "error", f["doc"] or "", f["line"] or 0),
+    ):
+        location = f"{finding['doc']}"
+        if finding["line"] is not None:
+            location += f", línea {finding['line']}"
+        lines.append(
+            f"- **{severity_labels[finding['severity']]}** ({location}): {finding['message']}"
+        )
+    return "\n".join(lines)
+
+
+def get_interview_analysis(prepared_documents):
+    """
+    Devuelve el análisis estático de las entrevistas cargadas, reutilizando
+    el resultado mientras no cambie ningún archivo YAML
+
+    Retorno:
+        dict | None: Resultado de analyze_docassemble_interview, o None si no hay YAML
+    """
+    yaml_documents = [
+        (doc_name, entry) for doc_name, entry in prepared_documents if "blocks" in entry
+    ]
+    if not yaml_documents:
+        return None
+
+    cache_key = tuple((doc_name, entry["hash"]) for doc_name, entry in yaml_documents)
+    cached = st.session_state.get("interview_analysis")
+    if cached is not None and cached[0] == cache_key:
+        return cached[1]
+
+    analysis = analyze_docassemble_interview(
+        [(doc_name, entry["blocks"]) for doc_name, entry in yaml_documents]
+    )
+    logging.info(
+        f"Análisis estático de {len(yaml_documents)} entrevistas: {len(analysis['findings'])} hallazgos en {analysis['elapsed_ms']:.1f} ms"
+    )
+    st.session_state.interview_analysis = (cache_key, analysis)
+    return analysis
+
+
+def is_structural_question(prompt):
+    """
+    Indica si la consulta pregunta solo por la estructura de las entrevistas
+    (ids duplicados, variables sin definir, ...) sin mencionar variables
+    concretas; en ese caso se adjuntan siempre los hallazgos del análisis
+    """
+    if not _STRUCTURAL_QUESTION_PATTERN.search(prompt):
+        return False
+    mentioned, _ = get_yaml_variable_index().lookup(prompt)
+    return not mentioned
+
+
+def hash_document_content(doc_content):
+    """Calcula el hash SHA-256 del contenido procesado de un documento"""
+    if isinstance(doc_content, dict) and isinstance(doc_content.get("text"), str):
+        payload = doc_content["text"]
+    else:
+        payload = json.dumps(doc_content, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def extract_document_text(doc_content):
+    """Devuelve el texto utilizable de un documento procesado o None si no tiene"""
+    if not isinstance(doc_content, dict):
+        return None
+    if isinstance(doc_content.get("text"), str):
+        return doc_content["text"]
+    # Intentar extraer texto de la respuesta cruda si está disponible
+    raw_response = doc_content.get("raw_response")
+    if "error" in doc_content and isinstance(raw_response, dict):
+        if isinstance(raw_response.get("text"), str):
+            return raw_response["text"]
+    return None
+
+
+def build_document_context_fragment(doc_name, doc_content):
+    """
+    Construye la línea de contexto de un documento sin texto utilizable,
+    indicando por qué no se pudo extraer
+    """
+    if not isinstance(doc_content, dict):
+        return f"-- Documento: {doc_name} -- (Formato no reconocido)\n\n"
+    if "error" in doc_content:
+        return f"-- Documento: {doc_name} -- (Error al extraer texto: {doc_content['error']})\n\n"
+    return f"-- Documento: {doc_name} -- (No se pudo extraer texto)\n\n"
+
+
+def register_document_content(doc_name, doc_content):
+    """
+    Registra un documento en la sesión y lo prepara una sola vez: calcula
+    su hash y lo divide en fragmentos indexados para búsqueda, o prepara
+    su línea de contexto si no tiene texto. Se reutiliza mientras el
+    contenido (por hash) no cambie
+
+    Retorno:
+        dict: Entrada preparada con hash, fragmentos indexados o línea de contexto
+    """
+    st.session_state.document_contents[doc_name] = doc_content
+    if "document_context_fragments" not in st.session_state:
+        st.session_state.document_context_fragments = {}
+
+    fragments = st.session_state.document_context_fragments
+    entry = fragments.get(doc_name)
+    if entry is not None and entry["source"] is doc_content:
+        return entry
+
+    content_hash = hash_document_content(doc_content)
+    if entry is not None and entry["hash"] == content_hash:
+        # Mismo contenido en un objeto distinto: solo actualizar la referencia
+        entry["source"] = doc_content
+        return entry
+
+    index = get_document_index()
+    variable_index = get_yaml_variable_index()
+    text = extract_document_text(doc_content)
+    if text is not None and text.strip() and doc_content.get("format") == "yaml":
+        # Entrevistas: un fragmento por bloque y un índice de sus variables
+        blocks = split_docassemble_blocks(text)
+        chunk_ids = index.add_document(
+            doc_name,
+            [block["text"] for block in blocks],
+            key=content_hash[:12],
+            labels=[f"bloque {block['type']}, línea {block['line']}" for block in blocks],
+        )
+        variable_index.add_document(doc_name, blocks, chunk_ids)
+        entry = {
+            "hash": content_hash,
+            "fragment": None,
+            "chunk_ids": chunk_ids,
+            "blocks": blocks,
+            "source": doc_content,
+        }
+    elif text is not None and text.strip():
+        variable_index.remove_document(doc_name)
+        entry = {
+            "hash": content_hash,
+            "fragment": None,
+            "chunk_ids": index.add_document(
+                doc_name, chunk_document_text(text), key=content_hash[:12]
+            ),
+            "source": doc_content,
+        }
+    else:
+        index.remove_document(doc_name)
+        variable_index.remove_document(doc_name)
+        entry = {
+            "hash": content_hash,
+            "fragment": build_document_context_fragment(doc_name, doc_content),
+            "chunk_ids": [],
+            "source": doc_content,
+        }
+    fragments[doc_name] = entry
+    return entry
+
+
+def get_prepared_documents():
+    """
+    Devuelve, en orden de carga, los documentos de la sesión con su entrada
+    preparada. Solo se preparan los documentos que no tienen entrada
+    o cuyo contenido fue reemplazado
+
+    Retorno:
+        list: Tuplas (nombre_documento, entrada_preparada)
+    """
+    fragments = st.session_state.get("document_context_fragments", {})
+    prepared = []
+    for doc_name, doc_content in st.session_state.get("document_contents", {}).items():
+        entry = fragments.get(doc_name)
+        if entry is None or entry["source"] is not doc_content:
+            entry = register_document_content(doc_name, doc_content)
+        prepared.append((doc_name, entry))
+    return prepared
+
+
+def build_thread_document_context(thread_id, prepared_documents, prompt):
+    """
+    Construye el contexto de documentos para un mensaje: los bloques de
+    entrevista que definen o usan las variables mencionadas, los fragmentos
+    más relevantes para la consulta que el thread aún no ha recibido, el
+    inicio de los documentos nuevos sin fragmentos relevantes y un aviso de
+    los documentos retirados
+
+    Parámetros:
+        thread_id: ID del thread de conversación
+        prepared_documents: Resultado de get_prepared_documents()
+        prompt: Consulta del usuario usada para la búsqueda
+
+    Retorno:
+        tuple: (contexto, documentos, fragmentos) donde contexto puede ser vacío;
+        documentos (nombre -> hash) y fragmentos (ids enviados) se registran
+        en el thread si el envío tiene éxito
+    """
+    config = DOCUMENT_RETRIEVAL_CONFIG
+    index = get_document_index()
+    delivered = st.session_state.get("thread_document_hashes", {}).get(thread_id, {})
+    delivered_chunks = st.session_state.get("thread_delivered_chunks", {}).get(
+        thread_id, set()
+    )
+    current_names = {doc_name for doc_name, _ in prepared_documents}
+
+    # Bloques de entrevista relacionados con las variables de la consulta
+    _, variable_chunks = get_yaml_variable_index().lookup(prompt)
+    selected = [
+        chunk_id for chunk_id in variable_chunks if chunk_id not in delivered_chunks
+    ][: config["yaml_max_blocks"]]
+
+    # Fragmentos relevantes para la consulta que el thread todavía no tiene
+    selected += [
+        chunk_id
+        for chunk_id, _ in index.search(
+            prompt, config["top_k"], exclude=delivered_chunks.union(selected)
+        )
+    ]
+
+    # Documentos nuevos o modificados sin ningún fragmento seleccionado:
+    # incluir su inicio para que el asistente sepa de qué tratan
+    selected_docs = {index.chunks[chunk_id]["doc_name"] for chunk_id in selected}
+    for doc_name, entry in prepared_documents:
+        if (
+            entry["chunk_ids"]
+            and delivered.get(doc_name) != entry["hash"]
+            and doc_name not in selected_docs
+            and entry["chunk_ids"][0] not in delivered_chunks
+        ):
+            selected.append(entry["chunk_ids"][0])
+
+    # Aplicar el presupuesto de caracteres (siempre al menos un fragmento)
+    budget = config["max_context_chars"]
+    within_budget = []
+    for chunk_id in selected:
+        size = len(index.chunks[chunk_id]["text"])
+        if within_budget and size > budget:
+            continue
+        within_budget.append(chunk_id)
+        budget -= size
+
+    # Presentar los fragmentos agrupados por documento y en orden de aparición
+    doc_order = {doc_name: i for i, (doc_name, _) in enumerate(prepared_documents)}
+    within_budget.sort(
+        key=lambda chunk_id: (
+            doc_order.get(index.chunks[chunk_id]["doc_name"], 0),
+            index.chunks[chunk_id]["position"],
+        )
+    )
+
+    context_parts = []
+    pending = [
+        entry["fragment"]
+        for doc_name, entry in prepared_documents
+        if entry["fragment"] and delivered.get(doc_name) != entry["hash"]
+    ]
+    for chunk_id in within_budget:
+        chunk = index.chunks[chunk_id]
+        label = chunk["label"] or f"fragmento {chunk['position'] + 1}/{chunk['count']}"
+        pending.append(
+            f"-- Documento: {chunk['doc_name']} ({label}) --\n{chunk['text']}\n\n"
+        )
+    if pending:
+        context_parts.append(
+            "### Contexto de documentos procesados:\n\n" + "".join(pending).rstrip()
+        )
+
+    removed = [doc_name for doc_name in delivered if doc_name not in current_names]
+    if removed:
+        context_parts.append(
+            "### Documentos retirados del contexto (ignorar su contenido previo): "
+            + ", ".join(removed)
+        )
+
+    return (
+        "\n\n".join(context_parts),
+        {doc_name: entry["hash"] for doc_name, entry in prepared_documents},
+        within_budget,
+    )
+
+
+def forget_document_content(doc_name):
+    """Elimina un documento de la sesión junto con su entrada preparada e indexada"""
+    st.session_state.get("document_contents", {}).pop(doc_name, None)
+    st.session_state.get("document_context_fragments", {}).pop(doc_name, None)
+    get_document_index().remove_document(doc_name)
+    get_yaml_variable_index().remove_document(doc_name)
+
+
+# Función para inicializar un thread con OpenAI Assistants
+@handle_error(max_retries=1)
+def initialize_thread(client):
+    """
+    Inicializa un nuevo thread de conversación
+    con verificación de éxito
+    """
+    try:
+        thread = client.beta.threads.create()
+        thread_id = thread.id
+        logging.info(f"Thread creado: {thread_id}")
+
+        # Verificar que el thread se creó correctamente
+        test_thread = client.beta.threads.retrieve(thread_id=thread_id)
+        if not test_thread or not hasattr(test_thread, "id"):
+            raise Exception("El thread se creó pero no se puede recuperar")
+
+        return thread_id
+    except Exception as e:
+        logging.error(f"Error creando thread: {str(e)}")
+        st.error("No se pudo inicializar la conversación con el asistente")
+        return None
+
+
+# Función para procesar mensajes del asistente
+@handle_error(max_retries=1)
+def process_message_with_citations(message):
+    """
+    Extrae y formatea el texto del mensaje del asistente con citas adecuadas,
+    manejando diferentes formatos de respuesta
+    """
+    try:
+        # Verificar que el mensaje tenga contenido
+        if not hasattr(message, "content") or not message.content:
+            return "No se pudo procesar el mensaje"
+
+        # Procesar cada parte del contenido
+        processed_content = ""
+        for content_item in message.content:
+            # Verificar tipo de contenido
+            if hasattr(content_item, "text") and content_item.text:
+                # Procesar texto con anotaciones si existen
+                text_value = content_item.text.value
+                annotations = []
+
+                # Extraer anotaciones si existen
+                if (
+                    hasattr(content_item.text, "annotations")
+                    and content_item.text.annotations
+                ):
+                    annotations = content_item.text.annotations
+
+                    # Procesar cada anotación para formatear citas de archivos
+                    if annotations:
+                        # Recolectar información de citas
+                        citations = []
+                        for idx, annotation in enumerate(annotations):
+                            # Reemplazar el texto de la anotación con un marcador de referencia
+                            text_value = text_value.replace(
+                                annotation.text, f"[{idx+1}]"
+                            )
+
+                            # Extraer detalles de la cita si es una cita de archivo
+                            if file_citation := getattr(
+                                annotation, "file_citation", None
+                            ):
+                                file_id = file_citation.file_id
+                                # Buscar el nombre del archivo en los metadatos
+                                file_name = "Documento de referencia"
+                                if (
+                                    "file_metadata" in st.session_state
+                                    and file_id in st.session_state.file_metadata
+                                ):
+                                    file_name = st.session_state.file_metadata[file_id][
+                                        "name"
+                                    ]
+
+                                citations.append(f"[{idx+1}] Fuente: {file_name}")
+
+                        # Añadir las citas al final del texto procesado si existen
+                        if citations:
+                            text_value += "\n\n--- Referencias: ---\n" + "\n".join(
+                                citations
+                            )
+
+                processed_content += text_value
+            else:
+                # Si no es texto, añadimos una representación genérica
+                processed_content += str(content_item)
+
+        return processed_content
+    except Exception as e:
+        logging.error(f"Error procesando mensaje: {str(e)}")
+        logging.error(traceback.format_exc())
+        return "Error al procesar la respuesta del asistente"
+
+
+# Configuración de la espera adaptativa de runs (cuando no hay streaming)
+RUN_WAIT_CONFIG = {
+    "poll_interval": 1.0,  # Intervalo (s) fijo del polling original
+    "fast_polls": 3,  # Consultas iniciales rápidas
+    "fast_interval": 0.3,  # Intervalo (s) de las consultas rápidas
+    "backoff_factor": 1.7,  # Crecimiento exponencial del intervalo
+    "max_interval": 5.0,  # Techo (s) del intervalo entre consultas
+    "jitter": 0.2,  # Variación aleatoria relativa del intervalo
+    # Timeout (s) sin historial del asistente; con historial nunca se espera
+    # menos, para no abandonar runs que antes terminaban a tiempo
+    "default_timeout": 120,
+    "max_timeout": 300,  # Timeout máximo (s) con historial
+    "timeout_multiplier": 4,  # Timeout = multiplicador × duración esperada
+    "history_size": 20,  # Runs recientes considerados por asistente
+}
+
+# Estados en los que un run ya no avanzará por sí solo
+RUN_TERMINAL_STATES = ("completed", "failed", "cancelled", "expired", "incomplete")
+
+
+class RunDurationHistory:
+    """
+    Historial seguro para hilos de las duraciones recientes de runs
+    completados, agrupadas por asistente
+    """
+
+    def __init__(self, history_size=20):
+        self.history_size = history_size
+        self._durations = {}
+        self._lock = threading.Lock()
+
+    def record(self, assistant_id, duration):
+        with self._lock:
+            if assistant_id not in self._durations:
+                self._durations[assistant_id] = deque(maxlen=self.history_size)
+            self._durations[assistant_id].append(duration)
+
+    def expected(self, assistant_id):
+        """Duración esperada (mediana de runs recientes) o None sin historial"""
+        with self._lock:
+            durations = list(self._durations.get(assistant_id, ()))
+        return statistics.median(durations) if durations else None
+
+
+@st.cache_resource(show_spinner=False)
+def get_run_duration_history():
+    """Devuelve el historial de duraciones de runs compartido por el proceso"""
+    return RunDurationHistory(history_size=RUN_WAIT_CONFIG["history_size"])
+
+
+class RunWaitStrategy:
+    """
+    Estrategia de espera de runs por defecto: consultas a intervalo fijo y
+    timeout general, como el polling original. Las subclases deciden
+    cuánto dormir antes de la siguiente consulta y cuándo abandonar la espera
+    """
+
+    def start(self, assistant_id):
+        """Prepara la estrategia para un nuevo run del asistente indicado"""
+
+    def next_delay(self, poll_count, elapsed):
+        """Segundos a esperar antes de la consulta número poll_count + 1"""
+        return RUN_WAIT_CONFIG["poll_interval"]
+
+    def timeout(self):
+        """Tiempo máximo de espera (s) para el run actual"""
+        return RUN_WAIT_CONFIG["default_timeout"]
+
+    def record_completion(self, assistant_id, duration):
+        """Informa la duración de un run completado"""
+
+
+class FixedIntervalWaitStrategy(RunWaitStrategy):
+    """Estrategia de intervalo fijo, equivalente al polling original"""
+
+    def __init__(
+        self,
+        interval=RUN_WAIT_CONFIG["poll_interval"],
+        max_run_time=RUN_WAIT_CONFIG["default_timeout"],
+    ):
+        self.interval = interval
+        self.max_run_time = max_run_time
+
+    def next_delay(self, poll_count, elapsed):
+        return self.interval
+
+    def timeout(self):
+        return self.max_run_time
+
+
+class AdaptiveBackoffWaitStrategy(RunWaitStrategy):
+    """
+    Estrategia adaptativa: consultas rápidas al inicio, backoff exponencial
+    con jitter y techo, y una duración esperada aprendida de los runs
+    recientes del mismo asistente para no consultar antes de tiempo
+    """
+
+    def __init__(self, history=None, config=None):
+        self.history = history
+        self.config = dict(RUN_WAIT_CONFIG, **(config or {}))
+        self.expected_duration = None
+        self._backoff_polls = 0
+
+    def start(self, assistant_id):
+        self._backoff_polls = 0
+        self.expected_duration = (
+            self.history.expected(assistant_id) if self.history else None
+        )
+
+    def next_delay(self, poll_count, elapsed):
+        cfg = self.config
+
+        if self.expected_duration is not None and elapsed < self.expected_duration:
+            # Dormir hasta la duración esperada sin superar el techo
+            delay = min(self.expected_duration - elapsed, cfg["max_interval"])
+            delay = max(delay, cfg["fast_interval"])
+        elif poll_count < cfg["fast_polls"] and self.expected_duration is None:
+            delay = cfg["fast_interval"]
+        else:
+            # Backoff exponencial desde el inicio o desde la duración esperada
+            delay = min(
+                cfg["fast_interval"] * cfg["backoff_factor"] ** self._backoff_polls,
+                cfg["max_interval"],
+            )
+            self._backoff_polls += 1
+
+        jitter = cfg["jitter"]
+        return delay * random.uniform(1 - jitter, 1 + jitter)
+
+    def timeout(self):
+        cfg = self.config
+        if self.expected_duration is None:
+            return cfg["default_timeout"]
+        return min(
+            max(cfg["timeout_multiplier"] * self.expected_duration, cfg["default_timeout"]),
+            cfg["max_timeout"],
+        )
+
+    def record_completion(self, assistant_id, duration):
+        if self.history is not None:
+            self.history.record(assistant_id, duration)
+
+
+def wait_for_run(client, thread_id, run, assistant_id, status, strategy=None):
+    """
+    Espera a que un run alcance un estado terminal consultando su estado
+    según la estrategia de espera indicada
+
+    Parámetros:
+        client: Cliente OpenAI
+        thread_id: ID del thread
+        run: Run recién creado
+        assistant_id: ID del asistente (clave del historial de duraciones)
+        status: Contenedor st.status para mostrar el progreso
+        strategy: RunWaitStrategy a usar (adaptativa por defecto)
+
+    Retorno:
+        tuple: (run, estadísticas) con número de consultas, tiempo total,
+        espera desperdiciada estimada y si se agotó el tiempo
+    """
+    if strategy is None:
+        strategy = AdaptiveBackoffWaitStrategy(history=get_run_duration_history())
+    strategy.start(assistant_id)
+
+    start_time = time.time()
+    max_run_time = strategy.timeout()
+    stats = {"polls": 0, "elapsed": 0.0, "wasted_wait": 0.0, "timed_out": False}
+    last_delay = 0.0
+
+    while run.status not in RUN_TERMINAL_STATES and run.status != "requires_action":
+        elapsed_time = time.time() - start_time
+        if elapsed_time > max_run_time:
+            stats["timed_out"] = True
+            break
+
+        last_delay = min(
+            strategy.next_delay(stats["polls"], elapsed_time),
+            max(max_run_time - elapsed_time, 0),
+        )
+        time.sleep(last_delay)
+
+        try:
+            run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+            stats["polls"] += 1
+        except Exception as e:
+            # Continuar intentando, podría ser un error temporal
+            logging.warning(f"Error al recuperar estado de ejecución: {str(e)}")
+            continue
+
+        if run.status == "in_progress":
+            status.update(
+                label="Procesando consulta y analizando código YAML...",
+                state="running",
+            )
+
+    detected_at = time.time()
+    stats["elapsed"] = detected_at - start_time
+
+    if run.status == "completed":
+        # Tiempo entre la finalización real del run y su detección
+        completed_at = getattr(run, "completed_at", None)
+        if completed_at:
+            stats["wasted_wait"] = max(0.0, min(detected_at - completed_at, last_delay))
+        else:
+            stats["wasted_wait"] = last_delay / 2
+        strategy.record_completion(assistant_id, stats["elapsed"])
+
+    logging.info(
+        f"Espera del run {run.id}: estado={run.status}, consultas={stats['polls']}, "
+        f"tiempo={stats['elapsed']:.2f}s, espera desperdiciada≈{stats['wasted_wait']:.2f}s"
+    )
+    return run, stats
+
+
+# Marcador devuelto cuando el streaming no pudo iniciarse y se debe usar polling
+RUN_STREAMING_UNAVAILABLE = object()
+
+# Intervalo mínimo (s) entre repintados de la burbuja durante el streaming
+STREAMING_RENDER_INTERVAL = 0.05
+
+
+def _run_with_streaming(client, thread_id, assistant_id, response_placeholder):
+    """
+    Ejecuta el run mediante los eventos de streaming de Assistants API,
+    mostrando los tokens en la burbuja del chat a medida que llegan
+
+    Parámetros:
+        client: Cliente OpenAI
+        thread_id: ID del thread de conversación
+        assistant_id: ID del asistente
+        response_placeholder: Contenedor st.empty() donde se renderiza la respuesta
+
+    Retorno:
+        dict | None: Respuesta del asistente, None si el run falla,
+        o RUN_STREAMING_UNAVAILABLE si el streaming no está disponible
+    """
+    # SDKs anteriores a openai 1.14 no incluyen streaming de runs
+    if not hasattr(client.beta.threads.runs, "stream"):
+        return RUN_STREAMING_UNAVAILABLE
+
+    received_events = False
+    stream_start = time.time()
+    text_parts = []
+    final_message = None
+    run_id = None
+    last_render = 0.0
+
+    with st.status(
+        "Analizando consulta y procesando información...", expanded=False
+    ) as status:
+        try:
+            with client.beta.threads.runs.stream(
+                thread_id=thread_id, assistant_id=assistant_id
+            ) as stream:
+                for event in stream:
+                    received_events = True
+                    event_type = getattr(event, "event", "")
+
+                    if event_type == "thread.run.created":
+                        run_id = event.data.id
+                    elif event_type == "thread.run.in_progress":
+                        status.update(
+                            label="Procesando consulta y analizando código YAML...",
+                            state="running",
+                        )
+                    elif event_type == "thread.message.delta":
+                        for part in event.data.delta.content or []:
+                            text = getattr(part, "text", None)
+                            if text is not None and text.value:
+                                text_parts.append(text.value)
+
+                        # Limitar repintados para no saturar el websocket
+                        now = time.time()
+                        if now - last_render >= STREAMING_RENDER_INTERVAL:
+                            response_placeholder.markdown(
+                                escape_markdown_dollars("".join(text_parts)) + "▌"
+                            )
+                            last_render = now
+                    elif event_type == "thread.message.completed":
+                        final_message = event.data
+                    elif event_type == "thread.run.requires_action":
+                        # La aplicación no ejecuta herramientas: informar y cancelar
+                        logging.error(
+                            f"El run {run_id} requiere acciones no soportadas por la aplicación"
+                        )
+                        status.update(
+                            label="El asistente solicitó acciones no soportadas",
+                            state="error",
+                        )
+                        try:
+                            client.beta.threads.runs.cancel(
+                                thread_id=thread_id, run_id=event.data.id
+                            )
+                        except Exception as e:
+                            logging.warning(f"No se pudo cancelar la ejecución: {str(e)}")
+                        return None
+                    elif event_type in (
+                        "thread.run.failed",
+                        "thread.run.cancelled",
+                        "thread.run.expired",
+                    ):
+                        error_msg = f"Error en la ejecución ({event_type}): {getattr(event.data, 'last_error', None) or 'Desconocido'}"
+                        logging.error(error_msg)
+                        status.update(label="Error en el procesamiento", state="error")
+                        return None
+                    elif event_type == "error":
+                        logging.error(f"Error en el stream de ejecución: {event.data}")
+                        status.update(label="Error en el procesamiento", state="error")
+                        return None
+        except Exception as e:
+            if not received_events:
+                # El stream no llegó a iniciarse: recurrir al polling
+                logging.warning(f"Streaming no disponible, usando polling: {str(e)}")
+                status.update(
+                    label="Streaming no disponible, consultando estado...",
+                    state="complete",
+                )
+                return RUN_STREAMING_UNAVAILABLE
+            raise
+
+        status.update(label="Análisis completado", state="complete")
+
+    # Alimentar el historial usado por la espera adaptativa si se recurre al polling
+    get_run_duration_history().record(assistant_id, time.time() - stream_start)
+
+    if final_message is not None:
+        full_response = process_message_with_citations(final_message)
+        message_id = final_message.id
+        mark_thread_messages_seen(thread_id, [message_id])
+    elif text_parts:
+        full_response = "".join(text_parts)
+        message_id = None
+    else:
+        logging.warning("El stream terminó sin mensajes del asistente")
+        return None
+
+    response_placeholder.markdown(escape_markdown_dollars(full_response))
+    return {"role": "assistant", "content": full_response, "id": message_id}
+
+
+# Caché de respuestas del asistente para consultas repetidas con el mismo contexto
+RESPONSE_CACHE_CONFIG = {
+    "enabled": True,
+    "max_entries": 256,  # Respuestas conservadas (expulsión LRU)
+    "ttl": 24 * 3600,  # Vigencia (s) de cada respuesta
+}
+
+_PROMPT_WHITESPACE = re.compile(r"\s+")
+
 
+def normalize_prompt(prompt):
+    """Normaliza una consulta para compararla: minúsculas, espacios y signos de los extremos"""
+    return _PROMPT_WHITESPACE.sub(" ", prompt.casefold()).strip("?!.¿¡ ")
 
-# Función para procesar mensajes del asistente
-@handle_error(max_retries=1)
-def process_message_with_citations(message):
+
+class ResponseCache:
     """
-    Extrae y formatea el texto del mensaje del asistente con citas adecuadas,
-    manejando diferentes formatos de respuesta
+    Caché en memoria de respuestas del asistente, compartida entre sesiones,
+    con expiración por TTL, expulsión LRU por número de entradas y
+    estadísticas de aciertos por entrada
     """
-    try:
-        # Verificar que el mensaje tenga contenido
-        if not hasattr(message, "content") or not message.content:
-            return "No se pudo procesar el mensaje"
 
-        # Procesar cada parte del contenido
-        processed_content = ""
-        for content_item in message.content:
-            # Verificar tipo de contenido
-            if hasattr(content_item, "text") and content_item.text:
-                # Procesar texto con anotaciones si existen
-                text_value = content_item.text.value
-                annotations = []
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
 
-                # Extraer anotaciones si existen
-                if (
-                    hasattr(content_item.text, "annotations")
-                    and content_item.text.annotations
-                ):
-                    annotations = content_item.text.annotations
+    @staticmethod
+    def make_key(prompt, assistant_id, document_hashes, history_digest):
+        """
+        Calcula la clave de una consulta a partir de la consulta normalizada,
+        el asistente, los hashes de los documentos adjuntos y la conversación previa
+        """
+        payload = json.dumps(
+            {
+                "prompt": normalize_prompt(prompt),
+                "assistant_id": assistant_id,
+                "documents": sorted(document_hashes),
+                "history": history_digest,
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Devuelve la respuesta cacheada o None si no existe o expiró"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry["created_at"] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            entry["hits"] += 1
+            entry["last_hit_at"] = now
+            self.counters["hits"] += 1
+            return entry["content"]
+
+    def put(self, key, content):
+        """Guarda una respuesta y aplica el límite de entradas"""
+        with self._lock:
+            self._entries[key] = {
+                "content": content,
+                "created_at": time.time(),
+                "hits": 0,
+                "last_hit_at": None,
+            }
+            self._entries.move_to_end(key)
+            self.counters["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def entry_stats(self, key):
+        """Devuelve las estadísticas de una entrada (aciertos, fechas) o None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            return {k: v for k, v in entry.items() if k != "content"}
 
-                    # Procesar cada anotación para formatear citas de archivos
-                    if annotations:
-                        # Recolectar información de citas
-                        citations = []
-                        for idx, annotation in enumerate(annotations):
-                            # Reemplazar el texto de la anotación con un marcador de referencia
-                            text_value = text_value.replace(
-                                annotation.text, f"[{idx+1}]"
-                            )
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries))
 
-                            # Extraer detalles de la cita si es una cita de archivo
-                            if file_citation := getattr(
-                                annotation, "file_citation", None
-                            ):
-                                file_id = file_citation.file_id
-                                # Buscar el nombre del archivo en los metadatos
-                                file_name = "Documento de referencia"
-                                if (
-                                    "file_metadata" in st.session_state
-                                    and file_id in st.session_state.file_metadata
-                                ):
-                                    file_name = st.session_state.file_metadata[file_id][
-                                        "name"
-                                    ]
 
-                                citations.append(f"[{idx+1}] Fuente: {file_name}")
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    """Devuelve la caché de respuestas compartida o None si está deshabilitada"""
+    if not RESPONSE_CACHE_CONFIG["enabled"]:
+        return None
+    return ResponseCache(
+        RESPONSE_CACHE_CONFIG["max_entries"], RESPONSE_CACHE_CONFIG["ttl"]
+    )
 
-                        # Añadir las citas al final del texto procesado si existen
-                        if citations:
-                            text_value += "\n\n--- Referencias: ---\n" + "\n".join(
-                                citations
-                            )
 
-                processed_content += text_value
-            else:
-                # Si no es texto, añadimos una representación genérica
-                processed_content += str(content_item)
+def conversation_digest(messages, prompt):
+    """
+    Resume la conversación previa a la consulta actual: las respuestas solo
+    se reutilizan si el historial anterior es idéntico
+    """
+    previous = list(messages)
+    if previous and previous[-1]["role"] == "user" and previous[-1]["content"] == prompt:
+        previous.pop()
+    digest = hashlib.sha256()
+    for message in previous:
+        digest.update(f"{message['role']}\0{message['content']}\0".encode("utf-8"))
+    return digest.hexdigest()
 
-        return processed_content
+
+def add_assistant_message(client, thread_id, content):
+    """
+    Escribe en el thread una respuesta generada localmente, para que la
+    conversación del asistente siga siendo coherente con la mostrada
+
+    Retorno:
+        str | None: ID del mensaje creado, None si no se pudo escribir
+    """
+    try:
+        message = client.beta.threads.messages.create(
+            thread_id=thread_id, role="assistant", content=content
+        )
+        mark_thread_messages_seen(thread_id, [message.id])
+        return message.id
     except Exception as e:
-        logging.error(f"Error procesando mensaje: {str(e)}")
-        logging.error(traceback.format_exc())
-        return "Error al procesar la respuesta del asistente"
+        logging.warning(f"No se pudo escribir la respuesta local en el thread: {str(e)}")
+        return None
 
 
 # Función para enviar mensaje a OpenAI con contexto de documentos
 @handle_error(max_retries=1)
 def send_message_with_document_context(
-    client, thread_id, assistant_id, prompt, current_doc_contents=None
+    client,
+    thread_id,
+    assistant_id,
+    prompt,
+    current_doc_contents=None,
+    response_placeholder=None,
+    use_cache=True,
 ):
     """
     Envía un mensaje al asistente incluyendo el contexto de todos los documentos disponibles
-    con manejo mejorado de errores y reintentos
+    con manejo mejorado de errores y reintentos. Si se proporciona response_placeholder,
+    la respuesta se transmite en streaming y solo se recurre al polling si no es posible.
+    Las consultas repetidas con el mismo contexto se responden desde la caché
+    de respuestas salvo que use_cache sea False
     """
     try:
         # Construir el mensaje que incluirá el contexto del documento si existe
         full_prompt = prompt
 
-        # Combinar documentos actuales con documentos previamente procesados
-        all_doc_contents = {}
-
-        # Añadir documentos existentes en la sesión
-        if "document_contents" in st.session_state:
-            all_doc_contents.update(st.session_state.document_contents)
+        if "document_contents" not in st.session_state:
+            st.session_state.document_contents = {}
 
-        # Añadir documentos recién procesados, que pueden sobrescribir los anteriores
+        # Registrar documentos recién procesados, que pueden sobrescribir los anteriores
         if current_doc_contents and isinstance(current_doc_contents, dict):
-            all_doc_contents.update(current_doc_contents)
-            # Actualizar la sesión con los nuevos documentos
-            if "document_contents" not in st.session_state:
-                st.session_state.document_contents = {}
-            st.session_state.document_contents.update(current_doc_contents)
-
-        # Si hay contenido de documentos, añadirlo al prompt
-        if all_doc_contents and len(all_doc_contents) > 0:
-            document_context = "\n\n### Contexto de documentos procesados:\n\n"
-
-            for doc_name, doc_content in all_doc_contents.items():
-                # Extraer el texto del documento procesado por OCR
-                if isinstance(doc_content, dict):
-                    if "text" in doc_content:
-                        # Limitamos el contenido para no exceder el contexto de OpenAI
-                        doc_text = (
-                            doc_content["text"][:5000] + "..."
-                            if len(doc_content["text"]) > 5000
-                            else doc_content["text"]
-                        )
-                        document_context += (
-                            f"-- Documento: {doc_name} --\n{doc_text}\n\n"
-                        )
-                    elif "error" in doc_content and "raw_response" in doc_content:
-                        # Intentar extraer texto de la respuesta cruda si está disponible
-                        raw_response = doc_content["raw_response"]
-                        if isinstance(raw_response, dict) and "text" in raw_response:
-                            doc_text = (
-                                raw_response["text"][:5000] + "..."
-                                if len(raw_response["text"]) > 5000
-                                else raw_response["text"]
-                            )
-                            document_context += (
-                                f"-- Documento: {doc_name} --\n{doc_text}\n\n"
-                            )
-                        else:
-                            document_context += f"-- Documento: {doc_name} -- (Error al extraer texto: {doc_content['error']})\n\n"
-                    else:
-                        document_context += f"-- Documento: {doc_name} -- (No se pudo extraer texto)\n\n"
-                else:
-                    document_context += (
-                        f"-- Documento: {doc_name} -- (Formato no reconocido)\n\n"
-                    )
+            for doc_name, doc_content in current_doc_contents.items():
+                register_document_content(doc_name, doc_content)
+
+        # Solo se adjuntan los fragmentos relevantes para la consulta que el
+        # thread aún no ha recibido; los anteriores permanecen en su historial
+        prepared_documents = get_prepared_documents()
+        (
+            document_context,
+            delivered_documents,
+            delivered_chunks,
+        ) = build_thread_document_context(thread_id, prepared_documents, prompt)
+        if document_context:
+            full_prompt = f"{prompt}\n\n{document_context}"
+            logging.info(
+                f"Prompt enriquecido con {len(delivered_chunks)} fragmentos de documentos. Tamaño total: {len(full_prompt)} caracteres"
+            )
 
-            # Verificar si hay contenido real antes de añadirlo al prompt
-            if len(document_context) > 60:  # Más que solo el encabezado
-                full_prompt = f"{prompt}\n\n{document_context}"
-                logging.info(
-                    f"Prompt enriquecido con contexto de {len(all_doc_contents)} documentos. Tamaño total: {len(full_prompt)} caracteres"
+        # Análisis estático local de las entrevistas YAML cargadas: sus
+        # hallazgos son heurísticos, así que se adjuntan como apoyo para el
+        # asistente (siempre en preguntas estructurales y, en las demás, si el
+        # thread aún no los conoce) y nunca sustituyen a su respuesta
+        analysis_hash = None
+        analysis = get_interview_analysis(prepared_documents)
+        if analysis is not None and analysis["findings"]:
+            findings_text = format_analysis_findings(analysis)
+            analysis_hash = hashlib.sha256(findings_text.encode("utf-8")).hexdigest()
+            known_hash = st.session_state.get("thread_analysis_hashes", {}).get(thread_id)
+            if known_hash != analysis_hash or is_structural_question(prompt):
+                full_prompt += (
+                    "\n\n### Hallazgos del análisis estático local (heurísticos, "
+                    "pueden incluir falsos positivos; compruébalos en el YAML):\n"
+                    + findings_text
                 )
-            else:
-                logging.warning("No se pudo extraer texto útil de los documentos")
+
+        # Respuestas cacheadas para la misma consulta, asistente, documentos e historial
+        response_cache = get_response_cache()
+        cache_key = None
+        cached_answer = None
+        if response_cache is not None:
+            cache_key = ResponseCache.make_key(
+                prompt,
+                assistant_id,
+                delivered_documents.values(),
+                conversation_digest(st.session_state.get("messages", []), prompt),
+            )
+            if use_cache:
+                cached_answer = response_cache.get(cache_key)
 
         # Crear mensaje con el prompt completo (con sistema de retry)
         message = None
@@ -1593,120 +5561,287 @@ def send_message_with_document_context(
 
         if not message:
             raise Exception("No se pudo crear el mensaje después de reintentos")
+        mark_thread_messages_seen(thread_id, [message.id])
 
-        # Crear la ejecución
-        run = None
-        for attempt in range(2):
-            try:
-                run = client.beta.threads.runs.create(
-                    thread_id=thread_id, assistant_id=assistant_id
-                )
-                break
-            except Exception as e:
-                if attempt == 0:
-                    logging.warning(
-                        f"Error al crear ejecución (intento 1): {str(e)}. Reintentando..."
-                    )
-                    time.sleep(2)
-                else:
-                    raise Exception(f"Error al crear ejecución: {str(e)}")
-
-        if not run:
-            raise Exception("No se pudo iniciar la ejecución después de reintentos")
-
-        # Esperar a que se complete la ejecución
-        with st.status(
-            "Analizando consulta y procesando información...", expanded=True
-        ) as status:
-            run_counter = 0
-            max_run_time = 120  # Tiempo máximo de espera (2 minutos)
-            start_time = time.time()
-
-            while run.status not in ["completed", "failed", "cancelled", "expired"]:
-                run_counter += 1
-                time.sleep(1)
-
-                # Verificar timeout
-                elapsed_time = time.time() - start_time
-                if elapsed_time > max_run_time:
-                    status.update(
-                        label="La operación está tomando demasiado tiempo. Intente nuevamente.",
-                        state="error",
-                    )
-                    logging.error(
-                        f"Timeout después de {max_run_time}s esperando completar ejecución."
-                    )
-                    return None
+        # Estado previo del thread, para deshacer este turno si se regenera
+        thread_turn = {
+            "documents": dict(
+                st.session_state.get("thread_document_hashes", {}).get(thread_id, {})
+            ),
+            "chunks": sorted(delivered_chunks),
+            "analysis_hash": st.session_state.get("thread_analysis_hashes", {}).get(
+                thread_id
+            ),
+        }
 
-                # Actualizar el estado cada 2 segundos para no sobrecargar la API
-                if run_counter % 2 == 0:
-                    try:
-                        run = client.beta.threads.runs.retrieve(
-                            thread_id=thread_id, run_id=run.id
-                        )
-                    except Exception as e:
-                        logging.warning(
-                            f"Error al recuperar estado de ejecución: {str(e)}"
-                        )
-                        # Continuar intentando, podría ser un error temporal
+        # Registrar qué documentos y fragmentos conoce ya el thread
+        if "thread_document_hashes" not in st.session_state:
+            st.session_state.thread_document_hashes = {}
+        if "thread_delivered_chunks" not in st.session_state:
+            st.session_state.thread_delivered_chunks = {}
+        st.session_state.thread_document_hashes[thread_id] = delivered_documents
+        st.session_state.thread_delivered_chunks.setdefault(thread_id, set()).update(
+            delivered_chunks
+        )
+        if analysis_hash is not None:
+            if "thread_analysis_hashes" not in st.session_state:
+                st.session_state.thread_analysis_hashes = {}
+            st.session_state.thread_analysis_hashes[thread_id] = analysis_hash
 
-                # Mostrar mensajes según el estado
-                if run.status == "in_progress":
-                    status.update(
-                        label="Procesando consulta y analizando código YAML...",
-                        state="running",
-                    )
-                elif run.status == "requires_action":
-                    status.update(
-                        label="Realizando acciones requeridas...", state="running"
-                    )
+        if cached_answer is not None:
+            logging.info(
+                f"Respuesta servida desde caché: {response_cache.entry_stats(cache_key)}"
+            )
+            message_id = add_assistant_message(client, thread_id, cached_answer)
+            if response_placeholder is not None:
+                response_placeholder.markdown(escape_markdown_dollars(cached_answer))
+            return {
+                "role": "assistant",
+                "content": cached_answer,
+                "id": message_id,
+                "cached": True,
+                "reply_to": message.id,
+                "thread_turn": thread_turn,
+            }
+
+        response = _run_assistant(client, thread_id, assistant_id, response_placeholder)
+        if response is not None and cache_key is not None:
+            response_cache.put(cache_key, response["content"])
+        return response
+    except Exception as e:
+        logging.error(f"Error en comunicación con OpenAI: {str(e)}")
+        logging.error(traceback.format_exc())
+        st.error(
+            "Ocurrió un error al comunicarse con el asistente. Por favor, intente nuevamente."
+        )
+        return None
+
+
+# Tamaño de página al sincronizar mensajes nuevos de un thread (máximo de la API)
+THREAD_SYNC_PAGE_SIZE = 100
+
+
+def remove_last_thread_turn(client, thread_id, assistant_message, previous_messages):
+    """
+    Elimina del thread la última consulta y su respuesta (para regenerarla)
+    y deshace lo que ese turno registró: el cursor de sincronización y los
+    documentos, fragmentos y hallazgos enviados, que la nueva consulta
+    volverá a adjuntar
+
+    Parámetros:
+        client: Cliente OpenAI
+        thread_id: ID del thread de conversación
+        assistant_message: Respuesta del historial con "id", "reply_to" y "thread_turn"
+        previous_messages: Historial que se conserva, en orden cronológico
+
+    Retorno:
+        bool: True si los mensajes se eliminaron del thread
+    """
+    if not assistant_message.get("reply_to"):
+        return False
+    message_ids = [
+        message_id
+        for message_id in (assistant_message.get("id"), assistant_message.get("reply_to"))
+        if message_id and not message_id.startswith("local_")
+    ]
+    try:
+        for message_id in message_ids:
+            client.beta.threads.messages.delete(message_id=message_id, thread_id=thread_id)
+    except Exception as e:
+        logging.warning(f"No se pudo eliminar el turno del thread: {str(e)}")
+        return False
+
+    # El cursor vuelve al último mensaje conservado que existe en el thread
+    sync = _thread_sync_state(thread_id)
+    sync["seen"].difference_update(message_ids)
+    if sync["cursor"] in message_ids:
+        sync["cursor"] = next(
+            (
+                message["id"]
+                for message in reversed(previous_messages)
+                if message.get("id") and not message["id"].startswith("local_")
+            ),
+            None,
+        )
+
+    turn = assistant_message.get("thread_turn") or {}
+    if "documents" in turn and "thread_document_hashes" in st.session_state:
+        st.session_state.thread_document_hashes[thread_id] = turn["documents"]
+    delivered_chunks = st.session_state.get("thread_delivered_chunks", {}).get(thread_id)
+    if delivered_chunks is not None:
+        delivered_chunks.difference_update(turn.get("chunks", []))
+    analysis_hashes = st.session_state.get("thread_analysis_hashes", {})
+    if turn.get("analysis_hash") is None:
+        analysis_hashes.pop(thread_id, None)
+    else:
+        analysis_hashes[thread_id] = turn["analysis_hash"]
+    return True
+
+
+def _thread_sync_state(thread_id):
+    """Devuelve el estado de sincronización (cursor e IDs vistos) de un thread"""
+    if "thread_sync" not in st.session_state:
+        st.session_state.thread_sync = {}
+    return st.session_state.thread_sync.setdefault(
+        thread_id, {"cursor": None, "seen": set()}
+    )
+
+
+def mark_thread_messages_seen(thread_id, message_ids):
+    """
+    Registra mensajes del thread como ya vistos y avanza el cursor hasta el
+    último de ellos (los IDs deben estar en orden cronológico)
+    """
+    sync = _thread_sync_state(thread_id)
+    for message_id in message_ids:
+        if message_id:
+            sync["seen"].add(message_id)
+            sync["cursor"] = message_id
 
-                # Manejar errores
-                if run.status == "failed":
-                    error_msg = f"Error en la ejecución: {getattr(run, 'last_error', 'Desconocido')}"
-                    logging.error(error_msg)
-                    status.update(label="Error en el procesamiento", state="error")
-                    return None
 
-            # Actualizar estado final
-            if run.status == "completed":
-                status.update(label="Análisis completado", state="complete")
+def fetch_new_assistant_messages(client, thread_id, run_id=None):
+    """
+    Obtiene los mensajes del asistente posteriores al cursor del thread,
+    filtrados por run si se indica, recorriendo todas las páginas en orden
+    cronológico. El coste depende solo de los mensajes nuevos, no de la
+    longitud de la conversación
+
+    Parámetros:
+        client: Cliente OpenAI
+        thread_id: ID del thread de conversación
+        run_id: ID del run cuyos mensajes se buscan (opcional)
+
+    Retorno:
+        list: Mensajes nuevos del asistente en orden cronológico
+    """
+    sync = _thread_sync_state(thread_id)
+    params = {"thread_id": thread_id, "order": "asc", "limit": THREAD_SYNC_PAGE_SIZE}
+    if run_id:
+        params["run_id"] = run_id
+    after = sync["cursor"]
+
+    new_messages = []
+    fetched_ids = []
+    while True:
+        if after:
+            params["after"] = after
+        page = client.beta.threads.messages.list(**params)
+        data = list(page.data)
+        for message in data:
+            fetched_ids.append(message.id)
+            if message.role == "assistant" and message.id not in sync["seen"]:
+                new_messages.append(message)
+        if not data or not getattr(page, "has_more", False):
+            break
+        after = data[-1].id
+
+    mark_thread_messages_seen(thread_id, fetched_ids)
+    return new_messages
+
+
+def _run_assistant(client, thread_id, assistant_id, response_placeholder=None):
+    """
+    Ejecuta el asistente sobre el thread y devuelve su respuesta, con
+    streaming si hay un contenedor disponible y polling en otro caso
+
+    Retorno:
+        dict | None: Respuesta del asistente o None si la ejecución falla
+    """
+    # Ejecución con streaming (preferida)
+    if response_placeholder is not None:
+        streamed_response = _run_with_streaming(
+            client, thread_id, assistant_id, response_placeholder
+        )
+        if streamed_response is not RUN_STREAMING_UNAVAILABLE:
+            return streamed_response
+
+    # Crear la ejecución
+    run = None
+    for attempt in range(2):
+        try:
+            run = client.beta.threads.runs.create(
+                thread_id=thread_id, assistant_id=assistant_id
+            )
+            break
+        except Exception as e:
+            if attempt == 0:
+                logging.warning(
+                    f"Error al crear ejecución (intento 1): {str(e)}. Reintentando..."
+                )
+                time.sleep(2)
             else:
-                status.update(label=f"Estado final: {run.status}", state="error")
+                raise Exception(f"Error al crear ejecución: {str(e)}")
 
-        # Recuperar mensajes agregados por el asistente
-        if run.status == "completed":
+    if not run:
+        raise Exception("No se pudo iniciar la ejecución después de reintentos")
+
+    # Esperar a que se complete la ejecución
+    with st.status(
+        "Analizando consulta y procesando información...", expanded=True
+    ) as status:
+        run, wait_stats = wait_for_run(
+            client, thread_id, run, assistant_id, status
+        )
+
+        if wait_stats["timed_out"]:
+            status.update(
+                label="La operación está tomando demasiado tiempo. Intente nuevamente.",
+                state="error",
+            )
+            logging.error(
+                f"Timeout después de {wait_stats['elapsed']:.0f}s esperando completar ejecución."
+            )
+            return None
+
+        if run.status == "requires_action":
+            # La aplicación no ejecuta herramientas: informar y cancelar
+            logging.error(
+                f"El run {run.id} requiere acciones no soportadas por la aplicación"
+            )
+            status.update(
+                label="El asistente solicitó acciones no soportadas", state="error"
+            )
             try:
-                messages = client.beta.threads.messages.list(thread_id=thread_id)
+                client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
+            except Exception as e:
+                logging.warning(f"No se pudo cancelar la ejecución: {str(e)}")
+            return None
 
-                # Buscar el mensaje más reciente del asistente
-                for message in messages.data:
-                    if message.role == "assistant" and not any(
-                        msg["role"] == "assistant" and msg.get("id") == message.id
-                        for msg in st.session_state.messages
-                    ):
-                        full_response = process_message_with_citations(message)
-                        return {
-                            "role": "assistant",
-                            "content": full_response,
-                            "id": message.id,
-                        }
+        # Manejar errores
+        if run.status == "failed":
+            error_msg = f"Error en la ejecución: {getattr(run, 'last_error', 'Desconocido')}"
+            logging.error(error_msg)
+            status.update(label="Error en el procesamiento", state="error")
+            return None
 
-                # Si no se encontró un mensaje nuevo
+        # Actualizar estado final
+        if run.status == "completed":
+            status.update(label="Análisis completado", state="complete")
+        else:
+            status.update(label=f"Estado final: {run.status}", state="error")
+
+    # Recuperar mensajes agregados por el asistente
+    if run.status == "completed":
+        try:
+            new_messages = fetch_new_assistant_messages(client, thread_id, run.id)
+            if not new_messages:
                 logging.warning("No se encontraron nuevos mensajes del asistente")
                 return None
-            except Exception as e:
-                logging.error(f"Error al recuperar mensajes: {str(e)}")
-                return None
 
-        return None
-    except Exception as e:
-        logging.error(f"Error en comunicación con OpenAI: {str(e)}")
-        logging.error(traceback.format_exc())
-        st.error(
-            "Ocurrió un error al comunicarse con el asistente. Por favor, intente nuevamente."
-        )
-        return None
+            # Un run puede añadir varios mensajes: se presentan en orden
+            full_response = "\n\n".join(
+                process_message_with_citations(message) for message in new_messages
+            )
+            return {
+                "role": "assistant",
+                "content": full_response,
+                "id": new_messages[-1].id,
+            }
+        except Exception as e:
+            logging.error(f"Error al recuperar mensajes: {str(e)}")
+            return None
+
+    return None
 
 
 # Función para limpiar la sesión actual
@@ -1738,9 +5873,19 @@ def clean_current_session():
             st.session_state.messages = []
 
         # Limpiar otros estados relacionados con documentos
-        for key in ["file_metadata"]:
+        for key in ["file_metadata", "document_context_fragments"]:
             if key in st.session_state:
                 st.session_state[key] = {}
+        for key in [
+            "document_index",
+            "yaml_variable_index",
+            "interview_analysis",
+            "chat_history_window",
+            "pdf_exporter",
+            "export_job_id",
+        ]:
+            if key in st.session_state:
+                del st.session_state[key]
 
         # Verificar limpieza exitosa
         clean_success = True
@@ -1850,18 +5995,29 @@ with st.sidebar:
 
     # Opciones de exportación de chat
     st.subheader("💾 Exportar Conversación")
-    export_format = st.radio("Formato de exportación:", ("Markdown",))
+    export_format = st.radio(
+        "Formato de exportación:", (*CHAT_EXPORT_FORMATS, "PDF")
+    )
 
-    if st.button("Descargar conversación"):
+    # La exportación se genera en segundo plano para no bloquear el chat; el
+    # botón de descarga solo se muestra hasta que el archivo se descarga
+    if st.button("Generar exportación"):
         if "messages" in st.session_state and st.session_state.messages:
-            if export_format == "Markdown":
-                md_content = export_chat_to_markdown(st.session_state.messages)
-                b64 = base64.b64encode(md_content.encode()).decode()
-                href = f'<a href="data:text/markdown;base64,{b64}" download="{APP_IDENTITY["conversation_export_name"]}.md">Descargar archivo Markdown</a>'
-                st.markdown(href, unsafe_allow_html=True)
+            job = get_export_job_manager().submit(
+                st.session_state.messages,
+                export_format,
+                pdf_exporter=get_session_pdf_exporter() if export_format == "PDF" else None,
+            )
+            st.session_state.export_job_id = job.id
         else:
             st.warning("No hay conversación para exportar.")
 
+    export_job = _current_export_job()
+    if export_job is not None and not export_job.finished:
+        poll_export_job()
+    else:
+        render_export_job_status()
+
     # Administrador de contexto de documentos
     st.subheader("📄 Gestión de Documentos")
     manage_document_context()
@@ -1999,20 +6155,77 @@ if not st.session_state.thread_id and openai_client:
 
 # ----- INTERFAZ DE CHAT -----
 
-# Contenedor de historial de chat - mostrar mensajes previos
-chat_history_container = st.container()
+# Ventana visible del historial de chat
+CHAT_HISTORY_CONFIG = {
+    "visible_messages": 30,  # Mensajes mostrados inicialmente (los más recientes)
+    "load_step": 30,  # Mensajes añadidos con "mostrar anteriores"
+}
 
-with chat_history_container:
-    # Mostrar mensajes previos
-    for message in st.session_state.messages:
+# st.fragment (>=1.37) o st.experimental_fragment (>=1.33); sin soporte se
+# renderiza como parte del script completo
+chat_fragment = (
+    getattr(st, "fragment", None)
+    or getattr(st, "experimental_fragment", None)
+    or (lambda func: func)
+)
+
+
+@chat_fragment
+def render_chat_history():
+    """
+    Renderiza el historial de chat en un fragmento aislado: solo se muestran
+    los mensajes más recientes (con opción de cargar anteriores), de modo que
+    el coste de cada rerun no depende de la longitud de la conversación
+    """
+    messages = st.session_state.messages
+    if "chat_history_window" not in st.session_state:
+        st.session_state.chat_history_window = CHAT_HISTORY_CONFIG["visible_messages"]
+
+    start = max(0, len(messages) - st.session_state.chat_history_window)
+    if start and st.button(
+        f"⬆️ Mostrar mensajes anteriores ({start} ocultos)", key="load_earlier_messages"
+    ):
+        st.session_state.chat_history_window += CHAT_HISTORY_CONFIG["load_step"]
+        start = max(0, len(messages) - st.session_state.chat_history_window)
+
+    for position in range(start, len(messages)):
+        message = messages[position]
         with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+            st.markdown(escape_markdown_dollars(message["content"]))
+            if message.get("cached"):
+                st.caption("⚡ Respuesta reutilizada de una consulta idéntica")
+                # Permitir descartar la respuesta cacheada de la última consulta
+                if position == len(messages) - 1 and st.button(
+                    "🔄 Generar una respuesta nueva", key=f"regenerate_{position}"
+                ):
+                    # Quitar la pareja consulta/respuesta del historial y del
+                    # thread para volver a enviarla sin caché
+                    if remove_last_thread_turn(
+                        openai_client,
+                        st.session_state.thread_id,
+                        message,
+                        messages[: position - 1],
+                    ):
+                        messages.pop()
+                        st.session_state.uncached_prompt = messages.pop()["content"]
+                        rerun_app()
+                    else:
+                        st.error(
+                            "No se pudo retirar la respuesta anterior de la conversación. Intente de nuevo."
+                        )
 
     # Mostrar mensaje de bienvenida si no hay mensajes
-    if not st.session_state.messages:
+    if not messages:
         with st.chat_message("assistant"):
             st.markdown(APP_IDENTITY["welcome_message"])
 
+
+# Contenedor de historial de chat - mostrar mensajes previos
+chat_history_container = st.container()
+
+with chat_history_container:
+    render_chat_history()
+
 # Chat input con soporte nativo para adjuntar archivos
 # Extraer extensiones sin el punto para el parámetro file_type
 file_types = [ext[1:] for ext in ALLOWED_EXTENSIONS]  # Quitar el punto inicial
@@ -2025,31 +6238,45 @@ prompt = st.chat_input(
     APP_IDENTITY["chat_placeholder"],
 )
 
+# Repetir la última consulta sin caché si el usuario lo solicitó
+use_response_cache = True
+if not prompt and st.session_state.get("uncached_prompt"):
+    prompt = st.session_state.pop("uncached_prompt")
+    use_response_cache = False
+
 # Procesar la entrada del usuario
 if prompt:
     # Mostrar mensaje del usuario
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    st.session_state.messages.append(new_chat_message("user", prompt))
     with st.chat_message("user"):
-        st.markdown(prompt)
+        st.markdown(escape_markdown_dollars(prompt))
 
     # Procesar la respuesta usando OpenAI
     if st.session_state.thread_id and openai_client and assistant_id:
         try:
-            # Enviar mensaje y obtener respuesta
-            response = send_message_with_document_context(
-                openai_client,
-                st.session_state.thread_id,
-                assistant_id,
-                prompt,
-                current_doc_contents=st.session_state.document_contents if "document_contents" in st.session_state else None,
-            )
+            # Enviar mensaje y transmitir la respuesta en la burbuja del asistente
+            with st.chat_message("assistant"):
+                response_placeholder = st.empty()
+                response = send_message_with_document_context(
+                    openai_client,
+                    st.session_state.thread_id,
+                    assistant_id,
+                    prompt,
+                    current_doc_contents=st.session_state.document_contents if "document_contents" in st.session_state else None,
+                    response_placeholder=response_placeholder,
+                    use_cache=use_response_cache,
+                )
 
-            if response:
-                # Añadir respuesta al historial
-                st.session_state.messages.append(response)
-                with st.chat_message("assistant"):
-                    st.markdown(response["content"])
-            else:
+                if response:
+                    # Añadir respuesta al historial
+                    st.session_state.messages.append(new_chat_message(**response))
+                    response_placeholder.markdown(
+                        escape_markdown_dollars(response["content"])
+                    )
+                else:
+                    response_placeholder.empty()
+
+            if not response:
                 st.error(
                     "No se pudo obtener respuesta. Por favor, intente de nuevo."
                 )
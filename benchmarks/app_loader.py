@@ -0,0 +1,41 @@
+"""
+Carga las funciones y clases de app.py sin ejecutar la interfaz de Streamlit.
+
+Solo se ejecutan las importaciones, definiciones y constantes en MAYÚSCULAS
+del módulo, de modo que los benchmarks pueden medir los motores internos
+sin abrir una sesión de la aplicación.
+"""
+
+import ast
+import os
+import types
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+def _is_loadable(node):
+    if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return True
+    if isinstance(node, ast.Assign):
+        return all(isinstance(target, ast.Name) and target.id.isupper() for target in node.targets)
+    return False
+
+
+def load_app(path=APP_PATH):
+    """Devuelve un módulo con las definiciones de app.py"""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=path)
+
+    module = types.ModuleType("app")
+    module.__file__ = path
+    for node in tree.body:
+        if not _is_loadable(node):
+            continue
+        code = compile(ast.Module(body=[node], type_ignores=[]), path, "exec")
+        try:
+            exec(code, module.__dict__)
+        except NameError:
+            # Definiciones que dependen de objetos de la interfaz (decoradores
+            # de fragmentos, etc.): no son necesarias para los benchmarks
+            pass
+    return module
@@ -0,0 +1,76 @@
+"""
+Benchmark del índice BM25 de fragmentos de documentos.
+
+Mide el tiempo de construcción y la latencia de consulta para corpus
+sintéticos de 1k, 10k y 100k fragmentos. Imprime los resultados en JSON.
+
+Uso:
+    python benchmarks/bench_bm25_index.py [--sizes 1000 10000 100000] [--queries 200]
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+
+from app_loader import load_app
+
+VOCABULARY_SIZE = 20000
+WORDS_PER_CHUNK = 180
+CHUNKS_PER_DOCUMENT = 100
+
+
+def make_corpus(size, rng):
+    vocabulary = [f"termino{i}" for i in range(VOCABULARY_SIZE)]
+    # Distribución tipo Zipf para que haya términos frecuentes y raros
+    weights = [1.0 / (rank + 1) for rank in range(VOCABULARY_SIZE)]
+    words = rng.choices(vocabulary, weights=weights, k=size * WORDS_PER_CHUNK)
+    chunks = [
+        " ".join(words[i * WORDS_PER_CHUNK : (i + 1) * WORDS_PER_CHUNK])
+        for i in range(size)
+    ]
+    return vocabulary, chunks
+
+
+def run(app, size, query_count, seed):
+    rng = random.Random(seed)
+    vocabulary, chunks = make_corpus(size, rng)
+    index = app.BM25Index()
+
+    start = time.perf_counter()
+    for doc_number, offset in enumerate(range(0, size, CHUNKS_PER_DOCUMENT)):
+        index.add_document(f"doc{doc_number}.pdf", chunks[offset : offset + CHUNKS_PER_DOCUMENT])
+    build_seconds = time.perf_counter() - start
+
+    queries = [" ".join(rng.sample(vocabulary[:2000], 6)) for _ in range(query_count)]
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query, top_k=app.DOCUMENT_RETRIEVAL_CONFIG["top_k"])
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+
+    return {
+        "chunks": size,
+        "terms": len(index.postings),
+        "build_seconds": round(build_seconds, 4),
+        "query_ms_median": round(statistics.median(latencies), 3),
+        "query_ms_p95": round(latencies[int(len(latencies) * 0.95) - 1], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app = load_app()
+    results = [run(app, size, args.queries, args.seed) for size in args.sizes]
+    print(json.dumps({"benchmark": "bm25_index", "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Benchmark de los motores de exportación de conversaciones.
+
+Genera conversaciones sintéticas (ASCII, español con tildes, bloques de
+código largos y un único mensaje enorme) de 10 a 10.000 mensajes y mide,
+para cada motor, el tiempo, la memoria máxima (tracemalloc) y el tamaño
+del resultado. Funciona sin conexión e imprime los resultados en JSON.
+
+Uso:
+    python benchmarks/bench_export_engines.py [--sizes 10 100 1000 10000]
+        [--kinds ascii spanish code huge] [--engines ...] [--output resultados.json]
+"""
+
+import argparse
+import io
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from app_loader import load_app
+
+SPANISH_WORDS = (
+    "la entrevista pregunta al usuario información básica según su situación "
+    "jurídica también añade cláusulas y genera el documento final año señal "
+    "acción opción útil código después"
+).split()
+ASCII_WORDS = (
+    "the interview asks the user for basic information about their legal "
+    "situation then it adds clauses and produces the final document"
+).split()
+CODE_BLOCK = """```yaml
+---
+question: |
+  Información de contacto de ${ client.name.first }
+fields:
+  - Nombre: client.name.first
+  - Apellido: client.name.last
+  - Correo: client.email
+    datatype: email
+---
+code: |
+  if client.age > 60:
+    recommended_insurance = "senior"
+  else:
+    recommended_insurance = "standard"
+```"""
+
+
+def make_conversation(kind, size, rng):
+    """Genera una conversación sintética de size mensajes"""
+    if kind == "huge":
+        # Un solo mensaje enorme (~size * 1 KB) precedido de una consulta
+        words = rng.choices(SPANISH_WORDS, k=size * 150)
+        paragraphs = [" ".join(words[i : i + 120]) for i in range(0, len(words), 120)]
+        return [
+            {"role": "user", "content": "Genera la entrevista completa"},
+            {"role": "assistant", "content": "\n\n".join(paragraphs)},
+        ]
+
+    vocabulary = ASCII_WORDS if kind == "ascii" else SPANISH_WORDS
+    messages = []
+    for i in range(size):
+        if i % 2 == 0:
+            content = " ".join(rng.choices(vocabulary, k=rng.randint(8, 30))) + "?"
+            messages.append({"role": "user", "content": content})
+            continue
+        text = " ".join(rng.choices(vocabulary, k=rng.randint(60, 200)))
+        content = f"## Respuesta {i}\n\n{text}\n\n- primer punto\n- segundo punto"
+        if kind == "code":
+            content += "\n\n" + "\n\n".join([CODE_BLOCK] * rng.randint(1, 4))
+        messages.append({"role": "assistant", "content": content, "id": f"msg_{i}"})
+    return messages
+
+
+def build_engines(app):
+    def incremental(messages):
+        output = io.BytesIO()
+        exporter = app.IncrementalPDFExporter()
+        exporter.update(messages)
+        exporter.write_to(output)
+        return output.getvalue()
+
+    def incremental_append(messages):
+        # Exportación tras añadir un mensaje a una conversación ya exportada
+        exporter = app.IncrementalPDFExporter()
+        exporter.update(messages[:-1])
+        exporter.write_to(io.BytesIO())
+        start = time.perf_counter()
+        output = io.BytesIO()
+        exporter.update(messages)
+        exporter.write_to(output)
+        return output.getvalue(), time.perf_counter() - start
+
+    return {
+        "pdf_incremental": incremental,
+        "pdf_incremental_append": incremental_append,
+        "pdf_primary": lambda messages: app._export_chat_to_pdf_primary(messages)[0],
+        "pdf_secondary": lambda messages: app._export_chat_to_pdf_secondary(messages)[0],
+        "pdf_fallback": lambda messages: app._export_chat_to_pdf_fallback(messages)[0],
+        "markdown": lambda messages: app.export_chat_to_markdown(messages).encode("utf-8"),
+    }
+
+
+def run_case(engine, messages):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = engine(messages)
+        elapsed = time.perf_counter() - start
+        if isinstance(result, tuple):
+            result, elapsed = result
+        outcome = {"ok": True, "output_bytes": len(result)}
+    except Exception as e:
+        elapsed = time.perf_counter() - start
+        outcome = {"ok": False, "error": f"{type(e).__name__}: {str(e)[:200]}"}
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    outcome.update({"seconds": round(elapsed, 4), "peak_memory_bytes": peak})
+    return outcome
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument(
+        "--kinds", nargs="+", default=["ascii", "spanish", "code", "huge"],
+        choices=["ascii", "spanish", "code", "huge"],
+    )
+    parser.add_argument("--engines", nargs="+", default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Archivo JSON de resultados (por defecto stdout)")
+    args = parser.parse_args()
+
+    # Los motores registran avisos por cada línea problemática
+    logging.disable(logging.WARNING)
+    app = load_app()
+    engines = build_engines(app)
+    selected = args.engines or list(engines)
+    unknown = set(selected) - set(engines)
+    if unknown:
+        parser.error(f"Motores desconocidos: {', '.join(sorted(unknown))}")
+
+    results = []
+    for kind in args.kinds:
+        for size in args.sizes:
+            messages = make_conversation(kind, size, random.Random(args.seed))
+            input_bytes = sum(len(m["content"].encode("utf-8")) for m in messages)
+            for name in selected:
+                outcome = run_case(engines[name], messages)
+                outcome.update(
+                    {"engine": name, "kind": kind, "messages": size, "input_bytes": input_bytes}
+                )
+                results.append(outcome)
+                print(
+                    f"{kind:>8} {size:>6} {name:<24} "
+                    + (f"{outcome['seconds']:.3f}s" if outcome["ok"] else outcome["error"][:60]),
+                    file=sys.stderr,
+                )
+
+    report = {
+        "benchmark": "export_engines",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "results": results,
+    }
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(data)
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Benchmark del preprocesamiento de imágenes para OCR.
+
+Genera (o lee de --fixtures) un conjunto de imágenes de prueba y mide, para
+cada una, la latencia y el pico de memoria residente (RSS) de
+prepare_image_for_ocr frente a la implementación anterior. Cada medición
+se ejecuta en un subproceso nuevo para que el pico de RSS sea el de esa
+imagen. Funciona sin conexión e imprime los resultados en JSON.
+
+Uso:
+    python benchmarks/bench_image_preprocessing.py [--fixtures DIR] [--repeat 3]
+"""
+
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+# Imágenes sintéticas: (nombre, ancho, alto, tipo, formato)
+SYNTHETIC_FIXTURES = [
+    ("photo_40mp.jpg", 7728, 5152, "photo", "JPEG"),
+    ("photo_12mp.jpg", 4032, 3024, "photo", "JPEG"),
+    ("document_scan_a4.png", 4960, 7016, "document", "PNG"),
+    ("document_phone.jpg", 3024, 4032, "document", "JPEG"),
+    ("screenshot_small.png", 1280, 800, "document", "PNG"),
+]
+
+
+def legacy_prepare_image_for_ocr(file_data):
+    """Implementación anterior, conservada solo como referencia"""
+    img = Image.open(file_data)
+    if img.mode != "L" and img.mode != "1":
+        img = img.convert("L")
+    max_dimension = 4000
+    if img.width > max_dimension or img.height > max_dimension:
+        ratio = min(max_dimension / img.width, max_dimension / img.height)
+        img = img.resize((int(img.width * ratio), int(img.height * ratio)), Image.LANCZOS)
+    save_format = "JPEG"
+    histogram = img.histogram()
+    if img.mode == "L" and (histogram[0] + histogram[-1]) > sum(histogram) * 0.8:
+        save_format = "PNG"
+    buffer = BytesIO()
+    if save_format == "JPEG":
+        img.save(buffer, format=save_format, quality=95, optimize=True)
+    else:
+        img.save(buffer, format=save_format, optimize=True)
+    return buffer.getvalue(), f"image/{save_format.lower()}"
+
+
+def make_fixture(path, width, height, kind, image_format):
+    if kind == "photo":
+        # Degradado de color con ruido: comprime como una fotografía real
+        base = Image.linear_gradient("L").resize((width, height))
+        noise = Image.effect_noise((width, height), 40)
+        img = Image.merge("RGB", (base, noise, Image.blend(base, noise, 0.5)))
+    else:
+        img = Image.new("RGB", (width, height), "white")
+        draw = ImageDraw.Draw(img)
+        line_height = max(12, height // 120)
+        for y in range(line_height * 4, height - line_height * 4, line_height * 2):
+            draw.rectangle(
+                (width // 10, y, width - width // 10 - (y * 7) % (width // 4), y + line_height // 2),
+                fill="black",
+            )
+    img.save(path, format=image_format, quality=90)
+
+
+def peak_rss_mb():
+    """Pico de RSS del proceso actual: VmHWM en Linux (no hereda el del padre)"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure_single(engine, path, repeat):
+    """Mide una imagen en este proceso (se invoca en un subproceso)"""
+    if engine == "current":
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from app_loader import load_app
+
+        function = load_app().prepare_image_for_ocr
+    else:
+        function = legacy_prepare_image_for_ocr
+
+    # Calentamiento con una imagen mínima: importaciones y carga de códecs
+    warmup = BytesIO()
+    Image.new("L", (8, 8), 255).save(warmup, format="PNG")
+    warmup.seek(0)
+    function(warmup)
+    baseline_mb = peak_rss_mb()
+
+    timings = []
+    for _ in range(repeat):
+        with open(path, "rb") as f:
+            start = time.perf_counter()
+            data, mime_type = function(f)
+            timings.append((time.perf_counter() - start) * 1000)
+    return {
+        "latency_ms_median": round(statistics.median(timings), 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "peak_rss_delta_mb": round(peak_rss_mb() - baseline_mb, 1),
+        "output_bytes": len(data),
+        "mime_type": mime_type,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--fixtures", help="Directorio con imágenes reales (por defecto, sintéticas)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--engines", nargs="+", default=["current", "legacy"])
+    parser.add_argument("--single", nargs=2, metavar=("ENGINE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(measure_single(args.single[0], args.single[1], args.repeat)))
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.fixtures:
+            paths = [
+                os.path.join(args.fixtures, name)
+                for name in sorted(os.listdir(args.fixtures))
+                if name.lower().endswith((".jpg", ".jpeg", ".png"))
+            ]
+        else:
+            paths = []
+            for name, width, height, kind, image_format in SYNTHETIC_FIXTURES:
+                path = os.path.join(workdir, name)
+                make_fixture(path, width, height, kind, image_format)
+                paths.append(path)
+
+        results = []
+        for path in paths:
+            with Image.open(path) as img:
+                size = img.size
+            for engine in args.engines:
+                completed = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--repeat", str(args.repeat),
+                     "--single", engine, path],
+                    capture_output=True, text=True, check=True,
+                )
+                result = json.loads(completed.stdout.strip().splitlines()[-1])
+                result.update(
+                    {"image": os.path.basename(path), "pixels": size[0] * size[1], "engine": engine}
+                )
+                results.append(result)
+                print(f"{result['image']:<24} {engine:<8} {result['latency_ms_median']:>8} ms "
+                      f"{result['peak_rss_delta_mb']:>7} MB", file=sys.stderr)
+
+    print(json.dumps({"benchmark": "image_preprocessing", "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Micro-benchmark de la normalización de texto usada por los exportadores.
+
+Compara el rendimiento (MB/s) de las funciones compartidas de app.py
+(tablas str.translate y expresiones precompiladas) con los bucles por
+carácter que usaban antes los exportadores. Imprime los resultados en JSON.
+
+Uso:
+    python benchmarks/bench_text_normalization.py [--megabytes 4] [--repeat 5]
+"""
+
+import argparse
+import json
+import random
+import re
+import statistics
+import time
+
+from app_loader import load_app
+
+SAMPLE_WORDS = (
+    "La entrevista pregunta información básica según la situación jurídica; "
+    "añade cláusulas, “citas” y código ${ client.name.first } <b>&</b> (opción) • fin"
+).split()
+
+
+# Implementaciones anteriores, conservadas solo como referencia de comparación
+def legacy_ascii(text):
+    if not all(ord(c) < 128 for c in text):
+        text = "".join(c if ord(c) < 128 else "?" for c in text)
+    return text
+
+
+def legacy_escape_xml(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def legacy_unsafe(text):
+    return "".join(c for c in text if c.isalnum() or c in " .,;:-?!()")
+
+
+def legacy_markdown(text):
+    text = re.sub(r"^#{1,6}\s+(.*?)$", r"\1", text, flags=re.MULTILINE)
+    text = re.sub(r"!\[.*?\]\(.*?\)", "[IMAGEN]", text)
+    return re.sub(r"\[(.*?)\]\(.*?\)", r"\1", text)
+
+
+def make_lines(megabytes, rng):
+    """Genera líneas cortas, como las que procesan los exportadores"""
+    lines, size = [], 0
+    while size < megabytes * 1024 * 1024:
+        line = " ".join(rng.choices(SAMPLE_WORDS, k=rng.randint(5, 25)))
+        lines.append(line)
+        size += len(line.encode("utf-8"))
+    return lines, size
+
+
+def throughput(function, lines, size, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            function(line)
+        timings.append(time.perf_counter() - start)
+    return round(size / (1024 * 1024) / statistics.median(timings), 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--megabytes", type=float, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app = load_app()
+    lines, size = make_lines(args.megabytes, random.Random(args.seed))
+    cases = [
+        ("latin1", legacy_ascii, app.to_latin1),
+        ("ascii", legacy_ascii, app.to_ascii),
+        ("escape_xml", legacy_escape_xml, app.escape_xml),
+        ("strip_unsafe", legacy_unsafe, app.strip_unsafe_characters),
+        ("simplify_markdown", legacy_markdown, app.simplify_markdown_for_export),
+        ("pdf_string", lambda text: text, app._pdf_escape),
+    ]
+
+    results = []
+    for name, legacy, shared in cases:
+        results.append(
+            {
+                "operation": name,
+                "legacy_mb_per_s": throughput(legacy, lines, size, args.repeat)
+                if name != "pdf_string"
+                else None,
+                "shared_mb_per_s": throughput(shared, lines, size, args.repeat),
+            }
+        )
+    print(
+        json.dumps(
+            {"benchmark": "text_normalization", "input_bytes": size, "results": results},
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark del análisis estático de entrevistas de docassemble.
+
+Genera entrevistas sintéticas del número de líneas indicado y mide el
+tiempo de validación YAML (sin caché, con caché y frente a safe_load_all
+directo), el de división en bloques y el del análisis. cold_total_ms es el
+camino completo de un archivo nuevo (validación, división y análisis sin
+caché), que es lo que espera el usuario al cargarlo. Imprime los resultados
+en JSON.
+
+Uso:
+    python benchmarks/bench_yaml_analyzer.py [--lines 1000 5000 20000] [--repeat 5]
+"""
+
+import argparse
+import json
+import statistics
+import time
+
+import yaml
+
+from app_loader import load_app
+
+LINES_PER_QUESTION = 7
+
+
+def make_interview(line_count):
+    blocks = ["mandatory: True\ncode: |\n  final_screen"]
+    for i in range(line_count // LINES_PER_QUESTION):
+        blocks.append(
+            f"id: pregunta {i}\n"
+            f"question: Pregunta {i} para ${{ client.name.first }}\n"
+            "fields:\n"
+            f"  - Campo: client.v{i}\n"
+            f"  - Otro: client.w{i}\n"
+            f"    show if: client.v{i}"
+        )
+    blocks.append("objects:\n  - client: Individual")
+    blocks.append("event: final_screen\nquestion: Fin")
+    return "\n---\n".join(blocks)
+
+
+def measure(function, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return result, round(statistics.median(timings), 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--lines", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = load_app()
+    results = []
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    for line_count in args.lines:
+        content = make_interview(line_count)
+        # Un comentario distinto en cada repetición evita los aciertos de caché
+        variants = iter(f"{content}\n# {i}" for i in range(args.repeat))
+        validation, validate_ms = measure(
+            lambda: app.validate_yaml_content(next(variants)), args.repeat
+        )
+        _, validate_cached_ms = measure(lambda: app.validate_yaml_content(content), args.repeat)
+        _, safe_load_all_ms = measure(
+            lambda: list(yaml.load_all(content, Loader=loader)), args.repeat
+        )
+        split_variants = iter(f"{content}\n# split {i}" for i in range(args.repeat))
+        _, split_ms = measure(
+            lambda: app.split_docassemble_blocks(next(split_variants)), args.repeat
+        )
+        blocks, split_cached_ms = measure(
+            lambda: app.split_docassemble_blocks(content), args.repeat
+        )
+        analysis, analyze_ms = measure(
+            lambda: app.analyze_docassemble_interview([("bench.yml", blocks)]), args.repeat
+        )
+        cold_variants = iter(f"{content}\n# cold {i}" for i in range(args.repeat))
+        _, cold_total_ms = measure(
+            lambda: app.analyze_docassemble_interview(
+                [("bench.yml", app.split_docassemble_blocks(next(cold_variants)))]
+            ),
+            args.repeat,
+        )
+        results.append(
+            {
+                "lines": content.count("\n") + 1,
+                "blocks": len(blocks),
+                "engine": validation["engine"],
+                "validate_ms": validate_ms,
+                "validate_cached_ms": validate_cached_ms,
+                "safe_load_all_ms": safe_load_all_ms,
+                "split_ms": split_ms,
+                "split_cached_ms": split_cached_ms,
+                "analyze_ms": analyze_ms,
+                "cold_total_ms": cold_total_ms,
+                "findings": len(analysis["findings"]),
+            }
+        )
+    print(json.dumps({"benchmark": "yaml_analyzer", "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
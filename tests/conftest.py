@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from app_loader import load_app  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():
+    """Definiciones de app.py cargadas sin ejecutar la interfaz de Streamlit"""
+    return load_app()
@@ -0,0 +1,25 @@
+def test_text_without_dollars_is_unchanged(app):
+    text = "Sin fórmulas ni **variables**"
+    assert app.escape_markdown_dollars(text) is text
+
+
+def test_mako_expressions_are_escaped(app):
+    assert app.escape_markdown_dollars("Hola ${ client.name }, son $5") == (
+        "Hola \\${ client.name }, son \\$5"
+    )
+
+
+def test_code_spans_and_blocks_are_untouched(app):
+    text = "Usa `${ x }` así:\n```yaml\nquestion: ${ x }\n```\nfuera $y"
+    assert app.escape_markdown_dollars(text) == (
+        "Usa `${ x }` así:\n```yaml\nquestion: ${ x }\n```\nfuera \\$y"
+    )
+
+
+def test_unclosed_code_block_while_streaming_is_untouched(app):
+    text = "Antes $a\n```python\nprint('$')"
+    assert app.escape_markdown_dollars(text) == "Antes \\$a\n```python\nprint('$')"
+
+
+def test_already_escaped_dollars_are_not_doubled(app):
+    assert app.escape_markdown_dollars("precio \\$10") == "precio \\$10"
@@ -0,0 +1,90 @@
+def block_variables(app, yaml_content):
+    blocks = app.split_docassemble_blocks(yaml_content)
+    assert len(blocks) == 1
+    return blocks[0]["defines"], blocks[0]["uses"]
+
+
+def test_comprehension_variables_are_local(app):
+    defines, uses = block_variables(
+        app, "code: |\n  nombres = [p.name for p in people if p.age > 18]\n"
+    )
+    assert defines == {"nombres"}
+    assert uses == {"people"}
+
+
+def test_except_and_with_names_are_local(app):
+    defines, uses = block_variables(
+        app,
+        "code: |\n"
+        "  try:\n"
+        "    edad = int(cliente.age)\n"
+        "  except Exception as err:\n"
+        "    edad = str(err)\n"
+        "  with open(ruta) as fh:\n"
+        "    datos = fh.read()\n",
+    )
+    assert defines == {"edad", "datos"}
+    assert uses == {"cliente.age", "ruta"}
+
+
+def test_keyword_arguments_are_not_variables(app):
+    defines, uses = block_variables(app, "code: |\n  total = sum(importes, start=0)\n")
+    assert defines == {"total"}
+    assert uses == {"importes"}
+
+
+def test_comments_and_strings_are_ignored(app):
+    defines, uses = block_variables(
+        app,
+        "code: |\n"
+        "  # the name of the client\n"
+        "  saludo = 'hello name ' + cliente.name.first  # the name\n",
+    )
+    assert defines == {"saludo"}
+    assert uses == {"cliente.name.first"}
+
+
+def test_function_arguments_and_imports_are_local(app):
+    defines, uses = block_variables(
+        app,
+        "code: |\n"
+        "  import json as js\n"
+        "  def formatear(valor, *resto, sep=', '):\n"
+        "    texto = sep.join(resto)\n"
+        "    return js.dumps(valor) + texto\n"
+        "  resultado = formatear(cliente.name)\n",
+    )
+    assert defines == {"resultado"}
+    assert uses == {"cliente.name"}
+
+
+def test_unparseable_code_is_skipped(app):
+    defines, uses = block_variables(app, "code: |\n  if cliente.age >\n    x = (\n")
+    assert defines == set()
+    assert uses == set()
+
+
+def test_mako_expressions_still_use_regex(app):
+    defines, uses = block_variables(
+        app,
+        "question: Hola ${ cliente.name.first }\n"
+        "fields:\n"
+        "  - Edad: cliente.age\n",
+    )
+    assert defines == {"cliente.age"}
+    assert uses == {"cliente.name.first"}
+
+
+def test_lookup_ignores_common_words(app):
+    blocks = app.split_docassemble_blocks(
+        "code: |\n  name = people[0].name\n---\nquestion: ${ the.answer }\n"
+    )
+    index = app.YamlVariableIndex()
+    index.add_document("entrevista.yml", blocks, ["c1", "c2"])
+
+    found, _ = index.lookup("What is the name of the people?")
+    assert found == ["name"]
+
+    found, chunk_ids = index.lookup("¿Dónde se usa the.answer?")
+    assert found == ["the.answer"]
+    assert chunk_ids == ["c2"]
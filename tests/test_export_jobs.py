@@ -0,0 +1,59 @@
+from datetime import datetime
+
+
+MESSAGES = [
+    {"id": "m1", "role": "user", "content": "Hola"},
+    {"id": "m2", "role": "assistant", "content": "Buenos días"},
+]
+
+
+def make_manager(app, tmp_path, now):
+    config = dict(app.EXPORT_JOBS_CONFIG, directory=str(tmp_path))
+    manager = app.ExportJobManager(config)
+    manager.export_date = lambda: app.ExportJobManager.export_date(manager, now[0])
+    return manager
+
+
+def read_export(job):
+    if job.future is not None:
+        job.future.result(timeout=10)
+    assert job.status == "done"
+    with open(job.path, encoding="utf-8") as f:
+        return f.read()
+
+
+def test_reexport_in_same_minute_reuses_artifact(app, tmp_path):
+    now = [datetime(2026, 10, 18, 10, 1, 5)]
+    manager = make_manager(app, tmp_path, now)
+
+    first = manager.submit(MESSAGES, "Markdown")
+    content = read_export(first)
+    now[0] = datetime(2026, 10, 18, 10, 1, 50)
+    second = manager.submit(MESSAGES, "Markdown")
+
+    assert second.from_cache
+    assert read_export(second) == content
+    assert "Fecha: 2026-10-18 10:01:00" in content
+
+
+def test_reexport_later_does_not_serve_stale_date(app, tmp_path):
+    now = [datetime(2026, 10, 18, 10, 1, 5)]
+    manager = make_manager(app, tmp_path, now)
+
+    first = manager.submit(MESSAGES, "Markdown")
+    read_export(first)
+    now[0] = datetime(2026, 10, 19, 9, 30, 0)
+    second = manager.submit(MESSAGES, "Markdown")
+
+    assert not second.from_cache
+    assert second.digest != first.digest
+    assert "Fecha: 2026-10-19 09:30:00" in read_export(second)
+
+
+def test_json_export_uses_job_date(app, tmp_path):
+    now = [datetime(2026, 10, 18, 10, 1, 5)]
+    manager = make_manager(app, tmp_path, now)
+
+    job = manager.submit(MESSAGES, "JSON")
+
+    assert '"exported_at": "2026-10-18T10:01:00"' in read_export(job)
@@ -0,0 +1,45 @@
+from io import BytesIO
+
+from PIL import Image
+
+
+def encode(img, image_format="PNG"):
+    buffer = BytesIO()
+    img.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def banded_image(values_and_rows, width=100):
+    """Imagen en grises con franjas horizontales de (valor, filas)"""
+    img = Image.new("L", (width, sum(rows for _, rows in values_and_rows)))
+    top = 0
+    for value, rows in values_and_rows:
+        img.paste(value, (0, top, width, top + rows))
+        top += rows
+    return img
+
+
+def test_pure_black_and_white_is_a_document(app):
+    img = banded_image([(255, 90), (0, 10)])
+
+    _, mime_type = app.prepare_image_for_ocr(encode(img))
+
+    assert mime_type == "image/png"
+
+
+def test_near_white_background_keeps_original_photo_rule(app):
+    # Fondo casi blanco (250): solo los píxeles exactamente 0 o 255 cuentan
+    img = banded_image([(250, 90), (0, 10)])
+
+    _, mime_type = app.prepare_image_for_ocr(encode(img))
+
+    assert mime_type == "image/jpeg"
+
+
+def test_fallback_returns_bytes_for_file_objects(app):
+    data = b"no es una imagen"
+
+    optimized, mime_type = app.prepare_image_for_ocr(BytesIO(data))
+
+    assert optimized == data
+    assert mime_type == "image/jpeg"
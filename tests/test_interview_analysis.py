@@ -0,0 +1,97 @@
+def undefined_variables(app, yaml_content):
+    blocks = app.split_docassemble_blocks(yaml_content)
+    analysis = app.analyze_docassemble_interview([("entrevista.yml", blocks)])
+    return sorted(
+        finding["message"]
+        for finding in analysis["findings"]
+        if finding["kind"] == "undefined_variable"
+    )
+
+
+INTERVIEW_HEADER = (
+    "mandatory: True\n"
+    "code: |\n"
+    "  resumen\n"
+    "---\n"
+    "objects:\n"
+    "  - people: DAList\n"
+    "---\n"
+    "question: Importes\n"
+    "fields:\n"
+    "  - Importes: amounts\n"
+    "---\n"
+)
+
+
+def test_comprehension_has_no_false_positives(app):
+    content = INTERVIEW_HEADER + "code: |\n  resumen = [p.name for p in people]\n"
+    assert undefined_variables(app, content) == []
+
+
+def test_except_clause_has_no_false_positives(app):
+    content = INTERVIEW_HEADER + (
+        "code: |\n"
+        "  try:\n"
+        "    resumen = len(people)\n"
+        "  except Exception as err:\n"
+        "    resumen = str(err)\n"
+    )
+    assert undefined_variables(app, content) == []
+
+
+def test_keyword_arguments_have_no_false_positives(app):
+    content = INTERVIEW_HEADER + "code: |\n  resumen = sum(amounts, start=0)\n"
+    assert undefined_variables(app, content) == []
+
+
+def test_comments_and_strings_have_no_false_positives(app):
+    content = INTERVIEW_HEADER + (
+        "code: |\n"
+        "  # the total of the amounts for each client\n"
+        "  resumen = 'total for the client: ' + str(amounts)  # name\n"
+    )
+    assert undefined_variables(app, content) == []
+
+
+def test_mako_loop_variables_are_local(app):
+    content = INTERVIEW_HEADER + (
+        "code: |\n  resumen = True\n"
+        "---\n"
+        "question: Personas\n"
+        "subquestion: |\n"
+        "  % for persona in people:\n"
+        "  * ${ persona.name }\n"
+        "  % endfor\n"
+    )
+    assert undefined_variables(app, content) == []
+
+
+def test_real_undefined_variable_is_reported(app):
+    content = INTERVIEW_HEADER + "code: |\n  resumen = cliente.name.first\n"
+    assert undefined_variables(app, content) == [
+        "La variable 'cliente.name.first' se usa pero ningún bloque la define"
+    ]
+
+
+def finding_kinds(app, yaml_content):
+    blocks = app.split_docassemble_blocks(yaml_content)
+    analysis = app.analyze_docassemble_interview([("entrevista.yml", blocks)])
+    return [finding["kind"] for finding in analysis["findings"]]
+
+
+QUESTION = "---\nquestion: Nombre\nfields:\n  - Nombre: nombre\n"
+
+
+def test_mandatory_expression_is_an_entry_point(app):
+    content = "mandatory: nombre != ''\ncode: |\n  nombre\n" + QUESTION
+    assert "missing_mandatory" not in finding_kinds(app, content)
+
+
+def test_initial_block_is_an_entry_point(app):
+    content = "initial: True\ncode: |\n  nombre\n" + QUESTION
+    assert "missing_mandatory" not in finding_kinds(app, content)
+
+
+def test_mandatory_false_is_not_an_entry_point(app):
+    content = "mandatory: False\ncode: |\n  nombre\n" + QUESTION
+    assert "missing_mandatory" in finding_kinds(app, content)
@@ -0,0 +1,74 @@
+import asyncio
+import contextlib
+import io
+
+import pytest
+from PyPDF2 import PdfWriter
+
+
+class FakeStatus:
+    def empty(self):
+        return self
+
+    def markdown(self, *args, **kwargs):
+        pass
+
+    def update(self, *args, **kwargs):
+        pass
+
+
+class FakeStreamlit:
+    @contextlib.contextmanager
+    def status(self, *args, **kwargs):
+        yield FakeStatus()
+
+    def error(self, message):
+        raise AssertionError(message)
+
+
+def make_pdf(page_count):
+    writer = PdfWriter()
+    for _ in range(page_count):
+        writer.add_blank_page(612, 792)
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+@pytest.fixture
+def ocr_stub(app, monkeypatch):
+    monkeypatch.setattr(app, "st", FakeStreamlit())
+    monkeypatch.setattr(app, "get_ocr_result_cache", lambda: None)
+    monkeypatch.setitem(app.PDF_TEXT_LAYER_CONFIG, "enabled", False)
+    state = {"in_flight": 0, "max_in_flight": 0, "requests": 0}
+
+    async def fake_request(http_client, api_key, document, file_name, job_id, report, first_page=None):
+        state["requests"] += 1
+        state["in_flight"] += 1
+        state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        await asyncio.sleep(0.05)
+        state["in_flight"] -= 1
+        return {"pages": [{"number": first_page + 1, "markdown": f"fragmento {first_page}"}]}
+
+    monkeypatch.setattr(app, "_request_mistral_ocr_async", fake_request)
+    return state
+
+
+def test_single_document_sends_shards_concurrently(app, ocr_stub):
+    page_count = app.OCR_CONFIG["pdf_shard_pages"] * 3 - 5
+
+    result = app.process_document_with_mistral_ocr("clave", make_pdf(page_count), "PDF", "a.pdf")
+
+    assert "error" not in result
+    assert ocr_stub["requests"] == 3
+    assert ocr_stub["max_in_flight"] == min(3, app.OCR_CONFIG["max_concurrency"])
+
+
+def test_shard_concurrency_respects_limit(app, ocr_stub, monkeypatch):
+    monkeypatch.setitem(app.OCR_CONFIG, "max_concurrency", 2)
+    page_count = app.OCR_CONFIG["pdf_shard_pages"] * 4
+
+    app.process_document_with_mistral_ocr("clave", make_pdf(page_count), "PDF", "a.pdf")
+
+    assert ocr_stub["requests"] == 4
+    assert ocr_stub["max_in_flight"] == 2
@@ -0,0 +1,27 @@
+def make_strategy(app, durations):
+    history = app.RunDurationHistory()
+    for duration in durations:
+        history.record("asst", duration)
+    strategy = app.AdaptiveBackoffWaitStrategy(history=history)
+    strategy.start("asst")
+    return strategy
+
+
+def test_base_strategy_polls_at_fixed_interval(app):
+    strategy = app.RunWaitStrategy()
+    strategy.start("asst")
+
+    assert strategy.next_delay(0, 0.0) == app.RUN_WAIT_CONFIG["poll_interval"]
+    assert strategy.timeout() == app.RUN_WAIT_CONFIG["default_timeout"]
+
+
+def test_fast_history_never_lowers_timeout_below_default(app):
+    strategy = make_strategy(app, [2.0, 3.0, 2.5])
+
+    assert strategy.timeout() == app.RUN_WAIT_CONFIG["default_timeout"]
+
+
+def test_slow_history_extends_timeout_up_to_max(app):
+    config = app.RUN_WAIT_CONFIG
+    assert make_strategy(app, [50.0]).timeout() == config["timeout_multiplier"] * 50.0
+    assert make_strategy(app, [500.0]).timeout() == config["max_timeout"]
@@ -0,0 +1,28 @@
+def test_commented_separator_splits_blocks(app):
+    validation = app.validate_yaml_content("a: 1\n--- # sección\nb: 2\n")
+
+    assert validation["valid"]
+    assert [block["data"] for block in validation["blocks"]] == [{"a": 1}, {"b": 2}]
+    assert [block["line"] for block in validation["blocks"]] == [1, 3]
+
+
+def test_separator_with_tag_keeps_tag_in_next_block(app):
+    validation = app.validate_yaml_content("a: 1\n--- !!map\nb: 2\n")
+
+    assert validation["valid"]
+    assert [block["data"] for block in validation["blocks"]] == [{"a": 1}, {"b": 2}]
+
+
+def test_error_after_commented_separator_reports_its_line(app):
+    validation = app.validate_yaml_content("a: 1\n--- # sección\nb: [1, 2\nc: 3\n")
+
+    assert not validation["valid"]
+    assert validation["blocks"][0]["data"] == {"a": 1}
+    assert validation["blocks"][1]["error"]["line"] >= 3
+
+
+def test_dashes_inside_text_are_not_separators(app):
+    validation = app.validate_yaml_content("a: |\n  ----\n  texto\n---\nb: 2\n")
+
+    assert validation["valid"]
+    assert len(validation["blocks"]) == 2